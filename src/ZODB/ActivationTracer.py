@@ -0,0 +1,179 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Tracing of object activations
+
+A connection tracing activations records, for each object whose state
+it loads, the load time and the call site: the innermost frames of the
+stack outside of ZODB and persistent.  It also remembers which object's
+record referred to each object, to spot the N+1 pattern: many siblings,
+referenced by the same parent, activated one at a time from the same
+call site, typically by a loop over the items of a container.  Such
+objects are better loaded ahead, or their data kept in their parent.
+
+Tracing costs a stack walk and a scan of the references of each record
+loaded, so it's opt-in: a database with an `activation_sample_rate`
+traces that fraction of the connections it opens, for one request.
+"""
+import heapq
+import logging
+import sys
+
+from ZODB.serialize import referencesf
+from ZODB.utils import oid_repr
+
+logger = logging.getLogger('ZODB.ActivationTracer')
+
+_skipped_modules = set(('ZODB.Connection', __name__))
+
+
+def callSite(frame, depth):
+    """Return the `depth` innermost frames from `frame` outside of ZODB
+
+    Frames are (file name, line number, function name) tuples.
+    """
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if not (module in _skipped_modules
+                or module == 'persistent'
+                or module.startswith('persistent.')):
+            break
+        frame = frame.f_back
+    site = []
+    while frame is not None and len(site) < depth:
+        code = frame.f_code
+        site.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return tuple(site)
+
+
+def formatCallSite(site):
+    return ['File "%s", line %s, in %s' % frame for frame in site]
+
+
+class ActivationTracer(object):
+    """Activations of a connection, by call site and parent
+
+    At most `max_parents` references are remembered, so that tracing a
+    request that scans the database doesn't use up memory.
+    """
+
+    stack_depth = 5
+    n_plus_one_threshold = 5 # siblings activated from the same call site
+    slowest = 10
+    max_parents = 100000
+
+    def __init__(self):
+        self.parents = {}  # {oid -> (parent oid, parent class name)}
+        self.activations = 0
+        self.load_time = 0.0
+        self.sites = {}    # {call site -> [activations, time, {class -> n}]}
+        self.siblings = {} # {(parent oid, call site) -> [activations, {..}]}
+        self.slow = []     # heap of (time, oid, class name, call site)
+
+    def loaded(self, oid, class_name, p):
+        """Note the objects referenced by the record `p` loaded for oid"""
+        parents = self.parents
+        if len(parents) >= self.max_parents:
+            return
+        parent = oid, class_name
+        for ref in referencesf(p):
+            if ref not in parents:
+                parents[ref] = parent
+
+    def activated(self, oid, class_name, seconds):
+        """Record an activation, called by the connection's setstate()"""
+        site = callSite(sys._getframe(1), self.stack_depth)
+        self.activations += 1
+        self.load_time += seconds
+
+        counts = self.sites.get(site)
+        if counts is None:
+            counts = self.sites[site] = [0, 0.0, {}]
+        counts[0] += 1
+        counts[1] += seconds
+        classes = counts[2]
+        classes[class_name] = classes.get(class_name, 0) + 1
+
+        parent = self.parents.get(oid)
+        if parent is not None:
+            key = parent, site
+            counts = self.siblings.get(key)
+            if counts is None:
+                counts = self.siblings[key] = [0, {}]
+            counts[0] += 1
+            classes = counts[1]
+            classes[class_name] = classes.get(class_name, 0) + 1
+
+        heapq.heappush(self.slow, (seconds, oid, class_name, site))
+        if len(self.slow) > self.slowest:
+            heapq.heappop(self.slow)
+
+    def getReport(self):
+        """Return a report of the activations
+
+        The result is a dictionary with the number of activations, their
+        total load_time and:
+
+        call_sites
+           A list of dictionaries with the call_site (formatted frames,
+           innermost first), the number of activations, their load_time
+           and their counts by class name, most activations first.
+
+        n_plus_one
+           A list of dictionaries with the parent oid, parent_class,
+           call_site, number of activations and their counts by class,
+           for the call sites that activated at least
+           `n_plus_one_threshold` objects referenced by the same parent,
+           most activations first.
+
+        slowest
+           A list of dictionaries with the oid, class_name, load_time
+           and call_site of the slowest activations, slowest first.
+        """
+        call_sites = [
+            dict(call_site=formatCallSite(site), activations=activations,
+                 load_time=load_time, classes=dict(classes))
+            for (site, (activations, load_time, classes))
+            in self.sites.items()]
+        call_sites.sort(key=lambda d: -d['activations'])
+        n_plus_one = [
+            dict(parent=parent, parent_class=parent_class,
+                 call_site=formatCallSite(site), activations=activations,
+                 classes=dict(classes))
+            for (((parent, parent_class), site), (activations, classes))
+            in self.siblings.items()
+            if activations >= self.n_plus_one_threshold]
+        n_plus_one.sort(key=lambda d: -d['activations'])
+        slowest = [
+            dict(oid=oid, class_name=class_name, load_time=seconds,
+                 call_site=formatCallSite(site))
+            for (seconds, oid, class_name, site)
+            in sorted(self.slow, reverse=True)]
+        return dict(activations=self.activations, load_time=self.load_time,
+                    call_sites=call_sites, n_plus_one=n_plus_one,
+                    slowest=slowest)
+
+    def log(self, report=None):
+        """Log the N+1 patterns found, if any"""
+        if report is None:
+            report = self.getReport()
+        for found in report['n_plus_one']:
+            logger.warning(
+                "%s objects referenced by %s %s activated one at a time, "
+                "%s\n  %s",
+                found['activations'], found['parent_class'],
+                oid_repr(found['parent']),
+                ', '.join('%s=%s' % item
+                          for item in sorted(found['classes'].items())),
+                '\n  '.join(found['call_site']))
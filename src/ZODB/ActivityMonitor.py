@@ -15,8 +15,130 @@
 
 $Id$"""
 
+import bisect
+import math
 import threading
 import time
+from array import array
+
+try:
+    from time import perf_counter as timer
+except ImportError:
+    from time import time as timer
+
+
+class Histogram(object):
+    """Distribution of durations, in buckets of exponentially growing size
+
+    Bucket `i` counts values up to `bounds[i]` seconds, and the last
+    bucket counts larger values.  Adding a value is a binary search and
+    a few additions, so histograms can be kept all the time.
+    """
+
+    bounds = tuple(.0001 * 2 ** i for i in range(17)) # 100us to 6.5s
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def update(self, other):
+        """Add the values counted by another histogram."""
+        buckets = self.buckets
+        for i, n in enumerate(other.buckets):
+            buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Return an upper bound of the p-th percentile (0 < p <= 100).
+
+        This is the upper bound of the bucket the percentile falls in,
+        or the largest value seen, if that's smaller.
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def getStatistics(self):
+        return dict(
+            count=self.count,
+            total=self.total,
+            mean=self.count and self.total / self.count,
+            max=self.max,
+            p50=self.percentile(50),
+            p95=self.percentile(95),
+            p99=self.percentile(99),
+            buckets=list(zip(self.bounds + (None,), self.buckets)),
+            )
+
+
+class TransferStatistics(object):
+    """Storage traffic and cache effectiveness of a connection
+
+    Connections keep one of these per request, and the activity monitor
+    sums them up for the database.
+    """
+
+    def __init__(self):
+        self.load_time = Histogram()  # Storage load()/loadBefore() calls
+        self.load_bytes = 0
+        self.stores = 0
+        self.store_bytes = 0
+        self.hits = 0           # Cache lookups answered with a non-ghost
+        self.misses = 0         # Object states loaded from the storage
+        self.invalidations = 0  # Objects invalidated in the cache
+        self.commits = 0
+        self.conflicts = 0      # ConflictErrors raised by loads and commits
+
+    def loaded(self, seconds, size):
+        self.load_time.add(seconds)
+        self.load_bytes += size
+
+    def stored(self, size):
+        self.stores += 1
+        self.store_bytes += size
+
+    def update(self, other):
+        """Add the counts of another TransferStatistics."""
+        self.load_time.update(other.load_time)
+        self.load_bytes += other.load_bytes
+        self.stores += other.stores
+        self.store_bytes += other.store_bytes
+        self.hits += other.hits
+        self.misses += other.misses
+        self.invalidations += other.invalidations
+        self.commits += other.commits
+        self.conflicts += other.conflicts
+
+    def getStatistics(self):
+        return dict(
+            loads=self.load_time.count,
+            load_time=self.load_time.getStatistics(),
+            load_bytes=self.load_bytes,
+            stores=self.stores,
+            store_bytes=self.store_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            invalidations=self.invalidations,
+            commits=self.commits,
+            conflicts=self.conflicts,
+            )
 
 
 class ActivityMonitor:
@@ -32,6 +154,8 @@ class ActivityMonitor:
         self.history_length = history_length  # Number of seconds
         self.log = []                     # [(time, loads, stores)]
         self.trim_lock = threading.Lock()
+        self.transfer = TransferStatistics() # Since we were created
+        self.transfer_lock = threading.Lock()
 
     def closedConnection(self, conn):
         log = self.log
@@ -39,6 +163,24 @@ class ActivityMonitor:
         loads, stores = conn.getTransferCounts(1)
         log.append((now, loads, stores))
         self.trim(now)
+        self._addTransfer(conn)
+
+    def _addTransfer(self, conn):
+        transfer = getattr(conn, '_transfer', None)
+        if transfer is not None:
+            self.transfer_lock.acquire()
+            try:
+                self.transfer.update(transfer)
+            finally:
+                self.transfer_lock.release()
+
+    def getTransferStatistics(self):
+        """Return the summed transfer statistics of closed connections."""
+        self.transfer_lock.acquire()
+        try:
+            return self.transfer.getStatistics()
+        finally:
+            self.transfer_lock.release()
 
     def trim(self, now):
         self.trim_lock.acquire()
@@ -110,3 +252,209 @@ class ActivityMonitor:
         div['connections'] = div['connections'] + connections
 
         return res
+
+
+class RingBufferActivityMonitor(ActivityMonitor):
+    """ZODB load/store activity monitor with constant time recording
+
+    Activity is counted in one bucket per second of history, kept in
+    preallocated arrays used as a ring buffer, so recording a closed
+    connection doesn't allocate anything and old activity doesn't have
+    to be trimmed.  Queries only look at the seconds in the window
+    asked for.
+
+    Besides totals, each bucket keeps histograms of the number of loads
+    and stores per connection, with a bucket for 0 and for each power
+    of 2, from which percentiles are estimated.
+    """
+
+    histogram_size = 24 # Counts up to 2**22, and a bucket for more.
+
+    def __init__(self, history_length=3600):
+        ActivityMonitor.__init__(self, history_length)
+        self.lock = threading.Lock()
+        self._allocate(history_length)
+
+    def _allocate(self, history_length):
+        size = max(int(math.ceil(history_length)), 1) + 1
+        self._size = size
+        self._seconds = array('l', [-1]) * size  # The second in each slot
+        self._connections = array('l', [0]) * size
+        self._loads = array('l', [0]) * size
+        self._stores = array('l', [0]) * size
+        self._commits = array('l', [0]) * size
+        hsize = self.histogram_size
+        self._load_histograms = array('l', [0]) * (size * hsize)
+        self._store_histograms = array('l', [0]) * (size * hsize)
+
+    def _bucket(self, n):
+        """The histogram bucket counting n"""
+        # The exponent is n's bit length (int.bit_length() is new in 2.7).
+        return min(math.frexp(n)[1], self.histogram_size - 1)
+
+    def closedConnection(self, conn):
+        now = time.time()
+        loads, stores = conn.getTransferCounts(1)
+        transfer = getattr(conn, '_transfer', None)
+        commits = transfer is not None and transfer.commits or 0
+        second = int(now)
+        hsize = self.histogram_size
+        self.lock.acquire()
+        try:
+            i = second % self._size
+            if self._seconds[i] != second:
+                self._clear(i)
+                self._seconds[i] = second
+            self._connections[i] += 1
+            self._loads[i] += loads
+            self._stores[i] += stores
+            self._commits[i] += commits
+            self._load_histograms[i * hsize + self._bucket(loads)] += 1
+            self._store_histograms[i * hsize + self._bucket(stores)] += 1
+        finally:
+            self.lock.release()
+        self._addTransfer(conn)
+
+    def _clear(self, i):
+        self._connections[i] = self._loads[i] = self._stores[i] = 0
+        self._commits[i] = 0
+        hsize = self.histogram_size
+        for j in range(i * hsize, (i + 1) * hsize):
+            self._load_histograms[j] = self._store_histograms[j] = 0
+
+    def trim(self, now):
+        """Old activity is overwritten, so there's nothing to trim."""
+
+    def setHistoryLength(self, history_length):
+        self.lock.acquire()
+        try:
+            old = (self._size, self._seconds, self._connections,
+                   self._loads, self._stores, self._commits,
+                   self._load_histograms, self._store_histograms)
+            self.history_length = history_length
+            self._allocate(history_length)
+            (size, seconds, connections, loads, stores, commits,
+             load_histograms, store_histograms) = old
+            hsize = self.histogram_size
+            cutoff = int(time.time() - history_length)
+            for j in range(size):
+                second = seconds[j]
+                if second < 0 or second < cutoff:
+                    continue
+                i = second % self._size
+                if self._seconds[i] > second:
+                    continue
+                self._seconds[i] = second
+                self._connections[i] = connections[j]
+                self._loads[i] = loads[j]
+                self._stores[i] = stores[j]
+                self._commits[i] = commits[j]
+                self._load_histograms[i*hsize:(i+1)*hsize] = (
+                    load_histograms[j*hsize:(j+1)*hsize])
+                self._store_histograms[i*hsize:(i+1)*hsize] = (
+                    store_histograms[j*hsize:(j+1)*hsize])
+        finally:
+            self.lock.release()
+
+    def _window(self, start, end):
+        now = time.time()
+        if start == 0:
+            start = now - self.history_length
+        if end == 0:
+            end = now
+        return start, end
+
+    def _slots(self, start, end):
+        """Return [(second, slot)] of the seconds recorded in [start, end]
+        """
+        first = max(int(start), int(time.time()) - self._size + 1)
+        result = []
+        seconds = self._seconds
+        size = self._size
+        for second in range(first, int(end) + 1):
+            i = second % size
+            if seconds[i] == second:
+                result.append((second, i))
+        return result
+
+    def getActivityAnalysis(self, start=0, end=0, divisions=10):
+        start, end = self._window(start, end)
+        res = []
+        for n in range(divisions):
+            res.append({
+                'start': start + (end - start) * n / divisions,
+                'end': start + (end - start) * (n + 1) / divisions,
+                'loads': 0,
+                'stores': 0,
+                'connections': 0,
+                'commits': 0,
+                })
+
+        width = float(end - start) / divisions
+        self.lock.acquire()
+        try:
+            for second, i in self._slots(start, end):
+                if width > 0:
+                    n = min(max(int((second - start) / width), 0),
+                            divisions - 1)
+                else:
+                    n = divisions - 1
+                div = res[n]
+                div['connections'] += self._connections[i]
+                div['loads'] += self._loads[i]
+                div['stores'] += self._stores[i]
+                div['commits'] += self._commits[i]
+        finally:
+            self.lock.release()
+        return res
+
+    def getActivitySummary(self, start=0, end=0):
+        """Summarize the activity between start and end
+
+        Return a dictionary with the number of connections, loads,
+        stores and commits, and the 50th, 95th and 99th percentiles of
+        the number of loads and stores per connection.  Percentiles
+        are upper bounds: 2**k-1 for the power of 2 bucket they fall in.
+        """
+        start, end = self._window(start, end)
+        hsize = self.histogram_size
+        load_histogram = [0] * hsize
+        store_histogram = [0] * hsize
+        connections = loads = stores = commits = 0
+        self.lock.acquire()
+        try:
+            for second, i in self._slots(start, end):
+                connections += self._connections[i]
+                loads += self._loads[i]
+                stores += self._stores[i]
+                commits += self._commits[i]
+                for k in range(hsize):
+                    load_histogram[k] += self._load_histograms[i*hsize+k]
+                    store_histogram[k] += self._store_histograms[i*hsize+k]
+        finally:
+            self.lock.release()
+
+        def percentiles(histogram):
+            result = {}
+            for p in 50, 95, 99:
+                rank = connections * p / 100.0
+                seen = 0
+                value = 0
+                for k, n in enumerate(histogram):
+                    seen += n
+                    if seen >= rank:
+                        value = (1 << k) - 1
+                        break
+                result['p%s' % p] = value
+            return result
+
+        return dict(
+            start=start,
+            end=end,
+            connections=connections,
+            loads=loads,
+            stores=stores,
+            commits=commits,
+            loads_per_connection=percentiles(load_histogram),
+            stores_per_connection=percentiles(store_histogram),
+            )
@@ -29,6 +29,8 @@ from persistent.TimeStamp import TimeStamp
 
 import ZODB.interfaces
 from ZODB import POSException
+from ZODB.ActivityMonitor import timer
+from ZODB.CommitStatistics import record
 from ZODB.utils import z64, oid_repr, byte_ord, byte_chr
 from ZODB.UndoLogCompatible import UndoLogCompatible
 from ZODB._compat import dumps, _protocol, py2_hasattr
@@ -226,7 +228,9 @@ class BaseStorage(UndoLogCompatible):
                 raise POSException.StorageTransactionError(
                     "Duplicate tpc_begin calls for same transaction")
             self._lock_release()
+            start = timer()
             self._commit_lock_acquire()
+            record('commit_lock_wait', timer() - start)
             self._lock_acquire()
             self._transaction = transaction
             self._clear_temp()
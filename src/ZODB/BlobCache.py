@@ -0,0 +1,254 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Size-bounded local cache of committed blob files
+"""
+import errno
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from ZODB import utils
+from ZODB.blob import FilesystemHelper, remove_committed, rename_or_copy_blob
+
+logger = logging.getLogger('ZODB.BlobCache')
+
+
+class BlobCache(object):
+    """Copies of a storage's committed blob files, within a byte budget.
+
+    A storage keeping its blobs in a directory on a slow file system,
+    such as a network share, can be given a cache directory on a local
+    disk.  Committed blob files are copied to the cache when first
+    loaded, and loaded from there afterwards.  When the files in the
+    cache take more than `size_bytes`, the least recently used ones are
+    removed until they take `target` of it, by a daemon thread.  Removed
+    files are copied again when next loaded.  The storage's blob
+    directory stays the authoritative copy of every file.
+
+    The files in the cache, in least recently used order, and their
+    sizes, are saved in an index in the cache directory when it's
+    closed, using 24 bytes per file.  A cache directory without an
+    index, or with an unreadable one, is cleared when opened.
+
+    The lock protecting the cache's bookkeeping is only held for
+    dictionary operations and the removal of a single file, so loading
+    blobs isn't held up by a cleanup, and open blob files can be read
+    after they're removed from the cache, on POSIX systems.
+    """
+
+    index_name = '.cache-index'
+
+    # Fraction of size_bytes cleanups reduce the cache to.
+    target = .9
+
+    def __init__(self, directory, size_bytes, layout='automatic',
+                 start=True):
+        self.fshelper = FilesystemHelper(directory, layout)
+        self.fshelper.create()
+        self.size_bytes = size_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        # {(oid, tid) -> size}, least recently used first
+        self._files = OrderedDict()
+        self._bytes = 0
+        self._load_index()
+        self._event = threading.Event()
+        self._stopped = False
+        self._thread = None
+        if start:
+            self._thread = threading.Thread(
+                target=self._run, name='ZODB blob cache cleanup')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __len__(self):
+        return len(self._files)
+
+    def get(self, oid, tid):
+        """Return the name of the cached file of a blob, or None"""
+        key = oid, tid
+        with self._lock:
+            size = self._files.pop(key, None)
+            if size is None:
+                self.misses += 1
+                return None
+            self._files[key] = size
+            self.hits += 1
+        return self.fshelper.getBlobFilename(oid, tid)
+
+    def add(self, oid, tid, source):
+        """Copy a committed blob file to the cache and return its name"""
+        fshelper = self.fshelper
+        fshelper.createPathForOID(oid)
+        filename = fshelper.getBlobFilename(oid, tid)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=fshelper.temp_dir)
+        with os.fdopen(fd, 'wb') as target:
+            with open(source, 'rb') as f:
+                utils.copy_file(f, target)
+        size = os.path.getsize(tmp)
+        key = oid, tid
+        with self._lock:
+            if key in self._files:
+                # Another thread was first
+                remove_committed(tmp)
+                return filename
+            rename_or_copy_blob(tmp, filename)
+            self._files[key] = size
+            self._bytes += size
+            over = self._bytes > self.size_bytes
+        if over:
+            self._event.set()
+        return filename
+
+    def discard(self, oid, tid):
+        """Forget the cached file of a blob, which was found missing"""
+        with self._lock:
+            size = self._files.pop((oid, tid), None)
+            if size is not None:
+                self._bytes -= size
+
+    def prune(self, exists):
+        """Remove the files of revisions the storage no longer has
+
+        `exists` is called with the oid and tid of each cached file, and
+        returns whether the storage still has the revision, which it may
+        not after a pack.  Return the number of files removed.
+        """
+        with self._lock:
+            keys = list(self._files)
+        removed = 0
+        for oid, tid in keys:
+            if exists(oid, tid):
+                continue
+            with self._lock:
+                size = self._files.pop((oid, tid), None)
+                if size is None:
+                    continue
+                self._bytes -= size
+                self._remove(oid, tid)
+            removed += 1
+        return removed
+
+    def cleanup(self):
+        """Remove least recently used files until the cache fits
+
+        Return the number of files removed.
+        """
+        removed = 0
+        target = self.size_bytes * self.target
+        while 1:
+            with self._lock:
+                if self._bytes <= self.size_bytes and not removed:
+                    break
+                if self._bytes <= target or not self._files:
+                    break
+                (oid, tid), size = self._files.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+                self._remove(oid, tid)
+            removed += 1
+        return removed
+
+    def _remove(self, oid, tid):
+        filename = self.fshelper.getBlobFilename(oid, tid)
+        try:
+            remove_committed(filename)
+        except OSError as v:
+            if v.errno != errno.ENOENT:
+                logger.warning("Couldn't remove %s: %s", filename, v)
+            return
+        try:
+            os.rmdir(os.path.dirname(filename))
+        except OSError:
+            pass # Other revisions, or a race with add().
+
+    def _run(self):
+        event = self._event
+        while 1:
+            event.wait()
+            event.clear()
+            if self._stopped:
+                break
+            try:
+                self.cleanup()
+            except Exception:
+                logger.exception("Cleaning up the blob cache")
+
+    def getStatistics(self):
+        """Return a dictionary describing the use of the cache."""
+        with self._lock:
+            return dict(
+                size_bytes=self.size_bytes,
+                bytes=self._bytes,
+                files=len(self._files),
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                )
+
+    def close(self):
+        self._stopped = True
+        self._event.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(10)
+        self._save_index()
+
+    def _index_path(self):
+        return os.path.join(self.fshelper.base_dir, self.index_name)
+
+    def _save_index(self):
+        path = self._index_path()
+        with self._lock:
+            data = b''.join(oid + tid + utils.p64(size)
+                            for ((oid, tid), size) in self._files.items())
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def _load_index(self):
+        path = self._index_path()
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            data = None
+        if data is None or len(data) % 24:
+            if data is not None:
+                logger.warning("Ignoring the invalid blob cache index %s",
+                               path)
+            self._clear()
+            return
+        # The index is removed while in use, so it can't get stale if the
+        # process doesn't close the cache.
+        os.remove(path)
+        files = self._files
+        for i in range(0, len(data), 24):
+            size = utils.u64(data[i+16:i+24])
+            files[data[i:i+8], data[i+8:i+16]] = size
+            self._bytes += size
+
+    def _clear(self):
+        """Remove the files left in a cache without index"""
+        for oid, path in self.fshelper.listOIDs():
+            for name in os.listdir(path):
+                if name.endswith('.blob'):
+                    remove_committed(os.path.join(path, name))
+        temp_dir = self.fshelper.temp_dir
+        for name in os.listdir(temp_dir):
+            remove_committed(os.path.join(temp_dir, name))
@@ -0,0 +1,188 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Database-wide memory budget for connection caches
+"""
+import logging
+import threading
+
+logger = logging.getLogger('ZODB.CacheBudget')
+
+
+class CacheBudget(object):
+    """Keep the caches of all of a database's connections within a budget.
+
+    The cache_size_bytes setting applies to each connection separately,
+    so the memory used by a database's caches grows with the number of
+    connections.  A CacheBudget caps the total estimated size (as recorded
+    in _p_estimated_size) of all the connection caches of a database.
+
+    When the budget is exceeded, connections are shrunk in order of
+    how recently they were used: first the connections sitting unused in
+    the pool, oldest first, then the open connections, least recently
+    opened first.  Unused connections are garbage collected right away.
+    They're taken out of the pool meanwhile, so they can't be handed out,
+    rather than holding the database lock, which would hold up opening
+    and closing connections.  A cache can only be used by the thread
+    using its connection, so for open connections we just lower the
+    cache's cache_size_bytes target, which the connection applies at its
+    next transaction boundary.  Once the caches fit in `restore_ratio`
+    of the budget, the targets are restored.  (Restoring them as soon as
+    the caches fit would let them grow right back over the budget, and
+    cache sizes would swing back and forth between trims.)
+
+    Trimming is done every `interval` seconds by a daemon thread, unless
+    `start` is false.
+    """
+
+    interval = 5
+    restore_ratio = .9
+
+    def __init__(self, db, size_bytes, interval=None, start=True):
+        self._db = db
+        self.size_bytes = size_bytes
+        if interval is not None:
+            self.interval = interval
+        self.trims = 0          # Number of times we had to shrink caches
+        self.trimmed_bytes = 0  # Estimated bytes freed from unused caches
+        self._event = threading.Event()
+        self._stopped = False
+        self._thread = None
+        if start:
+            self._thread = threading.Thread(
+                target=self._run, name='ZODB cache budget')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._event.wait(self.interval)
+            if self._stopped:
+                break
+            try:
+                self.trim()
+            except Exception:
+                logger.exception("Trimming connection caches")
+
+    def close(self):
+        self._stopped = True
+        self._event.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(10)
+
+    def _connections(self):
+        """Return [(last_used, idle, target, connection)], in trim order.
+
+        This must be called with the database lock held.
+        """
+        db = self._db
+        idle = {}
+        for t, c in db.pool.available:
+            idle[c] = t
+        for pool in db.historical_pool.pools.values():
+            for t, c in pool.available:
+                idle[c] = t
+
+        result = []
+        def add(c):
+            if c._cache is None or c._storage is None:
+                return # released
+            if c.before is None:
+                target = db._cache_size_bytes
+            else:
+                target = db._historical_cache_size_bytes
+            if c in idle:
+                result.append((0, idle[c], target, c))
+            else:
+                result.append((1, c.opened or 0, target, c))
+        db.pool.map(add)
+        db.historical_pool.map(add)
+        result.sort(key=lambda r: r[:2])
+        return [(last_used, not open_, target, c)
+                for (open_, last_used, target, c) in result]
+
+    def trim(self):
+        """Shrink connection caches to fit the budget.
+
+        Return the total estimated size of the caches before trimming.
+        """
+        db = self._db
+        # [(connection, its pool, its position in it, estimated size)]
+        withdrawn = []
+        db._a()
+        try:
+            connections = self._connections()
+            total = sum(c._cache.total_estimated_size
+                        for (_, _, _, c) in connections)
+            excess = total - self.size_bytes
+            if excess > 0:
+                self.trims += 1
+            restore = total <= self.size_bytes * self.restore_ratio
+            for last_used, idle, target, c in connections:
+                cache = c._cache
+                if excess > 0:
+                    size = cache.total_estimated_size
+                    # A cache_size_bytes of 0 means unlimited, so we
+                    # can't go below 1.
+                    limit = max(size - excess, 1)
+                    if target:
+                        limit = min(limit, target)
+                    cache.cache_size_bytes = limit
+                    excess -= size - limit
+                    if idle:
+                        if c.before is None:
+                            pool = db.pool
+                        else:
+                            pool = db.historical_pool.pools[c.before]
+                        withdrawn.append(
+                            (c, pool, pool.withdraw(c), size))
+                elif restore:
+                    cache.cache_size_bytes = target
+        finally:
+            db._r()
+
+        for c, pool, position, size in withdrawn:
+            try:
+                cache = c._cache
+                c._cache_policy.gc(cache)
+                self.trimmed_bytes += size - cache.total_estimated_size
+            except Exception:
+                logger.exception("Trimming the cache of %s", c)
+            db._a()
+            try:
+                pool.restore(c, position)
+            finally:
+                db._r()
+        return total
+
+    def getStatistics(self):
+        """Return a dictionary describing how the budget is being spent."""
+        db = self._db
+        db._a()
+        try:
+            connections = self._connections()
+            total = sum(c._cache.total_estimated_size
+                        for (_, _, _, c) in connections)
+            idle = sum(c._cache.total_estimated_size
+                       for (_, idle, _, c) in connections if idle)
+        finally:
+            db._r()
+        return dict(
+            budget=self.size_bytes,
+            total=total,
+            idle=idle,
+            connections=len(connections),
+            trims=self.trims,
+            trimmed_bytes=self.trimmed_bytes,
+            )
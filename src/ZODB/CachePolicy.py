@@ -0,0 +1,328 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Eviction policies for connection object caches
+
+A connection's PickleCache keeps its non-ghost objects in least
+recently used order and, when asked to garbage collect, ghostifies the
+least recently used ones until it's back under its targets.  A cache
+policy decides which objects to ghostify instead.  The connection tells
+its policy about cache hits (get() returning an object whose state is
+loaded, or a reference to one being resolved while unpickling) and
+misses (object states loaded from the storage, including ghosts being
+activated) and asks it to garbage collect the cache at transaction
+boundaries.  Attribute access on objects that are already loaded is
+handled by the cache itself, in C, and isn't seen by the policy.
+
+A policy is created by calling a factory without arguments, once for
+each connection.  The policies defined here are registered by name in
+`policies`.
+"""
+from collections import OrderedDict
+import heapq
+
+
+class LRUPolicy(object):
+    """Least recently used, the cache's own eviction order
+    """
+
+    name = 'lru'
+
+    def __init__(self):
+        self.hits = 0       # Cache lookups answered with a non-ghost
+        self.misses = 0     # Object states loaded from the storage
+        self.evictions = 0  # Objects ghostified by gc()
+
+    def hit(self, obj):
+        self.hits += 1
+
+    def miss(self, obj):
+        self.misses += 1
+
+    def gc(self, cache):
+        """Ghostify objects until the cache is within its targets."""
+        before = cache.cache_non_ghost_count
+        self._sweep(cache)
+        self.evictions += max(before - cache.cache_non_ghost_count, 0)
+
+    def _sweep(self, cache):
+        cache.incrgc()
+
+    def clear(self):
+        """Forget about the objects in the cache, which was replaced."""
+
+    def getStatistics(self):
+        return dict(
+            policy=self.name,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            )
+
+
+def _over(cache):
+    """Is the cache over its targets?"""
+    if cache.cache_non_ghost_count > cache.cache_size:
+        return True
+    size_bytes = cache.cache_size_bytes
+    return bool(size_bytes) and cache.total_estimated_size > size_bytes
+
+
+def _resident(cache, oid):
+    """Is the object with the given oid in the cache, and not a ghost?"""
+    obj = cache.get(oid, None)
+    return obj is not None and obj._p_changed is not None
+
+
+def _tracked_limit(cache):
+    # The number of objects a policy may track before it looks for the
+    # ones that left the cache some other way (invalidation,
+    # cacheMinimize ...).  Doubling it each time keeps that amortized O(1).
+    return 2 * max(cache.cache_size, cache.cache_non_ghost_count, 1)
+
+
+def _evict(obj):
+    """Ghostify obj if it's unmodified.  Return whether we did."""
+    if obj._p_changed is not False:
+        return False # Modified, or already a ghost.
+    obj._p_deactivate()
+    return obj._p_changed is None
+
+
+class TwoQueuePolicy(LRUPolicy):
+    """Scan resistant eviction, after the 2Q algorithm
+
+    Objects loaded from the storage are on probation.  An object that
+    is used again in a later transaction, either because it's looked up
+    in the cache or because it's loaded again soon after having been
+    evicted, shows that it's part of the working set and becomes hot.
+    Probationary objects are evicted first, in the order they were
+    loaded, as long as they take up more than `in_fraction` of the
+    cache, so a scan through many objects used once, like a catalog
+    reindex, only displaces other probationary objects.  Hot objects are
+    evicted in least recently used order.  Objects the policy wasn't
+    told about, like new objects added by the connection, are left to
+    the cache's own order.
+
+    The ids of up to `out_fraction` times the cache size objects
+    evicted from probation are remembered.
+    """
+
+    name = '2q'
+    in_fraction = .25
+    out_fraction = .5
+
+    def __init__(self):
+        LRUPolicy.__init__(self)
+        self._period = 0                 # Number of gc() calls
+        self._probation = OrderedDict()  # {oid -> period loaded}
+        self._hot = OrderedDict()        # {oid -> None}, least recent first
+        self._out = OrderedDict()
+
+    def _use_hot(self, oid):
+        self._hot.pop(oid, None)
+        self._hot[oid] = None
+
+    def hit(self, obj):
+        self.hits += 1
+        oid = obj._p_oid
+        if oid in self._hot:
+            self._use_hot(oid)
+            return
+        loaded = self._probation.get(oid)
+        if loaded is not None and loaded < self._period:
+            del self._probation[oid]
+            self._use_hot(oid)
+
+    def miss(self, obj):
+        self.misses += 1
+        oid = obj._p_oid
+        if oid in self._out:
+            del self._out[oid]
+            self._use_hot(oid)
+        elif oid in self._hot:
+            self._use_hot(oid)
+        else:
+            self._probation.pop(oid, None)
+            self._probation[oid] = self._period
+
+    def gc(self, cache):
+        self._period += 1
+        LRUPolicy.gc(self, cache)
+
+    def _sweep(self, cache):
+        if not _over(cache):
+            return
+        probation = self._probation
+        hot = self._hot
+        if len(probation) + len(hot) > _tracked_limit(cache):
+            for queue in probation, hot:
+                for oid in [oid for oid in queue
+                            if not _resident(cache, oid)]:
+                    del queue[oid]
+
+        out = self._out
+        out_size = int(cache.cache_size * self.out_fraction)
+        in_size = cache.cache_size * self.in_fraction
+        # Look at each object at most once.  Modified objects can't be
+        # evicted and are put back afterwards.
+        probation_left = len(probation)
+        hot_left = len(hot)
+        modified = []
+        while _over(cache) and (probation_left or hot_left):
+            if probation_left and (len(probation) > in_size or not hot_left):
+                probation_left -= 1
+                oid, loaded = probation.popitem(False)
+                obj = cache.get(oid, None)
+                if obj is None:
+                    continue
+                if _evict(obj):
+                    out[oid] = None
+                    while len(out) > out_size:
+                        out.popitem(False)
+                elif obj._p_changed is not None:
+                    modified.append((probation, oid, loaded))
+            else:
+                hot_left -= 1
+                oid, _ = hot.popitem(False)
+                obj = cache.get(oid, None)
+                if obj is not None and not _evict(obj) and (
+                    obj._p_changed is not None):
+                    modified.append((hot, oid, None))
+        for queue, oid, value in modified:
+            queue[oid] = value
+
+        if _over(cache):
+            cache.incrgc()
+
+    def clear(self):
+        self._probation.clear()
+        self._hot.clear()
+        self._out.clear()
+
+
+class SizeAwareLFUPolicy(LRUPolicy):
+    """Frequency and size aware eviction, after the GDSF algorithm
+
+    Each object has a priority, computed when it's used as::
+
+      inflation + frequency / size
+
+    where frequency counts the hits and misses of the object while it's
+    in the cache and size is its _p_estimated_size.  Objects with the
+    lowest priority are evicted first, so large objects that are rarely
+    used go before small, popular ones, and objects used once during a
+    scan go before the working set.  The inflation is raised to the
+    priority of each object evicted, so that objects that were popular
+    a long time ago eventually age out.  Objects the policy wasn't told
+    about, like new objects added by the connection, are left to the
+    cache's own order.
+
+    Priorities are kept in a heap, so that a sweep only looks at the
+    objects it evicts.
+    """
+
+    name = 'lfu'
+
+    def __init__(self):
+        LRUPolicy.__init__(self)
+        self._inflation = 0.0
+        self._uses = 0
+        self._frequency = {}
+        # {oid -> (priority, use, oid)}, the current entry for each object
+        # in _heap.  Entries replaced by later uses are left in the heap
+        # and skipped.  Ties go in least recently used order.
+        self._priority = {}
+        self._heap = []
+
+    def _used(self, obj):
+        oid = obj._p_oid
+        frequency = self._frequency.get(oid, 0) + 1
+        self._frequency[oid] = frequency
+        self._uses += 1
+        self._priority[oid] = entry = (
+            self._inflation + float(frequency) / (obj._p_estimated_size or 1),
+            self._uses, oid)
+        heap = self._heap
+        heapq.heappush(heap, entry)
+        if len(heap) > 2 * len(self._priority) + 100:
+            self._rebuild()
+
+    def _rebuild(self):
+        self._heap = list(self._priority.values())
+        heapq.heapify(self._heap)
+
+    def hit(self, obj):
+        self.hits += 1
+        self._used(obj)
+
+    def miss(self, obj):
+        self.misses += 1
+        self._used(obj)
+
+    def _sweep(self, cache):
+        if not _over(cache):
+            return
+        frequency = self._frequency
+        priority = self._priority
+        if len(priority) > _tracked_limit(cache):
+            for oid in [oid for oid in priority if not _resident(cache, oid)]:
+                del priority[oid]
+                frequency.pop(oid, None)
+            self._rebuild()
+
+        heap = self._heap
+        modified = []
+        while heap and _over(cache):
+            entry = heapq.heappop(heap)
+            oid = entry[2]
+            if priority.get(oid) is not entry:
+                continue # Replaced by a later use.
+            obj = cache.get(oid, None)
+            if obj is not None and obj._p_changed is not None:
+                if not _evict(obj):
+                    modified.append(entry)
+                    continue
+                self._inflation = max(self._inflation, entry[0])
+            del priority[oid]
+            frequency.pop(oid, None)
+        for entry in modified:
+            heapq.heappush(heap, entry)
+
+        if _over(cache):
+            cache.incrgc()
+
+    def clear(self):
+        self._frequency.clear()
+        self._priority.clear()
+        del self._heap[:]
+
+
+policies = {
+    LRUPolicy.name: LRUPolicy,
+    TwoQueuePolicy.name: TwoQueuePolicy,
+    SizeAwareLFUPolicy.name: SizeAwareLFUPolicy,
+    }
+
+
+def getPolicyFactory(policy):
+    """Return a policy factory given a policy name or factory."""
+    if policy is None:
+        return LRUPolicy
+    if callable(policy):
+        return policy
+    try:
+        return policies[policy]
+    except KeyError:
+        raise ValueError("Unknown cache policy %r (expected one of %s)"
+                         % (policy, ', '.join(sorted(policies))))
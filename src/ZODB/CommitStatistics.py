@@ -0,0 +1,169 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Timing of the phases of two-phase commit
+
+When a database has commit statistics, its connections time each phase
+of the commits they take part in.  The phases are nested:
+
+tpc_begin
+   Storage tpc_begin(), including commit_lock_wait, the time spent
+   waiting for the storage's commit lock.
+
+commit
+   Connection commit(), including serialize (pickling objects) and
+   store (storage store() calls, including conflict_resolution).
+
+tpc_vote
+   Storage tpc_vote().
+
+tpc_finish
+   Storage tpc_finish(), including invalidation (publishing the
+   invalidations to the database) and storage_finish (the storage's
+   _finish(), including fsync).
+
+Storages add the time of their own phases by calling record(), which
+charges the commit being timed in the current thread, if any.
+"""
+import logging
+import threading
+
+from ZODB.ActivityMonitor import Histogram, timer
+from ZODB.utils import class_name
+
+logger = logging.getLogger('ZODB.CommitStatistics')
+
+phases = ('tpc_begin', 'commit_lock_wait',
+          'commit', 'serialize', 'store', 'conflict_resolution',
+          'tpc_vote',
+          'tpc_finish', 'invalidation', 'storage_finish', 'fsync',
+          )
+
+_current = threading.local()
+
+
+def record(phase, seconds):
+    """Add time spent in a phase to the commit timed in this thread."""
+    timing = getattr(_current, 'timing', None)
+    if timing is not None:
+        timing.add(phase, seconds)
+
+
+class Phase(object):
+    """Time a phase, making its commit the current thread's"""
+
+    def __init__(self, timing, name):
+        self.timing = timing
+        self.name = name
+
+    def __enter__(self):
+        self.previous = getattr(_current, 'timing', None)
+        _current.timing = self.timing
+        self.start = timer()
+
+    def __exit__(self, *args):
+        self.timing.add(self.name, timer() - self.start)
+        _current.timing = self.previous
+
+
+class NoPhase(object):
+    """Used instead of a Phase when commits aren't timed"""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+nophase = NoPhase()
+
+
+class CommitTiming(object):
+    """The phase times of one connection's part in a commit
+    """
+
+    def __init__(self):
+        self.start = timer()
+        self.phases = {}   # {phase -> seconds}
+        self.classes = {}  # {class name -> number of objects stored}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def stored(self, obj):
+        name = class_name(obj.__class__)
+        self.classes[name] = self.classes.get(name, 0) + 1
+
+
+class CommitStatistics(object):
+    """Commit phase times for a database
+
+    Commits taking `slow_threshold` seconds or more are logged, with
+    their phase times and the number of objects stored by class.
+    """
+
+    def __init__(self, slow_threshold=None):
+        self.slow_threshold = slow_threshold
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.aborts = 0
+        self.slow = 0     # Number of commits logged as slow
+        self.total = Histogram()
+        self.phases = dict((name, Histogram()) for name in phases)
+
+    def begin(self):
+        return CommitTiming()
+
+    def aborted(self, timing):
+        with self.lock:
+            self.aborts += 1
+
+    def finished(self, timing, transaction):
+        total = timer() - timing.start
+        with self.lock:
+            self.commits += 1
+            self.total.add(total)
+            for name, seconds in timing.phases.items():
+                histogram = self.phases.get(name)
+                if histogram is None:
+                    histogram = self.phases[name] = Histogram()
+                histogram.add(seconds)
+            slow = (self.slow_threshold is not None
+                    and total >= self.slow_threshold)
+            if slow:
+                self.slow += 1
+
+        if slow:
+            logger.warning(
+                "Slow commit, %.3fs: %r by %r\n  phases: %s\n  objects: %s",
+                total, transaction.description, transaction.user,
+                ', '.join('%s=%.3fs' % (name, timing.phases[name])
+                          for name in phases if name in timing.phases),
+                ', '.join('%s=%s' % item
+                          for item in sorted(timing.classes.items())),
+                )
+
+    def getStatistics(self):
+        with self.lock:
+            return dict(
+                commits=self.commits,
+                aborts=self.aborts,
+                slow=self.slow,
+                slow_threshold=self.slow_threshold,
+                total=self.total.getStatistics(),
+                phases=dict((name, h.getStatistics())
+                            for (name, h) in self.phases.items()),
+                )
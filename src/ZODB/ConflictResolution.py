@@ -14,12 +14,18 @@
 
 import logging
 import sys
+import threading
+from collections import OrderedDict
 
 import six
 import zope.interface
+from ZODB.ActivityMonitor import Histogram, timer
+from ZODB.CommitStatistics import record
 from ZODB.POSException import ConflictError
 from ZODB.loglevels import BLATHER
+from ZODB.utils import get_pickle_protocol
 from ZODB._compat import BytesIO, Unpickler, Pickler, _protocol
+from ZODB._compat import HIGHEST_PROTOCOL
 
 # Subtle: Python 2.x has pickle.PicklingError and cPickle.PicklingError,
 # and these are unrelated classes!  So we shouldn't use pickle.PicklingError,
@@ -235,9 +241,105 @@ def persistent_id(object):
         return None
     return object.data
 
+class ResolutionCache(object):
+    """Committed records used to resolve conflicts, and resolution times
+
+    A hot object, like a counter, that keeps conflicting is resolved
+    against the same few revisions over and over, while the storage
+    holds its commit lock.  Records are kept by (oid, serial), which
+    identifies them for good, so they aren't loaded from the storage
+    again.  The records are kept pickled, because resolvers are free to
+    change the states they're passed: each resolution still unpickles
+    the states it needs.  (Keeping unpickled states would mean deep
+    copying them instead, which isn't cheaper.)
+
+    At most `size` records of up to `max_record_size` bytes are kept,
+    the least recently used ones being dropped first.
+    """
+
+    def __init__(self, size=100, max_record_size=1<<20):
+        self.size = size
+        self.max_record_size = max_record_size
+        self.lock = threading.Lock()
+        self.records = OrderedDict() # {(oid, serial) -> data}
+        self.hits = self.misses = 0
+        self.resolved = self.failed = 0
+        self.time = Histogram()
+
+    def loadSerial(self, storage, oid, serial):
+        key = oid, serial
+        with self.lock:
+            data = self.records.pop(key, None)
+            if data is not None:
+                self.records[key] = data
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = storage.loadSerial(oid, serial)
+        self.add(oid, serial, data)
+        return data
+
+    def add(self, oid, serial, data):
+        if len(data) > self.max_record_size:
+            return
+        with self.lock:
+            records = self.records
+            records.pop((oid, serial), None)
+            records[oid, serial] = data
+            while len(records) > self.size:
+                records.popitem(False)
+
+    def finished(self, seconds, resolved):
+        with self.lock:
+            self.time.add(seconds)
+            if resolved:
+                self.resolved += 1
+            else:
+                self.failed += 1
+
+    def getStatistics(self):
+        with self.lock:
+            return dict(
+                resolved=self.resolved,
+                failed=self.failed,
+                time=self.time.getStatistics(),
+                cache_hits=self.hits,
+                cache_misses=self.misses,
+                cache_records=len(self.records),
+                )
+
+# Guards the creation of resolution caches.  Storages may call
+# tryToResolveConflict with their own lock held.
+_resolution_cache_lock = threading.Lock()
+
+def _resolutionCache(storage):
+    cache = getattr(storage, '_crs_cache', None)
+    if cache is None:
+        with _resolution_cache_lock:
+            cache = getattr(storage, '_crs_cache', None)
+            if cache is None:
+                cache = storage._crs_cache = ResolutionCache(
+                    getattr(storage, 'conflict_resolution_cache_size', 100))
+    return cache
+
 _unresolvable = {}
 def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
                          committedData=b''):
+    cache = _resolutionCache(self)
+    resolved = False
+    start = timer()
+    try:
+        data = _tryToResolveConflict(self, cache, oid, committedSerial,
+                                     oldSerial, newpickle, committedData)
+        resolved = True
+        return data
+    finally:
+        seconds = timer() - start
+        cache.finished(seconds, resolved)
+        record('conflict_resolution', seconds)
+
+def _tryToResolveConflict(self, cache, oid, committedSerial, oldSerial,
+                          newpickle, committedData=b''):
     # class_tuple, old, committed, newstate = ('',''), 0, 0, 0
     try:
         prfactory = PersistentReferenceFactory()
@@ -268,9 +370,11 @@ def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
             raise ConflictError
 
 
-        oldData = self.loadSerial(oid, oldSerial)
-        if not committedData:
-            committedData  = self.loadSerial(oid, committedSerial)
+        oldData = cache.loadSerial(self, oid, oldSerial)
+        if committedData:
+            cache.add(oid, committedSerial, committedData)
+        else:
+            committedData = cache.loadSerial(self, oid, committedSerial)
 
         if newpickle == oldData:
             # old -> new diff is empty, so merge is trivial
@@ -285,8 +389,11 @@ def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
 
         resolved = resolve(old, committed, newstate)
 
+        # The resolved state is pickled like the new one.
         file = BytesIO()
-        pickler = Pickler(file, _protocol)
+        protocol = get_pickle_protocol(newpickle)
+        pickler = Pickler(file, min(max(protocol, _protocol),
+                                    HIGHEST_PROTOCOL))
         if sys.version_info[0] < 3:
             pickler.inst_persistent_id = persistent_id
         else:
@@ -312,6 +419,13 @@ class ConflictResolvingStorage(object):
 
     tryToResolveConflict = tryToResolveConflict
 
+    # The number of committed records kept for conflict resolution
+    conflict_resolution_cache_size = 100
+
+    def getConflictResolutionStatistics(self):
+        """Return conflict resolution counts, times and cache use."""
+        return _resolutionCache(self).getStatistics()
+
     _crs_transform_record_data = _crs_untransform_record_data = (
         lambda self, o: o)
 
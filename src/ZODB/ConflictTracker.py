@@ -0,0 +1,140 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Tracking of the objects involved in conflicts
+
+A database's connections report the conflicts they run into to the
+database's ConflictTracker: write conflicts raised while committing,
+conflicts resolved by the storage and read conflicts.  The tracker
+counts them by object and by class over a sliding window, so that the
+most contended objects can be found and, for example, replaced by
+conflict-resolving counters or split up.
+"""
+import collections
+import threading
+
+from ZODB.ActivityMonitor import timer
+
+kinds = ('conflicts', 'resolved', 'read_conflicts')
+_CONFLICTS, _RESOLVED, _READ_CONFLICTS = range(len(kinds))
+
+
+class ConflictTracker(object):
+    """Conflict counts by object and class over the last `window` seconds
+
+    At most `max_events` conflicts are remembered, so a conflict storm
+    can't use up memory.
+    """
+
+    max_events = 100000
+
+    def __init__(self, window=3600):
+        self.window = window
+        self.lock = threading.Lock()
+        self.events = collections.deque()  # [(time, kind, oid, class name)]
+        self.objects = {} # {oid -> [class name, counts by kind...]}
+        self.classes = {} # {class name -> [counts by kind...]}
+        self.totals = [0] * len(kinds)
+
+    def conflict(self, oid, class_name):
+        """Count a write conflict that wasn't resolved."""
+        self._add(_CONFLICTS, oid, class_name)
+
+    def resolved(self, oid, class_name):
+        """Count a conflict resolved by the storage."""
+        self._add(_RESOLVED, oid, class_name)
+
+    def read_conflict(self, oid, class_name):
+        self._add(_READ_CONFLICTS, oid, class_name)
+
+    def _add(self, kind, oid, class_name):
+        now = timer()
+        with self.lock:
+            self.events.append((now, kind, oid, class_name))
+            self._count(kind, oid, class_name, 1)
+            self._trim(now)
+
+    def _count(self, kind, oid, class_name, n):
+        self.totals[kind] += n
+        if class_name is not None:
+            counts = self.classes.get(class_name)
+            if counts is None:
+                counts = self.classes[class_name] = [0] * len(kinds)
+            counts[kind] += n
+            if not any(counts):
+                del self.classes[class_name]
+        if oid is not None:
+            counts = self.objects.get(oid)
+            if counts is None:
+                counts = self.objects[oid] = [class_name] + [0] * len(kinds)
+            counts[kind + 1] += n
+            if class_name is not None:
+                counts[0] = class_name
+            if not any(counts[1:]):
+                del self.objects[oid]
+
+    def _trim(self, now):
+        events = self.events
+        cutoff = now - self.window
+        while events and (events[0][0] < cutoff
+                          or len(events) > self.max_events):
+            _, kind, oid, class_name = events.popleft()
+            self._count(kind, oid, class_name, -1)
+
+    def setWindow(self, window):
+        with self.lock:
+            self.window = window
+            self._trim(timer())
+
+    def getWindow(self):
+        return self.window
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.objects.clear()
+            self.classes.clear()
+            self.totals = [0] * len(kinds)
+
+    def getReport(self, top=10):
+        """Return conflict counts, with the `top` most contended objects
+
+        The result is a dictionary with the window, the conflict counts
+        by kind and:
+
+        objects
+           A list of dictionaries with oid, class_name and the counts
+           by kind, most conflicts first.
+
+        classes
+           A list of dictionaries with class_name and the counts by kind,
+           most conflicts first.
+        """
+        with self.lock:
+            self._trim(timer())
+            objects = [dict(zip(('oid', 'class_name') + kinds,
+                                (oid, ) + tuple(counts)))
+                       for (oid, counts) in self.objects.items()]
+            classes = [dict(zip(('class_name', ) + kinds,
+                                (class_name, ) + tuple(counts)))
+                       for (class_name, counts) in self.classes.items()]
+            result = dict(zip(kinds, self.totals))
+
+        def key(item):
+            return (-sum(item[kind] for kind in kinds),
+                    item['class_name'] or '')
+        objects.sort(key=key)
+        classes.sort(key=key)
+        result.update(window=self.window, objects=objects[:top],
+                      classes=classes)
+        return result
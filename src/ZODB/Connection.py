@@ -15,12 +15,14 @@
 
 $Id$"""
 
+import itertools
 import logging
 import sys
 import tempfile
 import threading
 import warnings
 import os
+import random
 import time
 
 from persistent import PickleCache
@@ -39,6 +41,9 @@ from zope.interface import implementer
 import transaction
 
 import ZODB
+from ZODB.ActivationTracer import ActivationTracer
+from ZODB.ActivityMonitor import TransferStatistics, timer
+from ZODB.CommitStatistics import nophase
 from ZODB.blob import SAVEPOINT_SUFFIX
 from ZODB.ConflictResolution import ResolvedSerial
 from ZODB.ExportImport import ExportImport
@@ -48,7 +53,7 @@ from ZODB.POSException import ConflictError, ReadConflictError
 from ZODB.POSException import Unsupported, ReadOnlyHistoryError
 from ZODB.POSException import POSKeyError
 from ZODB.serialize import ObjectWriter, ObjectReader
-from ZODB.utils import p64, u64, z64, oid_repr, positive_id
+from ZODB.utils import p64, u64, z64, oid_repr, positive_id, class_name
 from ZODB import utils
 import six
 
@@ -74,6 +79,27 @@ def className(obj):
     return "%s.%s" % (cls.__module__, cls.__name__)
 
 
+def _cacheClassReport(counts):
+    """Turn class counts into a report, biggest classes first."""
+    result = []
+    for name, (objects, ghosts, size, activations, rate) in six.iteritems(
+        counts):
+        objects = int(round(objects))
+        ghosts = int(round(ghosts))
+        result.append({
+            'class': name,
+            'objects': objects,
+            'ghosts': ghosts,
+            'non_ghosts': objects - ghosts,
+            'ghost_ratio': objects and float(ghosts) / objects,
+            'estimated_size': int(round(size)),
+            'activations': activations,
+            'activation_rate': rate,
+            })
+    result.sort(key=lambda d: (-d['estimated_size'], d['class']))
+    return result
+
+
 @implementer(IConnection,
              ISavepointDataManager,
              IPersistentDataManager,
@@ -119,16 +145,29 @@ class Connection(ExportImport, object):
         self._needs_to_join = True
         self.transaction_manager = None
         self.opened = None # time.time() when DB.open() opened us
+        self._affinity = None # affinity key DB.open() last opened us with
 
         self._reset_counter = global_reset_counter
         self._load_count = 0   # Number of objects unghosted
         self._store_count = 0  # Number of objects stored
+        self._activations = {} # {class -> number of objects unghosted}
+        self._activations_since = None # Set when we're first opened
+        self._transfer = TransferStatistics() # Reset by open()
+        # Set by open() for the requests the database samples
+        self._activation_tracer = None
+        # Phase times of the commit in progress, if the database times
+        # commits.
+        self._commit_timing = None
 
         # Cache which can ghostify (forget the state of) objects not
         # recently used. Its API is roughly that of a dict, with
         # additional gc-related and invalidation-related methods.
         self._cache = PickleCache(self, cache_size, cache_size_bytes)
 
+        # Decides which objects the cache ghostifies when it's over its
+        # targets.  See ZODB.CachePolicy.
+        self._cache_policy = db._cache_policy()
+
         # The pre-cache is used by get to avoid infinite loops when
         # objects immediately load their state whern they get their
         # persistent data set.
@@ -185,7 +224,14 @@ class Connection(ExportImport, object):
         # critical sections (if any -- this needs careful thought).
 
         self._inv_lock = threading.Lock()
-        self._invalidated = set()
+        self.__invalidated = set()
+
+        # Invalidations committed through the DB aren't delivered to us
+        # one by one.  The DB appends them to a shared log, and we merge
+        # entries past _inv_position into _invalidated whenever we need
+        # an up-to-date view (see _read_invalidation_log).
+        self._inv_log = db._invalidation_log
+        self._inv_position = self._inv_log.position
 
         # Flag indicating whether the cache has been invalidated:
         self._invalidatedCache = False
@@ -203,7 +249,7 @@ class Connection(ExportImport, object):
         # this connection. That is, all object revisions must be
         # written before _txn_time. If it is None, then the current
         # revisions are acceptable.
-        self._txn_time = None
+        self.__txn_time = None
 
         # To support importFile(), implemented in the ExportImport base
         # class, we need to run _importDuringCommit() from our commit()
@@ -211,7 +257,8 @@ class Connection(ExportImport, object):
         # to pass to _importDuringCommit().
         self._import = None
 
-        self._reader = ObjectReader(self, self._cache, self._db.classFactory)
+        self._reader = ObjectReader(self, self._cache, self._db.classFactory,
+                                    self._db._classCache())
 
 
     def add(self, obj):
@@ -238,6 +285,12 @@ class Connection(ExportImport, object):
         elif obj._p_jar is not self:
             raise InvalidObjectReference(obj, obj._p_jar)
 
+    def _cache_hit(self, obj):
+        # obj, whose state is loaded, was found in the cache by get() or
+        # while unpickling a reference to it.
+        self._cache_policy.hit(obj)
+        self._transfer.hits += 1
+
     def get(self, oid):
         """Return the persistent object with oid 'oid'."""
         if self.opened is None:
@@ -245,6 +298,8 @@ class Connection(ExportImport, object):
 
         obj = self._cache.get(oid, None)
         if obj is not None:
+            if obj._p_changed is not None:
+                self._cache_hit(obj)
             return obj
         obj = self._added.get(oid, None)
         if obj is not None:
@@ -253,7 +308,9 @@ class Connection(ExportImport, object):
         if obj is not None:
             return obj
 
+        start = timer()
         p, serial = self._storage.load(oid, '')
+        self._transfer.loaded(timer() - start, len(p))
         obj = self._reader.getGhost(p)
 
         # Avoid infiniate loop if obj tries to load its state before
@@ -276,7 +333,7 @@ class Connection(ExportImport, object):
         """Reduce cache size to target size.
         """
         for connection in six.itervalues(self.connections):
-            connection._cache.incrgc()
+            connection._cache_policy.gc(connection._cache)
 
     __onCloseCallbacks = None
     def onCloseCallback(self, f):
@@ -293,7 +350,8 @@ class Connection(ExportImport, object):
                                        "a transaction")
 
         if self._cache is not None:
-            self._cache.incrgc() # This is a good time to do some GC
+            # This is a good time to do some GC
+            self._cache_policy.gc(self._cache)
 
         # Call the close callbacks.
         if self.__onCloseCallbacks is not None:
@@ -307,9 +365,14 @@ class Connection(ExportImport, object):
 
         self._debug_info = ()
 
+        if self._activation_tracer is not None:
+            self._activation_tracer.log()
+
         if self.opened:
             self.transaction_manager.unregisterSynch(self)
 
+        self._inv_log.removeReader(self)
+
         if self._mvcc_storage:
             self._storage.sync(force=False)
 
@@ -350,16 +413,101 @@ class Connection(ExportImport, object):
             return
         self._inv_lock.acquire()
         try:
-            if self._txn_time is None:
-                self._txn_time = tid
-            elif (tid is not None) and (tid < self._txn_time):
-                raise AssertionError("invalidations out of order, %r < %r"
-                                     % (tid, self._txn_time))
+            self._read_invalidation_log()
+            self._invalidate(tid, oids)
+        finally:
+            self._inv_lock.release()
+
+    def _invalidate(self, tid, oids):
+        # Record an invalidation.  _inv_lock must be held.
+        if self.__txn_time is None:
+            self.__txn_time = tid
+        elif (tid is not None) and (tid < self.__txn_time):
+            raise AssertionError("invalidations out of order, %r < %r"
+                                 % (tid, self.__txn_time))
 
-            self._invalidated.update(oids)
+        self.__invalidated.update(oids)
+
+    def _read_invalidation_log(self):
+        """Merge invalidations published in the DB's log since we last looked.
+
+        _inv_lock must be held.
+        """
+        if self._inv_position == self._inv_log.position:
+            return # Nothing new (the common case), no need to lock the log.
+        position, entries = self._inv_log.since(self._inv_position)
+        self._inv_position = position
+        if self.before is not None:
+            return
+        if entries is None:
+            # We fell too far behind while idle and missed some
+            # invalidations.  (The log keeps what open connections
+            # haven't read.)  Treat the whole cache as invalid.
+            self._invalidatedCache = True
+            return
+        me = id(self)
+        for tid, oids, origin in entries:
+            if origin != me:
+                self._invalidate(tid, oids)
+
+    def _sync_invalidations(self):
+        # Bring _invalidated up to date with the DB's invalidation log.
+        if self._inv_position != self._inv_log.position:
+            self._inv_lock.acquire()
+            try:
+                self._read_invalidation_log()
+            finally:
+                self._inv_lock.release()
+
+    def _catch_up_invalidations(self):
+        """Apply logged invalidations while we're sitting in the pool.
+
+        This is called by the DB's invalidation dispatcher, with the
+        database lock held, so we can't be opened meanwhile.  It leaves
+        less work for _flush_invalidations() when we're next opened, and
+        keeps us from falling out of the invalidation log.
+        """
+        if self._mvcc_storage or self.before is not None:
+            return
+        cache = self._cache
+        ghostifiable = []
+        self._inv_lock.acquire()
+        try:
+            self._read_invalidation_log()
+            if self._invalidatedCache:
+                # Leave the whole-cache flush to open().
+                return
+            invalidated = self.__invalidated
+            self.__invalidated = set()
+            self.__txn_time = None
+
+            # Non-ghostifiable objects (persistent classes) reload their
+            # state when invalidated, which a closed connection can't do.
+            # Leave those for open().
+            for oid in invalidated:
+                obj = cache.get(oid)
+                if obj is None:
+                    continue
+                if isinstance(obj, type):
+                    self.__invalidated.add(oid)
+                else:
+                    ghostifiable.append(oid)
         finally:
             self._inv_lock.release()
 
+        cache.invalidate(ghostifiable)
+
+    @property
+    def _invalidated(self):
+        """The set of oids invalidated since the transaction started."""
+        self._sync_invalidations()
+        return self.__invalidated
+
+    @property
+    def _txn_time(self):
+        self._sync_invalidations()
+        return self.__txn_time
+
     def invalidateCache(self):
         self._inv_lock.acquire()
         try:
@@ -424,6 +572,86 @@ class Connection(ExportImport, object):
             self._store_count = 0
         return res
 
+    def getTransferStatistics(self, clear=False):
+        """Return storage traffic and cache statistics for this request.
+
+        See IConnection.
+        """
+        res = self._transfer.getStatistics()
+        if clear:
+            self._transfer = TransferStatistics()
+        return res
+
+    def getActivationReport(self, clear=False):
+        """Return where the objects loaded by this request were activated.
+
+        See IConnection.
+        """
+        tracer = self._activation_tracer
+        if tracer is None:
+            return None
+        res = tracer.getReport()
+        if clear:
+            self._activation_tracer = ActivationTracer()
+        return res
+
+    def _cacheClassCounts(self, sample, clear):
+        """Return {class name -> [objects, ghosts, bytes, activations, rate]}
+
+        Object, ghost and byte counts are estimated from at most `sample`
+        objects in the cache, evenly spread.  None means look at all of
+        them.
+        """
+        # The cache can't be iterated without a copy; a copy of its dict
+        # is the cheapest, and we just step through it.
+        data = self._cache.cache_data
+        n = len(data)
+        step = 1
+        if sample is not None and n > sample:
+            step = -(-n // sample)
+
+        counts = {}
+        seen = 0
+        for ob in itertools.islice(six.itervalues(data), 0, None, step):
+            seen += 1
+            name = class_name(ob.__class__)
+            c = counts.get(name)
+            if c is None:
+                c = counts[name] = [0, 0, 0, 0, 0.0]
+            c[0] += 1
+            if ob._p_changed is None:
+                c[1] += 1
+            else:
+                c[2] += ob._p_estimated_size
+        if seen:
+            scale = float(n) / seen
+            for c in counts.values():
+                c[0] *= scale
+                c[1] *= scale
+                c[2] *= scale
+
+        now = time.time()
+        elapsed = now - (self._activations_since or now)
+        for klass, activations in six.iteritems(self._activations):
+            name = class_name(klass)
+            c = counts.get(name)
+            if c is None:
+                c = counts[name] = [0, 0, 0, 0, 0.0]
+            c[3] += activations
+            if elapsed > 0:
+                c[4] += activations / elapsed
+        if clear:
+            self._activations = {}
+            self._activations_since = now
+        return counts
+
+    def cacheClassReport(self, sample=1000, clear=False):
+        """Report on the objects in the cache, by class
+
+        See IConnection.
+        """
+        return _cacheClassReport(self._cacheClassCounts(sample, clear))
+
     # Connection methods
     ##########################################################################
 
@@ -491,6 +719,13 @@ class Connection(ExportImport, object):
         self._needs_to_join = True
         self._registered_objects = []
         self._creating.clear()
+        self._commit_timing = None
+
+    def _commit_phase(self, name):
+        timing = self._commit_timing
+        if timing is None:
+            return nophase
+        return timing.phase(name)
 
     # Process pending invalidations.
     def _flush_invalidations(self):
@@ -500,9 +735,9 @@ class Connection(ExportImport, object):
             if invalidated is None:
                 # special value: the transaction is so old that
                 # we need to flush the whole cache.
-                self._cache.invalidate(list(self._cache.cache_data.keys()))
+                self._invalidate_cache(list(self._cache.cache_data.keys()))
             elif invalidated:
-                self._cache.invalidate(invalidated)
+                self._invalidate_cache(invalidated)
 
         self._inv_lock.acquire()
         try:
@@ -534,19 +769,36 @@ class Connection(ExportImport, object):
             # using a class while objects are being invalidated seems
             # small enough to be acceptable.
 
-            invalidated = dict.fromkeys(self._invalidated)
-            self._invalidated = set()
-            self._txn_time = None
+            self._read_invalidation_log()
+            invalidated = dict.fromkeys(self.__invalidated)
+            self.__invalidated = set()
+            self.__txn_time = None
             if self._invalidatedCache:
                 self._invalidatedCache = False
                 invalidated = self._cache.cache_data.copy()
         finally:
             self._inv_lock.release()
 
-        self._cache.invalidate(invalidated)
+        # Count first, as invalidate() empties dictionaries.
+        self._transfer.invalidations += len(invalidated)
+        self._invalidate_cache(invalidated)
 
         # Now is a good time to collect some garbage.
-        self._cache.incrgc()
+        self._cache_policy.gc(self._cache)
+
+    def _invalidate_cache(self, oids):
+        cache = self._cache
+        if cache.cache_klass_count:
+            found = oids
+            if not isinstance(found, (dict, set, frozenset)):
+                found = set(found) # A list of the whole cache, for one.
+            for oid, klass in cache.klass_items():
+                if oid in found:
+                    # The readers may have found it by name.
+                    self._db.clearClassCache()
+                    self._reader.clearClassCache()
+                    break
+        cache.invalidate(oids)
 
     def tpc_begin(self, transaction):
         """Begin commit of a transaction, starting the two-phase commit."""
@@ -555,30 +807,40 @@ class Connection(ExportImport, object):
         # _creating is a list of oids of new objects, which is used to
         # remove them from the cache if a transaction aborts.
         self._creating.clear()
-        self._normal_storage.tpc_begin(transaction)
+
+        statistics = self._db._commit_statistics
+        if statistics is not None:
+            self._commit_timing = statistics.begin()
+        with self._commit_phase('tpc_begin'):
+            self._normal_storage.tpc_begin(transaction)
 
     def commit(self, transaction):
         """Commit changes to an object"""
 
-        if self._savepoint_storage is not None:
+        with self._commit_phase('commit'):
+            try:
+                if self._savepoint_storage is not None:
 
-            # We first checkpoint the current changes to the savepoint
-            self.savepoint()
+                    # We first checkpoint the current changes to the savepoint
+                    self.savepoint()
 
-            # then commit all of the savepoint changes at once
-            self._commit_savepoint(transaction)
+                    # then commit all of the savepoint changes at once
+                    self._commit_savepoint(transaction)
 
-            # No need to call _commit since savepoint did.
+                    # No need to call _commit since savepoint did.
 
-        else:
-            self._commit(transaction)
-
-        for oid, serial in six.iteritems(self._readCurrent):
-            try:
-                self._storage.checkCurrentSerialInTransaction(
-                    oid, serial, transaction)
-            except ConflictError:
-                self._cache.invalidate(oid)
+                else:
+                    self._commit(transaction)
+
+                for oid, serial in six.iteritems(self._readCurrent):
+                    try:
+                        self._storage.checkCurrentSerialInTransaction(
+                            oid, serial, transaction)
+                    except ConflictError:
+                        self._cache.invalidate(oid)
+                        raise
+            except ConflictError as v:
+                self._conflicted(v)
                 raise
 
     def _commit(self, transaction):
@@ -602,9 +864,11 @@ class Connection(ExportImport, object):
 
         self._added_during_commit = []
 
+        invalidated = self._invalidated
         if self._invalidatedCache:
             raise ConflictError()
 
+        writer = ObjectWriter(jar=self, protocol=self._db.pickle_protocol)
         for obj in self._registered_objects:
             oid = obj._p_oid
             assert oid
@@ -616,7 +880,7 @@ class Connection(ExportImport, object):
             elif oid in self._added:
                 assert obj._p_serial == z64
             elif obj._p_changed:
-                if oid in self._invalidated:
+                if oid in invalidated:
                     resolve = getattr(obj, "_p_resolveConflict", None)
                     if resolve is None:
                         raise ConflictError(object=obj)
@@ -627,13 +891,16 @@ class Connection(ExportImport, object):
                 # changed and registered.
                 continue
 
-            self._store_objects(ObjectWriter(obj), transaction)
+            writer.push(obj)
+            self._store_objects(writer, transaction)
 
         for obj in self._added_during_commit:
-            self._store_objects(ObjectWriter(obj), transaction)
+            writer.push(obj)
+            self._store_objects(writer, transaction)
         self._added_during_commit = None
 
     def _store_objects(self, writer, transaction):
+        invalidated = self._invalidated
         for obj in writer:
             oid = obj._p_oid
             serial = getattr(obj, "_p_serial", z64)
@@ -657,12 +924,19 @@ class Connection(ExportImport, object):
                 self._creating[oid] = implicitly_adding
 
             else:
-                if (oid in self._invalidated
+                if (oid in invalidated
                     and not hasattr(obj, '_p_resolveConflict')):
                     raise ConflictError(object=obj)
                 self._modified.append(oid)
 
+            timing = self._commit_timing
+            if timing is not None:
+                start = timer()
             p = writer.serialize(obj)  # This calls __getstate__ of obj
+            if timing is not None:
+                stored = timer()
+                timing.add('serialize', stored - start)
+                timing.stored(obj)
             if len(p) >= self.large_record_size:
                 warnings.warn(large_object_message % (obj.__class__, len(p)))
 
@@ -688,7 +962,10 @@ class Connection(ExportImport, object):
             else:
                 s = self._storage.store(oid, serial, p, '', transaction)
 
+            if timing is not None:
+                timing.add('store', timer() - stored)
             self._store_count += 1
+            self._transfer.stored(len(p))
             # Put the object in the cache before handling the
             # response, just in case the response contains the
             # serial number for a newly created object
@@ -707,6 +984,20 @@ class Connection(ExportImport, object):
 
             self._handle_serial(oid, s)
 
+    def _conflicted(self, error):
+        """Count a conflict error raised by a load or commit."""
+        self._transfer.conflicts += 1
+        oid = getattr(error, 'oid', None)
+        class_name = getattr(error, 'class_name', None)
+        if class_name is None and oid is not None:
+            obj = self._cache.get(oid, None)
+            if obj is not None:
+                class_name = className(obj)
+        if isinstance(error, ReadConflictError):
+            self._db._conflict_tracker.read_conflict(oid, class_name)
+        else:
+            self._db._conflict_tracker.conflict(oid, class_name)
+
     def _handle_serial(self, oid, serial, change=True):
 
         # if we write an object, we don't want to check if it was read
@@ -721,6 +1012,7 @@ class Connection(ExportImport, object):
         if obj is None:
             return
         if serial == ResolvedSerial:
+            self._db._conflict_tracker.resolved(oid, className(obj))
             del obj._p_changed # transition from changed to ghost
         else:
             if change:
@@ -760,6 +1052,8 @@ class Connection(ExportImport, object):
                 obj._p_changed = False
             del obj._p_oid
             del obj._p_jar
+        if self._commit_timing is not None:
+            self._db._commit_statistics.aborted(self._commit_timing)
         self._tpc_cleanup()
 
     def _invalidate_creating(self, creating=None):
@@ -785,11 +1079,16 @@ class Connection(ExportImport, object):
         except AttributeError:
             return
         try:
-            s = vote(transaction)
+            with self._commit_phase('tpc_vote'):
+                s = vote(transaction)
         except ReadConflictError as v:
+            self._conflicted(v)
             if v.oid:
                 self._cache.invalidate(v.oid)
             raise
+        except ConflictError as v:
+            self._conflicted(v)
+            raise
 
         if s:
             for oid, serial in s:
@@ -804,13 +1103,24 @@ class Connection(ExportImport, object):
                 # storage provides MVCC.
                 return
             d = dict.fromkeys(self._modified)
-            self._db.invalidate(tid, d, self)
+            timing = self._commit_timing
+            if timing is None:
+                self._db.invalidate(tid, d, self)
+            else:
+                start = timer()
+                self._db.invalidate(tid, d, self)
+                timing.add('invalidation', timer() - start)
 #       It's important that the storage calls the passed function
 #       while it still has its lock.  We don't want another thread
 #       to be able to read any updated data until we've had a chance
 #       to send an invalidation message to all of the other
 #       connections!
-        self._storage.tpc_finish(transaction, callback)
+        with self._commit_phase('tpc_finish'):
+            self._storage.tpc_finish(transaction, callback)
+        self._transfer.commits += 1
+        if self._commit_timing is not None:
+            self._db._commit_statistics.finished(
+                self._commit_timing, transaction)
         self._tpc_cleanup()
 
     def sortKey(self):
@@ -867,15 +1177,27 @@ class Connection(ExportImport, object):
                 self._log.exception(msg)
                 raise
 
+        tracer = self._activation_tracer
+        if tracer is not None:
+            start = timer()
         try:
             self._setstate(obj)
-        except ConflictError:
+        except ConflictError as v:
+            self._conflicted(v)
             raise
         except:
             self._log.exception("Couldn't load state for %s %s",
                                 className(obj), oid_repr(oid))
             raise
 
+        if tracer is not None:
+            try:
+                tracer.activated(oid, className(obj), timer() - start)
+            except Exception:
+                # Tracing mustn't break loading.
+                self._log.exception("Couldn't trace the activation of %s %s",
+                                    className(obj), oid_repr(oid))
+
     def _setstate(self, obj):
         # Helper for setstate(), which provides logging of failures.
 
@@ -892,10 +1214,12 @@ class Connection(ExportImport, object):
         if self.before is not None:
             # Load data that was current before the time we have.
             before = self.before
+            start = timer()
             t = self._storage.loadBefore(obj._p_oid, before)
             if t is None:
                 raise POSKeyError() # historical connection!
             p, serial, end = t
+            self._transfer.loaded(timer() - start, len(p))
 
         else:
             # There is a harmless data race with self._invalidated.  A
@@ -905,27 +1229,42 @@ class Connection(ExportImport, object):
             if self._invalidatedCache:
                 raise ReadConflictError()
 
-            if (obj._p_oid in self._invalidated):
+            if (obj._p_oid in self.__invalidated):
                 self._load_before_or_conflict(obj)
                 return
 
+            start = timer()
             p, serial = self._storage.load(obj._p_oid, '')
+            self._transfer.loaded(timer() - start, len(p))
             self._load_count += 1
 
+            # Invalidations are logged by the DB before the storage
+            # releases its commit lock, so anything we just loaded that
+            # was already replaced shows up in the log by now.
             self._inv_lock.acquire()
             try:
-                invalid = obj._p_oid in self._invalidated
+                self._read_invalidation_log()
+                invalid = obj._p_oid in self.__invalidated
             finally:
                 self._inv_lock.release()
 
+            if self._invalidatedCache:
+                raise ReadConflictError()
+
             if invalid:
                 self._load_before_or_conflict(obj)
                 return
 
         self._reader.setGhostState(obj, p)
         obj._p_serial = serial
+        if self._activation_tracer is not None:
+            self._activation_tracer.loaded(obj._p_oid, className(obj), p)
         self._cache.update_object_size_estimation(obj._p_oid, len(p))
         obj._p_estimated_size = len(p)
+        self._cache_policy.miss(obj)
+        self._transfer.misses += 1
+        klass = obj.__class__
+        self._activations[klass] = self._activations.get(klass, 0) + 1
 
         # Blob support
         if isinstance(obj, Blob):
@@ -946,12 +1285,14 @@ class Connection(ExportImport, object):
         """
         try:
             # Load data that was current before the commit at txn_time.
+            started = timer()
             t = self._storage.loadBefore(obj._p_oid, self._txn_time)
         except KeyError:
             return False
         if t is None:
             return False
         data, start, end = t
+        self._transfer.loaded(timer() - started, len(data))
         # The non-current transaction must have been written before
         # txn_time.  It must be current at txn_time, but could have
         # been modified at txn_time.
@@ -961,6 +1302,12 @@ class Connection(ExportImport, object):
         assert self._txn_time <= end, (u64(self._txn_time), u64(end))
         self._reader.setGhostState(obj, data)
         obj._p_serial = start
+        if self._activation_tracer is not None:
+            self._activation_tracer.loaded(obj._p_oid, className(obj), data)
+        self._cache_policy.miss(obj)
+        self._transfer.misses += 1
+        klass = obj.__class__
+        self._activations[klass] = self._activations.get(klass, 0) + 1
 
         # MVCC Blob support
         if isinstance(obj, Blob):
@@ -1044,12 +1391,25 @@ class Connection(ExportImport, object):
         """
 
         self.opened = time.time()
+        if self._activations_since is None:
+            self._activations_since = self.opened
+        self._transfer = TransferStatistics()
+        rate = self._db._activation_sample_rate
+        if rate and random.random() < rate:
+            self._activation_tracer = ActivationTracer()
+        else:
+            self._activation_tracer = None
 
         if transaction_manager is None:
             transaction_manager = transaction.manager
 
         self.transaction_manager = transaction_manager
 
+        if self.before is None:
+            # Register before reading the log, so that nothing we haven't
+            # read is trimmed from it while we're open.
+            self._inv_log.addReader(self)
+
         if self._reset_counter != global_reset_counter:
             # New code is in place.  Start a new cache.
             self._resetCache()
@@ -1059,7 +1419,8 @@ class Connection(ExportImport, object):
         transaction_manager.registerSynch(self)
 
         if self._cache is not None:
-            self._cache.incrgc() # This is a good time to do some GC
+            # This is a good time to do some GC
+            self._cache_policy.gc(self._cache)
 
         if delegate:
             # delegate open to secondary connections
@@ -1073,11 +1434,17 @@ class Connection(ExportImport, object):
         See the docstring for the resetCaches() function.
         """
         self._reset_counter = global_reset_counter
-        self._invalidated.clear()
+        self._inv_lock.acquire()
+        try:
+            self._inv_position = self._inv_log.position
+            self.__invalidated.clear()
+        finally:
+            self._inv_lock.release()
         self._invalidatedCache = False
         cache_size = self._cache.cache_size
         cache_size_bytes = self._cache.cache_size_bytes
         self._cache = cache = PickleCache(self, cache_size, cache_size_bytes)
+        self._cache_policy.clear()
         if getattr(self, '_reader', None) is not None:
             self._reader._cache = cache
 
@@ -1087,6 +1454,7 @@ class Connection(ExportImport, object):
                 c._storage.release()
             c._storage = c._normal_storage = None
             c._cache = PickleCache(self, 0, 0)
+            c._cache_policy.clear()
 
     ##########################################################################
     # Python protocol
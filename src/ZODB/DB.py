@@ -13,17 +13,25 @@
 ##############################################################################
 """Database objects
 """
+import collections
 import sys
 import threading
 import logging
 import datetime
 import time
 import warnings
+import weakref
 
+from ZODB.ActivityMonitor import TransferStatistics, timer
 from ZODB.broken import find_global
-from ZODB.utils import z64
-from ZODB.Connection import Connection
-from ZODB._compat import Pickler, _protocol, BytesIO
+from ZODB.CacheBudget import CacheBudget
+from ZODB.ConflictTracker import ConflictTracker
+from ZODB.POSException import ConnectionPoolTimeoutError
+from ZODB.utils import z64, class_name
+from ZODB.Connection import Connection, _cacheClassReport
+from ZODB._compat import Pickler, _protocol, BytesIO, HIGHEST_PROTOCOL
+import ZODB.CachePolicy
+import ZODB.CommitStatistics
 import ZODB.serialize
 
 import transaction.weakset
@@ -104,11 +112,32 @@ class AbstractConnectionPool(object):
 
     size = property(getSize, lambda self, v: self.setSize(v))
 
+class PoolWaiter(object):
+    """A caller of DB.open() waiting for a connection to be returned."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        # Set by ConnectionPool.repush() when it hands us a connection.
+        self.connection = None
+
 class ConnectionPool(AbstractConnectionPool):
 
-    def __init__(self, size, timeout=1<<31):
+    def __init__(self, size, timeout=1<<31, limit=None, wait_timeout=None):
         super(ConnectionPool, self).__init__(size, timeout)
 
+        # An optional hard limit on the number of connections in use.
+        # When it's reached, DB.open() waits (up to wait_timeout seconds,
+        # or forever if that's None) for a connection to be returned.
+        self.limit = limit
+        self.wait_timeout = wait_timeout
+
+        # FIFO queue of PoolWaiters.  Returned connections are handed
+        # directly to the first waiter, so that later callers can't
+        # jump the queue.
+        self.waiters = collections.deque()
+        self.waits = self.wait_timeouts = 0
+        self.wait_time = 0.0
+
         # A stack of connections available to hand out.  This is a subset
         # of self.all.  push() and repush() add to this, and may remove
         # the oldest available connections if the pool is too large.
@@ -116,6 +145,14 @@ class ConnectionPool(AbstractConnectionPool):
         # in this stack.
         self.available = []
 
+        # Statistics about how well we reuse connections:
+        # opened: connections handed out by pop()
+        # created: new connections registered via push()
+        # affinity_hits/affinity_misses: pops asking for an affinity key
+        #   that did/didn't get a connection last used with the same key
+        self.opened = self.created = 0
+        self.affinity_hits = self.affinity_misses = 0
+
     def _append(self, c):
         available = self.available
         cactive = c._cache.cache_non_ghost_count
@@ -142,6 +179,7 @@ class ConnectionPool(AbstractConnectionPool):
         self._reduce_size(strictly_less=True)
         self.all.add(c)
         self._append(c)
+        self.created += 1
         n = len(self.all)
         limit = self.size
         if n > limit:
@@ -159,9 +197,29 @@ class ConnectionPool(AbstractConnectionPool):
         """
         assert c in self.all
         assert c not in self.available
+        if self.waiters:
+            waiter = self.waiters.popleft()
+            waiter.connection = c
+            waiter.event.set()
+            return
         self._reduce_size(strictly_less=True)
         self._append(c)
 
+    def mustWait(self):
+        """Return whether a caller has to wait for a connection.
+
+        That's the case if the pool has a hard limit that has been reached,
+        or if others are already waiting.
+        """
+        if self.limit is None:
+            return False
+        return bool(self.waiters) or not self.hasCapacity()
+
+    def hasCapacity(self):
+        """Return whether a connection can be handed out without waiting."""
+        return (self.limit is None or bool(self.available) or
+                len(self.all) < self.limit)
+
     def _reduce_size(self, strictly_less=False):
         """Throw away the oldest available connections until we're under our
         target size (strictly_less=False, the default) or no more than that
@@ -185,21 +243,91 @@ class ConnectionPool(AbstractConnectionPool):
     def reduce_size(self):
         self._reduce_size()
 
-    def pop(self):
+    def pop(self, affinity=None):
         """Pop an available connection and return it.
 
         Return None if none are available - in this case, the caller should
         create a new connection, register it via push(), and call pop() again.
         The caller is responsible for serializing this sequence.
+
+        If an affinity key is given, prefer the most recently used
+        connection that was last opened with the same key, since its cache
+        is likely to hold the objects the caller needs.  Otherwise, the
+        top of the stack is returned as usual.
         """
         result = None
-        if self.available:
-            _, result = self.available.pop()
+        available = self.available
+        if available:
+            i = len(available) - 1
+            if affinity is not None:
+                while i >= 0 and available[i][1]._affinity != affinity:
+                    i -= 1
+                if i < 0:
+                    i = len(available) - 1
+                    self.affinity_misses += 1
+                else:
+                    self.affinity_hits += 1
+            _, result = available.pop(i)
+            self.opened += 1
             # Leave it in self.all, so we can still get at it for statistics
             # while it's alive.
             assert result in self.all
         return result
 
+    def withdraw(self, c):
+        """Take an available connection out of the stack for a while.
+
+        pop() doesn't hand it out until it's put back by restore().
+        Return its position, to pass to restore(), or None if it isn't
+        available.
+        """
+        available = self.available
+        for i, (t, ac) in enumerate(available):
+            if ac is c:
+                del available[i]
+                return i, t
+        return None
+
+    def restore(self, c, position):
+        """Put back a connection taken out of the stack by withdraw().
+
+        Like a connection that's closed, it's handed to the first caller
+        waiting for one, if any.
+        """
+        if c._storage is None or c not in self.all:
+            return # released meanwhile
+        if self.waiters:
+            waiter = self.waiters.popleft()
+            waiter.connection = c
+            waiter.event.set()
+            return
+        i, t = position
+        self.available.insert(min(i, len(self.available)), (t, c))
+        self._reduce_size()
+
+    def getStatistics(self):
+        """Return a dictionary of statistics about the pool.
+
+        The number of connections that had to be created versus the
+        number handed out shows how well connections are reused, and the
+        affinity hits and misses how well requests with an affinity key
+        get a connection that was warmed up with the same key.
+        """
+        return dict(
+            size=self.size,
+            limit=self.limit,
+            all=len(self.all),
+            available=len(self.available),
+            opened=self.opened,
+            created=self.created,
+            affinity_hits=self.affinity_hits,
+            affinity_misses=self.affinity_misses,
+            waiting=len(self.waiters),
+            waits=self.waits,
+            wait_time=self.wait_time,
+            wait_timeouts=self.wait_timeouts,
+            )
+
     def map(self, f):
         """For every live connection c, invoke f(c)."""
         self.all.map(f)
@@ -264,10 +392,10 @@ class KeyedConnectionPool(AbstractConnectionPool):
     def reduce_size(self):
         self._reduce_size()
 
-    def pop(self, key):
+    def pop(self, key, affinity=None):
         pool = self.pools.get(key)
         if pool is not None:
-            return pool.pop()
+            return pool.pop(affinity)
 
     def map(self, f):
         for pool in six.itervalues(self.pools):
@@ -294,6 +422,169 @@ class KeyedConnectionPool(AbstractConnectionPool):
         return tuple(result)
 
 
+class InvalidationLog(object):
+    """Shared, append-only log of committed invalidations.
+
+    Rather than pushing invalidations into every connection on each
+    commit, the database appends a single (tid, oids, origin) entry here.
+    Each connection remembers the log position it has read up to and
+    replays newer entries when it needs them (see
+    Connection._read_invalidation_log).  Publishing a commit is thus
+    independent of the number of connections.
+
+    Only the most recent `size` entries are guaranteed to be retained,
+    plus any that open connections (registered with addReader) haven't
+    read yet, up to `max_reader_lag` times `size` entries, so that open
+    connections left unused can't make the log grow without bound.  A
+    connection that falls further behind than that can no longer tell
+    which objects changed, and must invalidate its whole cache.
+    """
+
+    max_reader_lag = 10
+
+    def __init__(self, size=10000):
+        self._size = size
+        self._lock = threading.Lock()
+        # Position of entries[0] and position of the next entry.
+        self.first = 0
+        self.position = 0
+        self.entries = []
+        self._trim_at = 2 * size
+        # Open connections, by id, whose unread entries must be kept.
+        self._readers = weakref.WeakValueDictionary()
+
+    def getSize(self):
+        return self._size
+
+    def setSize(self, size):
+        self._lock.acquire()
+        try:
+            self._size = size
+            self._trim()
+        finally:
+            self._lock.release()
+
+    size = property(getSize, setSize)
+
+    def addReader(self, connection):
+        """Keep the entries `connection` hasn't read yet while it's open.
+
+        The connection's `_inv_position` is the position it has read up to.
+        """
+        self._lock.acquire()
+        try:
+            self._readers[id(connection)] = connection
+        finally:
+            self._lock.release()
+
+    def removeReader(self, connection):
+        self._lock.acquire()
+        try:
+            self._readers.pop(id(connection), None)
+        finally:
+            self._lock.release()
+
+    def append(self, tid, oids, origin=None):
+        """Record that transaction `tid` invalidated `oids`.
+
+        `origin` is the connection that committed the transaction, if any.
+        It doesn't need to be told about its own changes.  Only its id is
+        kept, so that the log doesn't keep connections alive.  An id can
+        be reused once its connection is gone, but only by a connection
+        that starts reading the log after this entry.
+        """
+        if origin is not None:
+            origin = id(origin)
+        self._lock.acquire()
+        try:
+            self.entries.append((tid, oids, origin))
+            self.position += 1
+            # Trim in chunks so that appending stays amortized O(1).
+            if len(self.entries) >= self._trim_at:
+                self._trim()
+        finally:
+            self._lock.release()
+
+    def _trim(self):
+        keep = self.position - self._size
+        oldest = self.position - self._size * self.max_reader_lag
+        for reader in list(self._readers.values()):
+            # Positions only grow, so a stale read just keeps more.
+            position = reader._inv_position
+            if position >= oldest:
+                keep = min(keep, position)
+        extra = keep - self.first
+        if extra > 0:
+            del self.entries[:extra]
+            self.first += extra
+        self._trim_at = len(self.entries) + max(self._size, 1)
+
+    def since(self, position):
+        """Return (position, entries) for entries after `position`.
+
+        The returned position is the one to pass on the next call.  If
+        entries after `position` have already been discarded, entries is
+        None and the caller must treat everything as invalid.
+        """
+        self._lock.acquire()
+        try:
+            if position < self.first:
+                return self.position, None
+            return self.position, self.entries[position - self.first:]
+        finally:
+            self._lock.release()
+
+
+class InvalidationDispatcher(object):
+    """Apply logged invalidations to idle connections in the background.
+
+    Publishing an invalidation (appending it to the InvalidationLog) has to
+    happen while the storage still holds its commit lock, so that no other
+    thread can read the new data before it has been told the old data is
+    stale.  That part is cheap.  What's left is applying the invalidations
+    to connection caches, which otherwise happens when a pooled connection
+    is next handed out by DB.open(), in the requesting thread, and which
+    turns into a whole-cache flush if the connection has fallen out of the
+    log.
+
+    The dispatcher does that work for the connections sitting unused in
+    the pool, in a daemon thread that is woken after each commit.  Entries
+    are applied in log order, so ordering is preserved, and connections
+    in use keep reading the log themselves.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._event = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name='ZODB invalidation dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def notify(self):
+        """Let the dispatcher know that there are new log entries."""
+        self._event.set()
+
+    def _run(self):
+        event = self._event
+        while True:
+            event.wait()
+            event.clear()
+            if self._stopped:
+                break
+            try:
+                self._db._catchUpAvailableConnections()
+            except Exception:
+                logger.exception("Applying invalidations to idle connections")
+
+    def close(self):
+        self._stopped = True
+        self._event.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join(10)
+
+
 def toTimeStamp(dt):
     utc_struct = dt.utctimetuple()
     # if this is a leapsecond, this will probably fail.  That may be a good
@@ -330,9 +621,11 @@ class DB(object):
     The DB instance manages a pool of connections.  If a connection is
     closed, it is returned to the pool and its object cache is
     preserved.  A subsequent call to open() will reuse the connection.
-    There is no hard limit on the pool size.  If more than `pool_size`
-    connections are opened, a warning is logged, and if more than twice
-    that many, a critical problem is logged.
+    By default, there is no hard limit on the pool size.  If more than
+    `pool_size` connections are opened, a warning is logged, and if more
+    than twice that many, a critical problem is logged.  If `pool_limit`
+    is given, open() waits for a connection to be closed rather than
+    opening more than that many connections.
 
     The class variable 'klass' is used by open() to create database
     connections.  It is set to Connection, but a subclass could override
@@ -353,21 +646,33 @@ class DB(object):
         setPoolSize, setHistoricalPoolSize, getHistoricalTimeout,
         setHistoricalTimeout
       - `Transaction Methods`: invalidate
-      - `Other Methods`: lastTransaction, connectionDebugInfo
+      - `Other Methods`: lastTransaction, connectionDebugInfo,
+        getCommitStatistics, getTransferStatistics, getPackStatus,
+        getMetrics, getConflictReport, getConflictWindow,
+        setConflictWindow
       - `Cache Inspection Methods`: cacheDetail, cacheExtremeDetail,
         cacheFullSweep, cacheLastGCTime, cacheMinimize, cacheSize,
-        cacheDetailSize, getCacheSize, getHistoricalCacheSize, setCacheSize,
-        setHistoricalCacheSize
+        cacheDetailSize, cacheClassReport, getCacheSize,
+        getHistoricalCacheSize, setCacheSize, setHistoricalCacheSize,
+        getCacheBudgetBytes, setCacheBudgetBytes, getCacheBudgetStatistics,
+        getCachePolicy, getCachePolicyStatistics
     """
 
     klass = Connection  # Class to use for connections
     _activity_monitor = next = previous = None
+    _invalidation_dispatcher = _cache_budget = _commit_statistics = None
+    _pack_started = _last_pack = None
 
     def __init__(self, storage,
                  pool_size=7,
                  pool_timeout=1<<31,
+                 pool_limit=None,
+                 pool_wait_timeout=None,
                  cache_size=400,
                  cache_size_bytes=0,
+                 cache_budget_bytes=0,
+                 cache_budget_interval=5,
+                 cache_policy='lru',
                  historical_pool_size=3,
                  historical_cache_size=1000,
                  historical_cache_size_bytes=0,
@@ -376,16 +681,40 @@ class DB(object):
                  databases=None,
                  xrefs=True,
                  large_record_size=1<<24,
+                 invalidation_log_size=10000,
+                 invalidation_dispatcher=False,
+                 commit_timing=False,
+                 slow_commit_threshold=None,
+                 conflict_window=3600,
+                 activation_sample_rate=0,
+                 pickle_protocol=None,
                  **storage_args):
         """Create an object database.
 
         :Parameters:
           - `storage`: the storage used by the database, e.g. FileStorage
           - `pool_size`: expected maximum number of open connections
+          - `pool_limit`: optional hard limit on the number of open
+            connections, at least `pool_size`.  When it's reached,
+            open() waits for a connection to be closed.
+          - `pool_wait_timeout`: the maximum number of seconds open()
+            waits when `pool_limit` is reached, before raising
+            ConnectionPoolTimeoutError.  None means wait forever.
           - `cache_size`: target size of Connection object cache
           - `cache_size_bytes`: target size measured in total estimated size
                of objects in the Connection object cache.
                "0" means unlimited.
+          - `cache_budget_bytes`: target for the total estimated size of
+               objects in the caches of all of the database's
+               connections, enforced in the background by shrinking the
+               least recently used caches first.  "0" means unlimited.
+          - `cache_budget_interval`: number of seconds between checks of
+               the cache budget.  "0" means the budget is only enforced
+               when its trim() method is called.
+          - `cache_policy`: how connection caches choose the objects to
+               evict: 'lru' (the default), '2q' (scan resistant) or 'lfu'
+               (frequency and size aware), or a factory returning a
+               policy.  See ZODB.CachePolicy.
           - `historical_pool_size`: expected maximum number of total
             historical connections
           - `historical_cache_size`: target size of Connection object cache for
@@ -396,7 +725,31 @@ class DB(object):
             an unused historical connection will be kept, or None.
           - `xrefs` - Boolian flag indicating whether implicit cross-database
             references are allowed
+          - `invalidation_log_size`: number of committed transactions
+            remembered for connections to catch up on.  A pooled
+            connection that falls further behind has its whole cache
+            invalidated when it's next opened, as does an open one
+            that falls ten times further behind.
+          - `commit_timing`: Boolean flag indicating whether to time the
+            phases of two-phase commit.  See getCommitStatistics().
+          - `slow_commit_threshold`: if set, commits taking at least this
+            many seconds are logged with their phase times and the
+            number of objects stored by class.  Implies `commit_timing`.
+          - `conflict_window`: number of seconds over which conflicts are
+            counted by object and class.  See getConflictReport().
+          - `activation_sample_rate`: the fraction, from 0 to 1, of the
+            connections opened that trace where the objects they load
+            are activated.  See Connection.getActivationReport().
+          - `pickle_protocol`: the pickle protocol of the records written,
+            from the default to the highest supported.  Records written
+            with any protocol can be read.  The default is 3 on Python 3
+            and 1 on Python 2.  Lower protocols can't be used on Python 3
+            since they don't pickle bytes, such as oids, as such.
         """
+        if pool_limit is not None and pool_limit < pool_size:
+            raise ValueError("The pool limit, %s, is less than the pool "
+                             "size, %s" % (pool_limit, pool_size))
+
         if isinstance(storage, six.string_types):
             from ZODB import FileStorage
             storage = ZODB.FileStorage.FileStorage(storage, **storage_args)
@@ -410,13 +763,37 @@ class DB(object):
         self._r = x.release
 
         # pools and cache sizes
-        self.pool = ConnectionPool(pool_size, pool_timeout)
+        self.pool = ConnectionPool(pool_size, pool_timeout,
+                                   pool_limit, pool_wait_timeout)
         self.historical_pool = KeyedConnectionPool(historical_pool_size,
                                                    historical_timeout)
         self._cache_size = cache_size
         self._cache_size_bytes = cache_size_bytes
         self._historical_cache_size = historical_cache_size
         self._historical_cache_size_bytes = historical_cache_size_bytes
+        self._cache_policy = ZODB.CachePolicy.getPolicyFactory(cache_policy)
+        if commit_timing or slow_commit_threshold is not None:
+            self._commit_statistics = ZODB.CommitStatistics.CommitStatistics(
+                slow_commit_threshold)
+
+        # Transfer statistics of connections, added when they're closed
+        self._transfer = TransferStatistics()
+        self._conflict_tracker = ConflictTracker(conflict_window)
+        self._activation_sample_rate = activation_sample_rate
+
+        if pickle_protocol is None:
+            pickle_protocol = _protocol
+        elif not _protocol <= pickle_protocol <= HIGHEST_PROTOCOL:
+            raise ValueError("Pickle protocols from %s to %s are supported"
+                             % (_protocol, HIGHEST_PROTOCOL))
+        self.pickle_protocol = pickle_protocol
+
+        # Globals found by classFactory, see _classCache()
+        self._classes = {}
+
+        # Invalidations are published through a shared log that the
+        # connections read from.
+        self._invalidation_log = InvalidationLog(invalidation_log_size)
 
         # Setup storage
         self.storage = storage
@@ -448,7 +825,7 @@ class DB(object):
                 # Manually create a pickle for the root to put in the storage.
                 # The pickle must be in the special ZODB format.
                 file = BytesIO()
-                p = Pickler(file, _protocol)
+                p = Pickler(file, self.pickle_protocol)
                 p.dump((root.__class__, None))
                 p.dump(root.__getstate__())
                 t = transaction.Transaction()
@@ -474,6 +851,13 @@ class DB(object):
 
         self.large_record_size = large_record_size
 
+        if invalidation_dispatcher:
+            self._invalidation_dispatcher = InvalidationDispatcher(self)
+
+        self._cache_budget_interval = cache_budget_interval
+        if cache_budget_bytes:
+            self._cache_budget = self._newCacheBudget(cache_budget_bytes)
+
     @property
     def _storage(self):      # Backward compatibility
         return self.storage
@@ -489,6 +873,7 @@ class DB(object):
         try:
             assert connection._db is self
             connection.opened = None
+            self._transfer.update(connection._transfer)
 
             if connection.before:
                 self.historical_pool.repush(connection, connection.before)
@@ -516,9 +901,7 @@ class DB(object):
         detail = {}
         def f(con, detail=detail):
             for oid, ob in con._cache.items():
-                module = getattr(ob.__class__, '__module__', '')
-                module = module and '%s.' % module or ''
-                c = "%s%s" % (module, ob.__class__.__name__)
+                c = class_name(ob.__class__)
                 if c in detail:
                     detail[c] += 1
                 else:
@@ -527,6 +910,26 @@ class DB(object):
         self._connectionMap(f)
         return sorted(detail.items())
 
+    def cacheClassReport(self, sample=1000, clear=False):
+        """Report on the objects in all of the caches, by class
+
+        This is much cheaper than cacheExtremeDetail, as counts are
+        estimated from a sample of at most `sample` objects per
+        connection.  See IConnection.cacheClassReport.
+        """
+        counts = {}
+        def f(con):
+            for name, c in six.iteritems(con._cacheClassCounts(sample, clear)):
+                total = counts.get(name)
+                if total is None:
+                    counts[name] = c
+                else:
+                    for i, v in enumerate(c):
+                        total[i] += v
+
+        self._connectionMap(f)
+        return _cacheClassReport(counts)
+
     def cacheExtremeDetail(self):
         detail = []
         conn_no = [0]  # A mutable reference to a counter
@@ -597,7 +1000,12 @@ class DB(object):
         def f(con, m=m):
             m.append({'connection': repr(con),
                       'ngsize': con._cache.cache_non_ghost_count,
-                      'size': len(con._cache)})
+                      'size': len(con._cache),
+                      'estimated_size': con._cache.total_estimated_size,
+                      'cache_size_bytes': con._cache.cache_size_bytes,
+                      'opened': con.opened is not None,
+                      'policy': con._cache_policy.getStatistics(),
+                      })
         self._connectionMap(f)
         # Py3: Simulate Python 2 m.sort() functionality.
         return sorted(
@@ -619,6 +1027,12 @@ class DB(object):
         noop = lambda *a: None
         self.close = noop
 
+        if self._invalidation_dispatcher is not None:
+            self._invalidation_dispatcher.close()
+
+        if self._cache_budget is not None:
+            self._cache_budget.close()
+
         @self._connectionMap
         def _(c):
             c.transaction_manager.abort()
@@ -634,6 +1048,145 @@ class DB(object):
     def getCacheSizeBytes(self):
         return self._cache_size_bytes
 
+    def getCachePolicy(self):
+        return getattr(self._cache_policy, 'name', self._cache_policy)
+
+    def getCachePolicyStatistics(self):
+        """Return hit, miss and eviction counts, summed by cache policy.
+        """
+        result = {}
+        def f(con):
+            stats = con._cache_policy.getStatistics()
+            totals = result.setdefault(stats['policy'], dict(
+                connections=0, hits=0, misses=0, evictions=0))
+            totals['connections'] += 1
+            for name in ('hits', 'misses', 'evictions'):
+                totals[name] += stats[name]
+        self._connectionMap(f)
+        return result
+
+    def getCacheBudgetBytes(self):
+        if self._cache_budget is None:
+            return 0
+        return self._cache_budget.size_bytes
+
+    def getCacheBudgetStatistics(self):
+        if self._cache_budget is None:
+            return None
+        return self._cache_budget.getStatistics()
+
+    def getTransferStatistics(self):
+        """Return the summed transfer statistics of all connections.
+
+        The counts are totals since the database was opened.
+        """
+        total = TransferStatistics()
+        def f(con):
+            if con.opened is not None:
+                total.update(con._transfer)
+        self._a()
+        try:
+            total.update(self._transfer)
+            self._connectionMap(f)
+        finally:
+            self._r()
+        return total.getStatistics()
+
+    def getConflictReport(self, top=10):
+        """Return conflict counts for the conflict window.
+
+        Write conflicts, conflicts resolved by the storage and read
+        conflicts are counted, in total, by class and for the `top`
+        most contended objects.  See ZODB.ConflictTracker.
+        """
+        return self._conflict_tracker.getReport(top)
+
+    def getConflictWindow(self):
+        return self._conflict_tracker.getWindow()
+
+    def setConflictWindow(self, window):
+        self._conflict_tracker.setWindow(window)
+
+    def getActivationSampleRate(self):
+        return self._activation_sample_rate
+
+    def setActivationSampleRate(self, rate):
+        """Set the fraction of the connections opened that trace activations
+        """
+        self._activation_sample_rate = rate
+
+    def getPackStatus(self):
+        """Return whether a pack is running and how the last one went.
+
+        Only packs started with pack() are seen.  Times are in seconds
+        since the epoch.
+        """
+        result = dict(running=self._pack_started is not None,
+                      started=self._pack_started,
+                      last_started=None,
+                      last_duration=None,
+                      last_succeeded=None)
+        if self._last_pack is not None:
+            (result['last_started'], result['last_duration'],
+             result['last_succeeded']) = self._last_pack
+        return result
+
+    def getMetrics(self):
+        """Return a snapshot of the database's metrics.
+
+        This gathers pool, cache, transfer, commit, storage and pack
+        statistics in a single pass over the connections.  See
+        ZODB.metrics for rendering them in the OpenMetrics format.
+        """
+        transfer = TransferStatistics()
+        connections = dict(connections=0, open_connections=0,
+                           historical_connections=0,
+                           open_historical_connections=0)
+        caches = dict(objects=0, non_ghosts=0, estimated_bytes=0)
+        def f(con):
+            if con.before is None:
+                kind = 'connections'
+            else:
+                kind = 'historical_connections'
+            connections[kind] += 1
+            if con.opened is not None:
+                connections['open_' + kind] += 1
+                transfer.update(con._transfer)
+            cache = con._cache
+            caches['objects'] += len(cache)
+            caches['non_ghosts'] += cache.cache_non_ghost_count
+            caches['estimated_bytes'] += cache.total_estimated_size
+        self._a()
+        try:
+            transfer.update(self._transfer)
+            self._connectionMap(f)
+            pool = self.pool.getStatistics()
+        finally:
+            self._r()
+
+        result = dict(
+            database_name=self.database_name,
+            pool=pool,
+            caches=caches,
+            cache_size=self._cache_size,
+            cache_size_bytes=self._cache_size_bytes,
+            transfer=transfer.getStatistics(),
+            commits=self.getCommitStatistics(),
+            storage_size=self.getSize(),
+            pack=self.getPackStatus(),
+            )
+        result.update(connections)
+        return result
+
+    def getCommitStatistics(self):
+        """Return commit counts and the distributions of phase times.
+
+        None is returned if commits aren't timed.
+        """
+        if self._commit_statistics is None:
+            return None
+        return self._commit_statistics.getStatistics()
+
     def lastTransaction(self):
         return self.storage.lastTransaction()
 
@@ -643,6 +1196,9 @@ class DB(object):
     def getPoolSize(self):
         return self.pool.size
 
+    def getPoolStatistics(self):
+        return self.pool.getStatistics()
+
     def getSize(self):
         return self.storage.getSize()
 
@@ -658,6 +1214,9 @@ class DB(object):
     def getHistoricalTimeout(self):
         return self.historical_pool.timeout
 
+    def getInvalidationLogSize(self):
+        return self._invalidation_log.size
+
     def invalidate(self, tid, oids, connection=None, version=''):
         """Invalidate references to a given oid.
 
@@ -668,23 +1227,45 @@ class DB(object):
         """
         # Storages, esp. ZEO tests, need the version argument still. :-/
         assert version==''
-        # Notify connections.
-        def inval(c):
-            if c is not connection:
-                c.invalidate(tid, oids)
-        self._connectionMap(inval)
+        # Connections pick this up from the log the next time they look.
+        self._invalidation_log.append(tid, oids, connection)
+        if self._invalidation_dispatcher is not None:
+            self._invalidation_dispatcher.notify()
+
+    def _catchUpAvailableConnections(self):
+        """Apply logged invalidations to the connections in the pool.
+
+        This is called by the invalidation dispatcher.  We take the
+        database lock for each connection in turn, so that it can't be
+        handed out by open() while we work on it.
+        """
+        self._a()
+        try:
+            available = [c for (t, c) in self.pool.available]
+        finally:
+            self._r()
+
+        for c in available:
+            self._a()
+            try:
+                if c.opened is None and c._cache is not None:
+                    c._catch_up_invalidations()
+            finally:
+                self._r()
 
     def invalidateCache(self):
         """Invalidate each of the connection caches
         """
         self._connectionMap(lambda c: c.invalidateCache())
+        self.clearClassCache()
 
     transform_record_data = untransform_record_data = lambda self, data: data
 
     def objectCount(self):
         return len(self.storage)
 
-    def open(self, transaction_manager=None, at=None, before=None):
+    def open(self, transaction_manager=None, at=None, before=None,
+             affinity=None):
         """Return a database Connection for use by application code.
 
         Note that the connection pool is managed as a stack, to
@@ -701,6 +1282,11 @@ class DB(object):
             A timezone-naive datetime.datetime is treated as a UTC value.
           - `before`: like `at`, but opens the readonly state before the
             tid or datetime.
+          - `affinity`: an optional hashable key describing the kind of
+            work the connection will be used for, e.g. a thread id, a URL
+            prefix or a tenant name.  The pool prefers to return a
+            connection that was last opened with the same key, as its
+            cache is likely to already hold the objects needed.
         """
         # `at` is normalized to `before`, since we use storage.loadBefore
         # as the underlying implementation of both.
@@ -724,7 +1310,7 @@ class DB(object):
         try:
             # result <- a connection
             if before is not None:
-                result = self.historical_pool.pop(before)
+                result = self.historical_pool.pop(before, affinity)
                 if result is None:
                     c = self.klass(self,
                                    self._historical_cache_size,
@@ -732,9 +1318,13 @@ class DB(object):
                                    self._historical_cache_size_bytes,
                                    )
                     self.historical_pool.push(c, before)
-                    result = self.historical_pool.pop(before)
+                    result = self.historical_pool.pop(before, affinity)
             else:
-                result = self.pool.pop()
+                result = None
+                if self.pool.mustWait():
+                    result = self._waitForConnection()
+                if result is None:
+                    result = self.pool.pop(affinity)
                 if result is None:
                     c = self.klass(self,
                                    self._cache_size,
@@ -742,8 +1332,9 @@ class DB(object):
                                    self._cache_size_bytes,
                                    )
                     self.pool.push(c)
-                    result = self.pool.pop()
+                    result = self.pool.pop(affinity)
             assert result is not None
+            result._affinity = affinity
 
             # open the connection.
             result.open(transaction_manager)
@@ -758,6 +1349,55 @@ class DB(object):
         finally:
             self._r()
 
+    def _waitForConnection(self):
+        """Wait for a connection to be returned to the pool.
+
+        This is called by open(), with the database lock held, when the
+        pool's hard limit has been reached.  The lock is released while
+        waiting.  Return the connection handed to us by the pool, or None
+        if we can now pop or create one ourselves.
+        """
+        pool = self.pool
+        waiter = PoolWaiter()
+        pool.waiters.append(waiter)
+        start = time.time()
+        timeout = pool.wait_timeout
+        try:
+            while waiter.connection is None:
+                # Connections that are garbage collected without being
+                # closed free up capacity without being returned.
+                if pool.waiters[0] is waiter and pool.hasCapacity():
+                    break
+                if timeout is None:
+                    wait = 1.0
+                else:
+                    wait = min(start + timeout - time.time(), 1.0)
+                    if wait <= 0:
+                        pool.wait_timeouts += 1
+                        raise ConnectionPoolTimeoutError(
+                            "No connection available after %s seconds "
+                            "(%s connections in use)" %
+                            (timeout, len(pool.all)))
+                self._r()
+                try:
+                    waiter.event.wait(wait)
+                    waiter.event.clear()
+                finally:
+                    self._a()
+        finally:
+            if waiter in pool.waiters:
+                pool.waiters.remove(waiter)
+                if pool.waiters and pool.hasCapacity():
+                    # Let the next in line check for itself.
+                    pool.waiters[0].event.set()
+            pool.waits += 1
+            pool.wait_time += time.time() - start
+
+        result = waiter.connection
+        if result is not None:
+            pool.opened += 1
+        return result
+
     def connectionDebugInfo(self):
         result = []
         t = time.time()
@@ -780,6 +1420,7 @@ class DB(object):
                     t-o)),
                 'info': d,
                 'before': c.before,
+                'transfer': c.getTransferStatistics(),
                 })
 
         self._connectionMap(get_info)
@@ -806,11 +1447,18 @@ class DB(object):
         if t is None:
             t = time.time()
         t -= days * 86400
+        self._pack_started = started = time.time()
+        start = timer()
         try:
             self.storage.pack(t, self.references)
         except:
             logger.exception("packing")
+            self._last_pack = started, timer() - start, False
             raise
+        else:
+            self._last_pack = started, timer() - start, True
+        finally:
+            self._pack_started = None
 
     def setActivityMonitor(self, am):
         self._activity_monitor = am
@@ -819,6 +1467,26 @@ class DB(object):
         # Zope will rebind this method to arbitrary user code at runtime.
         return find_global(modulename, globalname)
 
+    def _classCache(self):
+        """Return the cache of globals shared by new connections' readers
+
+        Only the globals found by DB.classFactory are shared.  None is
+        returned if classFactory is overridden or rebound, since what it
+        finds could depend on the connection it's passed, and each
+        connection's reader then keeps its own cache.
+        """
+        factory = getattr(self.classFactory, '__func__', None)
+        if factory is not DB.__dict__['classFactory']:
+            return None
+        return self._classes
+
+    def clearClassCache(self):
+        """Forget the globals found by classFactory
+
+        This is done when persistent classes are invalidated.
+        """
+        self._classes.clear()
+
     def setCacheSize(self, size):
         self._a()
         try:
@@ -839,6 +1507,29 @@ class DB(object):
         finally:
             self._r()
 
+    def _newCacheBudget(self, size):
+        interval = self._cache_budget_interval
+        return CacheBudget(self, size, interval or None, start=bool(interval))
+
+    def setCacheBudgetBytes(self, size):
+        self._a()
+        try:
+            budget = self._cache_budget
+            if budget is not None and not size:
+                self._cache_budget = None
+            elif budget is None and size:
+                self._cache_budget = self._newCacheBudget(size)
+            elif budget is not None:
+                budget.size_bytes = size
+        finally:
+            self._r()
+        if budget is not None and not size:
+            budget.close()
+            # Restore the connections' own targets.
+            self.setCacheSizeBytes(self._cache_size_bytes)
+            self.setHistoricalCacheSizeBytes(
+                self._historical_cache_size_bytes)
+
     def setHistoricalCacheSize(self, size):
         self._a()
         try:
@@ -860,6 +1551,10 @@ class DB(object):
             self._r()
 
     def setPoolSize(self, size):
+        limit = self.pool.limit
+        if limit is not None and limit < size:
+            raise ValueError("The pool size, %s, is more than the pool "
+                             "limit, %s" % (size, limit))
         self._a()
         try:
             self.pool.size = size
@@ -873,6 +1568,9 @@ class DB(object):
         finally:
             self._r()
 
+    def setInvalidationLogSize(self, size):
+        self._invalidation_log.size = size
+
     def setHistoricalTimeout(self, timeout):
         self._a()
         try:
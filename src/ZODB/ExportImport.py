@@ -13,63 +13,107 @@
 ##############################################################################
 """Support for database export and import."""
 
+import collections
+import gzip
 import logging
 import os
 import sys
 from tempfile import TemporaryFile
 
 import six
+from BTrees.LLBTree import LLBTree
 
 from ZODB.blob import Blob
+from ZODB.fsIndex import fsIndex
 from ZODB.interfaces import IBlobStorage
 from ZODB.POSException import ExportError
-from ZODB.serialize import referencesf
-from ZODB.utils import p64, u64, cp, mktemp
-from ZODB._compat import Pickler, Unpickler, BytesIO, _protocol
+from ZODB.serialize import referencesf, _may_refer
+from ZODB.utils import p64, u64, cp, mktemp, get_pickle_metadata
+from ZODB.utils import get_pickle_protocol
+from ZODB._compat import Pickler, Unpickler, BytesIO
 
 
 logger = logging.getLogger('ZODB.ExportImport')
 
 class ExportImport:
 
-    def exportFile(self, oid, f=None):
+    def exportFile(self, oid, f=None, compress=False, progress=None):
+        """Export an object and the objects it refers to, to a file
+
+        The records are written as they're loaded, to a temporary file
+        if f is None.  With compress, the export is gzip-compressed, as
+        importFile() accepts too.  progress, if given, is called with
+        the number of records and of bytes exported after each record.
+        The byte count is that of the export before compression.
+        Return the file.
+        """
         if f is None:
             f = TemporaryFile(prefix="EXP")
         elif isinstance(f, six.string_types):
             f = open(f,'w+b')
-        f.write(b'ZEXP')
-        oids = [oid]
-        done_oids = {}
-        done = done_oids.__contains__
+        out = gzip.GzipFile(fileobj=f, mode='wb') if compress else f
+        out.write(b'ZEXP')
+        oids = collections.deque([oid])
+        # The oids seen, kept in an fsIndex which is much smaller than a
+        # set for large exports.
+        done = fsIndex()
         load = self._storage.load
         supports_blobs = IBlobStorage.providedBy(self._storage)
+        blob_classes = {}
+        records = size = 0
         while oids:
-            oid = oids.pop(0)
-            if oid in done_oids:
+            oid = oids.popleft()
+            if oid in done:
                 continue
-            done_oids[oid] = True
+            done[oid] = 0
             try:
                 p, serial = load(oid, '')
             except:
                 logger.debug("broken reference for oid %s", repr(oid),
                              exc_info=True)
-            else:
-                referencesf(p, oids)
-                f.writelines([oid, p64(len(p)), p])
+                continue
 
-                if supports_blobs:
-                    if not isinstance(self._reader.getGhost(p), Blob):
-                        continue # not a blob
+            oids.extend(referencesf(p))
+            out.writelines([oid, p64(len(p)), p])
+            records += 1
+            size += 16 + len(p)
+
+            if supports_blobs and self._isBlobRecord(p, blob_classes):
+                blobfilename = self._storage.loadBlob(oid, serial)
+                blob_size = os.stat(blobfilename).st_size
+                out.write(blob_begin_marker)
+                out.write(p64(blob_size))
+                with open(blobfilename, "rb") as blobdata:
+                    cp(blobdata, out)
+                size += len(blob_begin_marker) + 8 + blob_size
+
+            if progress is not None:
+                progress(records, size)
+
+        out.write(export_end_marker)
+        if compress:
+            out.close()
+        return f
 
-                    blobfilename = self._storage.loadBlob(oid, serial)
-                    f.write(blob_begin_marker)
-                    f.write(p64(os.stat(blobfilename).st_size))
-                    blobdata = open(blobfilename, "rb")
-                    cp(blobdata, f)
-                    blobdata.close()
+    def _isBlobRecord(self, p, blob_classes):
+        """Tell whether a record is of a Blob class
 
-        f.write(export_end_marker)
-        return f
+        The class is looked up by the names in the record, once per
+        class, in blob_classes.  Records that don't name their class
+        are loaded as ghosts.
+        """
+        names = get_pickle_metadata(p)
+        is_blob = blob_classes.get(names)
+        if is_blob is None:
+            if not all(names):
+                return isinstance(self._reader.getGhost(p), Blob)
+            try:
+                klass = self._db.classFactory(self, *names)
+                is_blob = issubclass(klass, Blob)
+            except Exception:
+                return isinstance(self._reader.getGhost(p), Blob)
+            blob_classes[names] = is_blob
+        return is_blob
 
     def importFile(self, f, clue='', customImporters=None):
         # This is tricky, because we need to work in a transaction!
@@ -80,6 +124,11 @@ class ExportImport:
                                        customImporters=customImporters)
 
         magic = f.read(4)
+        if magic[:2] == gzip_magic:
+            # Compressed by exportFile(compress=True)
+            f.seek(-len(magic), 1)
+            f = gzip.GzipFile(fileobj=f, mode='rb')
+            magic = f.read(4)
         if magic != b'ZEXP':
             if customImporters and magic in customImporters:
                 f.seek(0)
@@ -106,8 +155,20 @@ class ExportImport:
         Invoked by the transaction manager mid commit.
         Appends one item, the OID of the first object created,
         to return_oid_list.
+
+        Records are stored as they're read.  Records without references
+        already pickled with the database's protocol are stored as they
+        are.  Others are unpickled and pickled again with new oids.
         """
-        oids = {}
+        oids = _OidMap()
+        new_oid = self._storage.new_oid
+        protocol = self._db.pickle_protocol
+
+        def remap(ooid):
+            oid = oids.get(ooid)
+            if oid is None:
+                oid = oids[ooid] = new_oid()
+            return oid
 
         # IMPORTANT: This code should be consistent with the code in
         # serialize.py. It is currently out of date and doesn't handle
@@ -125,19 +186,12 @@ class ExportImport:
                 # this happens on Python 3 when all bytes in the oid are < 0x80
                 ooid = ooid.encode('ascii')
 
-            if ooid in oids:
-                oid = oids[ooid]
-            else:
-                if klass is None:
-                    oid = self._storage.new_oid()
-                else:
-                    oid = self._storage.new_oid(), klass
-                oids[ooid] = oid
-
-            return Ghost(oid)
+            if klass is None:
+                return Ghost(remap(ooid))
+            return Ghost((remap(ooid), klass))
 
+        header = f.read(16)
         while 1:
-            header = f.read(16)
             if header == export_end_marker:
                 break
             if len(header) != 16:
@@ -151,42 +205,41 @@ class ExportImport:
             if len(data) != length:
                 raise ExportError("Truncated export file")
 
-            if oids:
-                oid = oids[ooid]
-                if isinstance(oid, tuple):
-                    oid = oid[0]
-            else:
-                oids[ooid] = oid = self._storage.new_oid()
+            oid = remap(ooid)
+            if not return_oid_list:
                 return_oid_list.append(oid)
 
-            # Blob support
-            blob_begin = f.read(len(blob_begin_marker))
-            if blob_begin == blob_begin_marker:
+            # Blob support.  What follows is read without seeking back,
+            # which compressed files can't do cheaply.
+            header = f.read(16)
+            if header.startswith(blob_begin_marker):
                 # Copy the blob data to a temporary file
                 # and remember the name
-                blob_len = u64(f.read(8))
+                blob_len = header[len(blob_begin_marker):]
+                blob_len = u64(blob_len + f.read(8 - len(blob_len)))
                 blob_filename = mktemp()
                 blob_file = open(blob_filename, "wb")
                 cp(f, blob_file, blob_len)
                 blob_file.close()
+                header = f.read(16)
             else:
-                f.seek(-len(blob_begin_marker),1)
                 blob_filename = None
 
-            pfile = BytesIO(data)
-            unpickler = Unpickler(pfile)
-            unpickler.persistent_load = persistent_load
+            if _may_refer(data) or get_pickle_protocol(data) != protocol:
+                pfile = BytesIO(data)
+                unpickler = Unpickler(pfile)
+                unpickler.persistent_load = persistent_load
 
-            newp = BytesIO()
-            pickler = Pickler(newp, _protocol)
-            if sys.version_info[0] < 3:
-                pickler.inst_persistent_id = persistent_id
-            else:
-                pickler.persistent_id = persistent_id
+                newp = BytesIO()
+                pickler = Pickler(newp, protocol)
+                if sys.version_info[0] < 3:
+                    pickler.inst_persistent_id = persistent_id
+                else:
+                    pickler.persistent_id = persistent_id
 
-            pickler.dump(unpickler.load())
-            pickler.dump(unpickler.load())
-            data = newp.getvalue()
+                pickler.dump(unpickler.load())
+                pickler.dump(unpickler.load())
+                data = newp.getvalue()
 
             if blob_filename is not None:
                 self._storage.storeBlob(oid, None, data, blob_filename,
@@ -197,6 +250,7 @@ class ExportImport:
 
 export_end_marker = b'\377'*16
 blob_begin_marker = b'\000BLOBSTART'
+gzip_magic = b'\037\213'
 
 class Ghost(object):
     __slots__ = ("oid",)
@@ -206,3 +260,33 @@ class Ghost(object):
 def persistent_id(obj):
     if isinstance(obj, Ghost):
         return obj.oid
+
+
+class _OidMap(object):
+    """{exported oid -> new oid}
+
+    The oids are kept as integers in an LLBTree, which is much smaller
+    than a dict when importing many objects.  Oids too large for its
+    signed 64-bit integers are kept in a dict.
+    """
+
+    def __init__(self):
+        self._tree = LLBTree()
+        self._large = {}
+
+    def get(self, ooid):
+        n = u64(ooid)
+        if n < _large_oid:
+            oid = self._tree.get(n)
+            if oid is not None:
+                return p64(oid)
+        return self._large.get(ooid)
+
+    def __setitem__(self, ooid, oid):
+        n = u64(ooid)
+        if n < _large_oid and u64(oid) < _large_oid:
+            self._tree[n] = u64(oid)
+        else:
+            self._large[ooid] = oid
+
+_large_oid = 1 << 63
@@ -31,6 +31,7 @@ from zc.lockfile import LockFile
 from zope.interface import alsoProvides
 from zope.interface import implementer
 
+from ZODB.ActivityMonitor import timer
 from ZODB.blob import BlobStorageMixin
 from ZODB.blob import link_or_copy
 from ZODB.blob import remove_committed
@@ -38,6 +39,7 @@ from ZODB.blob import remove_committed_dir
 from ZODB.BaseStorage import BaseStorage
 from ZODB.BaseStorage import DataRecord as _DataRecord
 from ZODB.BaseStorage import TransactionRecord as _TransactionRecord
+from ZODB.CommitStatistics import record
 from ZODB.ConflictResolution import ConflictResolvingStorage
 from ZODB.ConflictResolution import ResolvedSerial
 from ZODB.FileStorage.format import CorruptedDataError
@@ -50,6 +52,7 @@ from ZODB.FileStorage.format import TRANS_HDR
 from ZODB.FileStorage.format import TRANS_HDR_LEN
 from ZODB.FileStorage.format import TxnHeader
 from ZODB.FileStorage.fspack import FileStoragePacker
+from ZODB.FileStorage.references import ReferenceIndex
 from ZODB.interfaces import IBlobStorageRestoreable
 from ZODB.interfaces import IExternalGC
 from ZODB.interfaces import IStorage
@@ -65,6 +68,7 @@ from ZODB.POSException import StorageError
 from ZODB.POSException import StorageSystemError
 from ZODB.POSException import StorageTransactionError
 from ZODB.POSException import UndoError
+from ZODB.serialize import referencesf
 from ZODB.fsIndex import fsIndex
 from ZODB.utils import as_bytes
 from ZODB.utils import as_text
@@ -144,9 +148,19 @@ class FileStorage(
     # Set True while a pack is in progress; undo is blocked for the duration.
     _pack_is_in_progress = False
 
+    # The ReferenceIndex, if the storage keeps one.
+    _references = None
+    # Whether the reference index is used to collect garbage.
+    _incremental_gc = False
+
+    # Number of incremental garbage collection candidates checked after
+    # committing transactions.
+    gc_candidates_per_commit = 10
+
     def __init__(self, file_name, create=False, read_only=False, stop=None,
                  quota=None, pack_gc=True, pack_keep_old=True, packer=None,
-                 blob_dir=None):
+                 blob_dir=None, reference_index=False, incremental_gc=False,
+                 blob_cache_dir=None, blob_cache_size=None):
 
         if read_only:
             self._is_read_only = True
@@ -170,6 +184,7 @@ class FileStorage(
         self._file_name = os.path.abspath(file_name)
 
         self._pack_gc = pack_gc
+        self._incremental_gc = incremental_gc
         self.pack_keep_old = pack_keep_old
         if packer is not None:
             self.packer = packer
@@ -178,6 +193,9 @@ class FileStorage(
 
         index, tindex = self._newIndexes()
         self._initIndex(index, tindex)
+        # {oid -> references} of the records written by the current
+        # transaction, for the reference index.
+        self._trefs = {}
 
         # Now open the file
 
@@ -227,6 +245,12 @@ class FileStorage(
 
         self._ltid = tid
 
+        if reference_index or incremental_gc:
+            self._references = self._restore_references(incremental_gc)
+            if incremental_gc:
+                self._update_references()
+                self._references.startCollecting()
+
         # self._pos should always point just past the last
         # transaction.  During 2PC, data is written after _pos.
         # invariant is restored at tpc_abort() or tpc_finish().
@@ -249,7 +273,8 @@ class FileStorage(
             if create and os.path.exists(self.blob_dir):
                 remove_committed_dir(self.blob_dir)
 
-            self._blob_init(blob_dir)
+            self._blob_init(blob_dir, blob_cache_dir=blob_cache_dir,
+                            blob_cache_size=blob_cache_size)
             alsoProvides(self, IBlobStorageRestoreable)
         else:
             self.blob_dir = None
@@ -293,6 +318,10 @@ class FileStorage(
             os.rename(tmp_name, index_name)
         except: pass
 
+        if self._references is not None:
+            self._references.save(self.__name__ + '.refs',
+                                  self._pos, self._ltid)
+
         self._saved += 1
 
     def _clear_index(self):
@@ -418,6 +447,56 @@ class FileStorage(
 
         return index, pos, tid
 
+    def _restore_references(self, collecting=False):
+        """Load the reference index saved for the storage, or a new one.
+
+        Entries of the records written since the index was saved are
+        missing.
+        """
+        r = ReferenceIndex.load(self.__name__ + '.refs', collecting)
+        if r is not None:
+            references, pos, tid = r
+            missing = self._oids_written_since(pos, tid)
+            if missing is not None:
+                references.missing.update(missing)
+                return references
+            logger.warning("Ignoring reference index for %s",
+                           self._file_name)
+        # Nothing to compute for an empty storage.
+        return ReferenceIndex(not self._index)
+
+    def _oids_written_since(self, pos, tid):
+        """Return the oids written after the transaction ending at pos.
+
+        Return None if the transaction ending at pos isn't tid.
+        """
+        if pos == 4 and tid == z64:
+            start = pos
+        elif pos < 4 + TRANS_HDR_LEN or pos > self._pos:
+            return None
+        else:
+            try:
+                tlen = self._read_num(pos - 8)
+                h = self._read_txn_header(pos - 8 - tlen)
+            except CorruptedError:
+                return None
+            if h.tid != tid or h.tlen != tlen:
+                return None
+            start = pos
+
+        oids = set()
+        pos = start
+        while pos < self._pos:
+            h = self._read_txn_header(pos)
+            end = pos + h.tlen
+            pos += h.headerlen()
+            while pos < end:
+                dh = self._read_data_header(pos)
+                oids.add(dh.oid)
+                pos += dh.recordlen()
+            pos = end + 8
+        return oids
+
     def close(self):
         self._file.close()
         self._files.close()
@@ -430,6 +509,8 @@ class FileStorage(
         except:
             # Log the error and continue
             logger.exception("Error saving index on close()")
+        if self.blob_dir:
+            self._blob_close()
 
     def getSize(self):
         return self._pos
@@ -495,6 +576,94 @@ class FileStorage(
             else:
                 return _file.read(h.plen), h.tid, end_tid
 
+    def getReferences(self, oid):
+        """Return the oids referred to by the current record of oid
+
+        They're taken from the reference index, if the storage keeps
+        one, rather than from the record's pickle.
+        """
+        references = self._references
+        with self._files.get() as _file:
+            pos = self._lookup_pos(oid)
+            if references is not None:
+                refs = references.get(oid, pos)
+                if refs is not None:
+                    return refs
+            h = self._read_data_header(pos, oid, _file)
+            if h.plen:
+                data = _file.read(h.plen)
+            elif h.back:
+                data = self._loadBack_impl(oid, h.back, False, _file)[0]
+            else:
+                data = None
+        refs = referencesf(data) if data else []
+        if references is not None:
+            with self._lock:
+                if self._index_get(oid) == pos:
+                    references.set(oid, pos, refs)
+        return refs
+
+    def getReferrers(self, oid):
+        """Return the oids of the objects whose current records refer to oid
+
+        Without a reference index, all of the current records are read.
+        With one, the references of all of the objects are only read
+        once, then kept up to date.
+        """
+        references = self._references
+        if references is None:
+            return [referrer for referrer in self._current_oids()
+                    if oid in self.getReferences(referrer)]
+        self._update_references()
+        return references.referrers(oid)
+
+    def _current_oids(self):
+        # Committing transactions update the index.
+        with self._lock:
+            return list(self._index.keys())
+
+    def _missing_references(self):
+        with self._lock:
+            return list(self._references.missing)
+
+    def _update_references(self):
+        """Compute the entries of the reference index not known yet"""
+        references = self._references
+        if not references.complete:
+            for oid in self._current_oids():
+                try:
+                    self.getReferences(oid)
+                except POSKeyError:
+                    pass # Packed away
+            references.complete = True
+        for oid in self._missing_references():
+            try:
+                self.getReferences(oid)
+            except POSKeyError:
+                references.missing.discard(oid)
+
+    def collectGarbage(self):
+        """Find the objects that became unreachable
+
+        This is only possible with incremental garbage collection, which
+        checks a few of the objects that lost referrers after each commit
+        and the rest when called or before packing.  Packs then remove
+        the objects found unreachable as of the pack time, without
+        marking the reachable ones.  Cycles of more than
+        ReferenceIndex.max_search objects, and garbage left before
+        incremental garbage collection was used, are only removed by
+        packs of a storage opened without it.
+
+        Return the number of objects found unreachable.
+        """
+        references = self._references
+        if references is None or not self._incremental_gc:
+            raise FileStorageError(
+                "Incremental garbage collection isn't enabled")
+        self._update_references()
+        with self._lock:
+            return references.collect(self._ltid)
+
     def store(self, oid, oldserial, data, version, transaction):
         if self._is_read_only:
             raise ReadOnlyError()
@@ -519,6 +688,8 @@ class FileStorage(
             pos = self._pos
             here = pos + self._tfile.tell() + self._thl
             self._tindex[oid] = here
+            if self._references is not None:
+                self._trefs[oid] = referencesf(data)
             new = DataHeader(oid, self._tid, old, pos, 0, len(data))
 
             self._tfile.write(new.asString())
@@ -554,6 +725,8 @@ class FileStorage(
             pos = self._pos
             here = pos + self._tfile.tell() + self._thl
             self._tindex[oid] = here
+            if self._references is not None:
+                self._trefs[oid] = []
             new = DataHeader(oid, self._tid, old, pos, 0, 0)
             self._tfile.write(new.asString())
             self._tfile.write(z64)
@@ -648,6 +821,8 @@ class FileStorage(
             here = self._pos + self._tfile.tell() + self._thl
             # And update the temp file index
             self._tindex[oid] = here
+            if self._references is not None:
+                self._trefs[oid] = referencesf(data) if data else []
             if prev_pos:
                 # If there is a valid prev_pos, don't write data.
                 data = None
@@ -677,6 +852,7 @@ class FileStorage(
 
     def _clear_temp(self):
         self._tindex.clear()
+        self._trefs.clear()
         if self._tfile is not None:
             self._tfile.seek(0)
 
@@ -735,12 +911,28 @@ class FileStorage(
                     if f is not None:
                         f(self._tid)
                     u, d, e = self._ude
+                    start = timer()
                     self._finish(self._tid, u, d, e)
+                    record('storage_finish', timer() - start)
                     self._clear_temp()
                 finally:
                     self._ude = None
                     self._transaction = None
                     self._commit_lock_release()
+        if self._incremental_gc:
+            self._collect_candidates()
+
+    def _collect_candidates(self):
+        # Check a few of the garbage collection candidates, once the
+        # commit lock is released.  Unlike a failure to finish a
+        # transaction, a failure to do so doesn't close the storage.
+        try:
+            with self._lock:
+                self._references.collect(self._ltid,
+                                         self.gc_candidates_per_commit)
+        except Exception:
+            logger.exception("Couldn't collect garbage in %s",
+                             self._file_name)
 
     def _finish(self, tid, u, d, e):
         # If self._nextpos is 0, then the transaction didn't write any
@@ -766,10 +958,14 @@ class FileStorage(
 
         self._file.flush()
         if fsync is not None:
+            start = timer()
             fsync(self._file.fileno())
+            record('fsync', timer() - start)
 
         self._pos = self._nextpos
         self._index.update(self._tindex)
+        if self._references is not None:
+            self._references.committed(self._tindex, self._trefs)
         self._ltid = tid
         self._blob_tpc_finish()
 
@@ -1098,14 +1294,17 @@ class FileStorage(
         if not self._index:
             return
 
+        if gc is None:
+            gc = self._pack_gc
+
+        if gc and self._incremental_gc:
+            self.collectGarbage()
+
         with self._lock:
             if self._pack_is_in_progress:
                 raise FileStorageError('Already packing')
             self._pack_is_in_progress = True
 
-        if gc is None:
-            gc = self._pack_gc
-
         oldpath = self._file_name + ".old"
         if os.path.exists(oldpath):
             os.remove(oldpath)
@@ -1138,8 +1337,11 @@ class FileStorage(
                     # OK, we're beyond the point of no return
                     os.rename(self._file_name + '.pack', self._file_name)
                     self._file = open(self._file_name, 'r+b')
+                    old_index = self._index
                     self._initIndex(index, self._tindex)
                     self._pos = opos
+                    if self._references is not None:
+                        self._references.packed(old_index, index)
 
             # We're basically done.  Now we need to deal with removed
             # blobs and removing the .old file (see further down).
@@ -1148,6 +1350,7 @@ class FileStorage(
                 self._commit_lock_release()
                 have_commit_lock = False
                 self._remove_blob_files_tagged_for_removal_during_pack()
+                self._blob_packed()
 
         finally:
             if have_commit_lock:
@@ -146,7 +146,7 @@ class PackCopier(FileStorageFormatter):
 
 class GC(FileStorageFormatter):
 
-    def __init__(self, file, eof, packtime, gc, referencesf):
+    def __init__(self, file, eof, packtime, gc, referencesf, references=None):
         self._file = file
         self._name = file.name
         self.eof = eof
@@ -174,6 +174,8 @@ class GC(FileStorageFormatter):
         self.ltid = z64
 
         self.referencesf = referencesf
+        # The storage's ReferenceIndex, if any
+        self.references = references
 
     def isReachable(self, oid, pos):
         """Return 1 if revision of `oid` at `pos` is reachable."""
@@ -188,7 +190,18 @@ class GC(FileStorageFormatter):
     def findReachable(self):
         self.buildPackIndex()
         if self.gc:
-            self.findReachableAtPacktime([z64])
+            dead = None
+            if self.references is not None:
+                dead = self.references.deadAsOf(self.packtime)
+            if dead is None:
+                self.findReachableAtPacktime([z64])
+            else:
+                # Incremental garbage collection found the unreachable
+                # objects already.
+                reachable = self.reachable
+                for oid, pos in self.oid2curpos.items():
+                    if oid not in dead:
+                        reachable[oid] = pos
             self.findReachableFromFuture()
             # These mappings are no longer needed and may consume a lot of
             # space.
@@ -322,6 +335,10 @@ class GC(FileStorageFormatter):
     def findrefs(self, pos):
         """Return a list of oids referenced as of packtime."""
         dh = self._read_data_header(pos)
+        if self.references is not None:
+            refs = self.references.get(dh.oid, pos)
+            if refs is not None:
+                return refs
         # Chase backpointers until we get to the record with the refs
         while dh.back:
             dh = self._read_data_header(dh.back)
@@ -361,7 +378,8 @@ class FileStoragePacker(FileStorageFormatter):
         self.locked = False
         self.file_end = storage.getSize()
 
-        self.gc = GC(self._file, self.file_end, self._stop, gc, referencesf)
+        self.gc = GC(self._file, self.file_end, self._stop, gc, referencesf,
+                     getattr(storage, '_references', None))
 
         # The packer needs to acquire the parent's commit lock
         # during the copying stage, so the two sets of lock acquire
@@ -0,0 +1,313 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""References of the current records of a FileStorage
+
+A FileStorage opened with a reference index keeps the oids referred to
+by the current record of each object, so that garbage collection when
+packing, the scripts following references and referrer queries don't
+have to unpickle records.  The index is updated when transactions are
+committed and packed, and saved next to the storage's index, in a
+``.refs`` file.
+
+Each object's entry has the position of the current record it was
+computed for.  An entry is only used if the position is still the one
+in the storage's index.  Records written without their data at hand,
+by undo, are added to a set of missing entries, computed again when
+needed.
+
+The index also supports incremental garbage collection.  Once all the
+entries are known, the referrers of each object are kept as well, and
+objects that lose referrers become candidates.  A candidate is
+unreachable, or dead, if following its referrers, and theirs, never
+leads to the root object.  That also finds cycles of garbage, up to
+`max_search` objects.  Packs then just drop the objects found dead
+rather than marking all of the reachable ones.
+"""
+import logging
+import os
+import threading
+
+from ZODB._compat import Pickler, Unpickler, _protocol
+from ZODB.utils import p64, u64, z64
+
+logger = logging.getLogger('ZODB.FileStorage')
+
+
+def _split(refs):
+    return [refs[i:i+8] for i in range(0, len(refs), 8)]
+
+
+class ReferenceIndex(object):
+    """{oid -> oids referred to by the object's current record}
+
+    `complete` tells whether every object in the storage has an entry or
+    is in `missing`.  It's false until the references of all the objects
+    were computed once.
+
+    When collecting garbage, `candidates` is the set of objects to check
+    and `dead` maps the objects found unreachable to the transaction id
+    as of which they were.  Both are None otherwise.
+    """
+
+    # Candidates leading back to more objects are left for full packs.
+    max_search = 10000
+
+    def __init__(self, complete=False):
+        self.complete = complete
+        self.missing = set()
+        self._lock = threading.Lock()
+        # {oid -> p64(record position) + referenced oids}
+        self._data = {}
+        # {oid -> set of referrer oids}, built by the first query.
+        self._referrers = None
+        self.candidates = None
+        self.dead = None
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, oid, pos):
+        """Return the oids referred to by the record at pos, or None"""
+        entry = self._data.get(oid)
+        if entry is not None and u64(entry[:8]) == pos:
+            return _split(entry[8:])
+        return None
+
+    def set(self, oid, pos, refs):
+        entry = p64(pos) + b''.join(refs)
+        with self._lock:
+            old = self._data.get(oid)
+            self._data[oid] = entry
+            self.missing.discard(oid)
+            if self._referrers is not None:
+                old = set(_split(old[8:])) if old is not None else set()
+                refs = set(refs)
+                for ref in old - refs:
+                    self._unrefer(oid, ref)
+                for ref in refs - old:
+                    self._refer(oid, ref)
+
+    def discard(self, oid):
+        with self._lock:
+            self._discard(oid)
+
+    def _discard(self, oid):
+        old = self._data.pop(oid, None)
+        if old is not None and self._referrers is not None:
+            self._forget(oid, old)
+
+    def _forget(self, oid, entry):
+        for ref in _split(entry[8:]):
+            self._unrefer(oid, ref)
+
+    def _refer(self, oid, ref):
+        self._referrers.setdefault(ref, set()).add(oid)
+        dead = self.dead
+        if dead and ref in dead and oid not in dead:
+            # Written by a connection that still had it, or undo.
+            self._revive(ref)
+
+    def _unrefer(self, oid, ref):
+        referrers = self._referrers.get(ref)
+        if referrers is not None:
+            referrers.discard(oid)
+            if not referrers:
+                del self._referrers[ref]
+        if self.candidates is not None and ref not in self.dead:
+            self.candidates.add(ref)
+
+    def _revive(self, oid):
+        todo = [oid]
+        while todo:
+            oid = todo.pop()
+            if self.dead.pop(oid, None) is not None:
+                entry = self._data.get(oid)
+                if entry is not None:
+                    todo.extend(_split(entry[8:]))
+
+    def _buildReferrers(self):
+        if self._referrers is None:
+            referrers = {}
+            for referrer, entry in self._data.items():
+                for ref in _split(entry[8:]):
+                    referrers.setdefault(ref, set()).add(referrer)
+            self._referrers = referrers
+
+    def committed(self, tindex, trefs):
+        """Update the entries of the objects written by a transaction
+
+        `tindex` has the positions of the new records and `trefs` the
+        references of those for which the data was stored.
+        """
+        for oid, pos in tindex.items():
+            refs = trefs.get(oid)
+            if refs is None:
+                with self._lock:
+                    self._discard(oid)
+                    self.missing.add(oid)
+            else:
+                self.set(oid, pos, refs)
+
+    def packed(self, old_index, index):
+        """Move the entries to the positions of the packed records
+
+        Entries of objects removed by the pack are dropped.
+        """
+        with self._lock:
+            for oid, entry in list(self._data.items()):
+                pos = index.get(oid)
+                if pos is not None and u64(entry[:8]) == old_index.get(oid):
+                    self._data[oid] = p64(pos) + entry[8:]
+                else:
+                    self._discard(oid)
+                    if pos is not None:
+                        self.missing.add(oid)
+            self.missing = set(oid for oid in self.missing if oid in index)
+            if self.dead is not None:
+                self.candidates = set(oid for oid in self.candidates
+                                      if oid in index)
+                self.dead = dict((oid, tid) for (oid, tid)
+                                 in self.dead.items() if oid in index)
+
+    def referrers(self, oid):
+        """Return the sorted oids of the objects referring to oid
+
+        The result is only accurate if the index is complete and nothing
+        is missing.
+        """
+        with self._lock:
+            self._buildReferrers()
+            return sorted(self._referrers.get(oid, ()))
+
+    def startCollecting(self):
+        """Keep track of the objects that may have become unreachable
+
+        The index must be complete.  Objects without referrers, other
+        than the root, are candidates.  Objects found dead before the
+        index was saved, but referred to by live objects now, as after
+        commits by a storage opened without incremental garbage
+        collection, are revived.
+        """
+        with self._lock:
+            if self.dead is None:
+                self.dead = {}
+                self.candidates = set()
+            self._buildReferrers()
+            dead = self.dead
+            for oid in list(dead):
+                if oid in dead and [referrer for referrer
+                                    in self._referrers.get(oid, ())
+                                    if referrer not in dead]:
+                    self._revive(oid)
+            for oid in self._data:
+                if (oid != z64 and oid not in self._referrers
+                    and oid not in self.dead):
+                    self.candidates.add(oid)
+
+    def collect(self, tid, limit=None):
+        """Find the unreachable objects among the candidates
+
+        At most `limit` candidates are checked.  The objects found dead
+        are recorded as of `tid` and the objects they refer to become
+        candidates.  Nothing is done while entries are missing, since
+        they could refer to candidates.  Return the number of objects
+        found dead.
+        """
+        with self._lock:
+            if (self._referrers is None or self.dead is None or
+                self.missing or not self.complete):
+                return 0
+            dead = self.dead
+            candidates = self.candidates
+            found = checked = 0
+            while candidates and (limit is None or checked < limit):
+                checked += 1
+                oid = candidates.pop()
+                if oid == z64 or oid in dead or oid not in self._data:
+                    continue
+                garbage = self._unreachable(oid)
+                if garbage is None:
+                    continue
+                for oid in garbage:
+                    dead[oid] = tid
+                for oid in garbage:
+                    for ref in _split(self._data[oid][8:]):
+                        if ref not in dead:
+                            candidates.add(ref)
+                found += len(garbage)
+            return found
+
+    def _unreachable(self, oid):
+        """Return the objects leading to oid, or None if the root does"""
+        referrers = self._referrers
+        dead = self.dead
+        seen = set([oid])
+        todo = [oid]
+        while todo:
+            for referrer in referrers.get(todo.pop(), ()):
+                if referrer in seen or referrer in dead:
+                    continue
+                if referrer == z64 or len(seen) >= self.max_search:
+                    return None
+                seen.add(referrer)
+                todo.append(referrer)
+        return seen
+
+    def deadAsOf(self, tid):
+        """Return the oids of the objects unreachable as of tid
+
+        Return None unless collecting garbage with nothing missing.
+        """
+        with self._lock:
+            if (self._referrers is None or self.dead is None or
+                self.missing or not self.complete):
+                return None
+            return set(oid for (oid, dead_tid) in self.dead.items()
+                       if dead_tid <= tid)
+
+    def save(self, file_name, pos, tid):
+        """Save the index, for a storage ending at pos with tid"""
+        tmp_name = file_name + '.refs_tmp'
+        with self._lock:
+            info = dict(pos=pos, tid=tid, complete=self.complete,
+                        missing=list(self.missing), references=self._data)
+            if self.dead is not None:
+                info.update(candidates=list(self.candidates), dead=self.dead)
+            with open(tmp_name, 'wb') as f:
+                Pickler(f, _protocol).dump(info)
+        if os.path.exists(file_name):
+            os.remove(file_name)
+        os.rename(tmp_name, file_name)
+
+    @classmethod
+    def load(class_, file_name, collecting=False):
+        """Return (index, pos, tid) as saved, or None
+
+        The garbage collection state is only restored if `collecting`.
+        """
+        if not os.path.exists(file_name):
+            return None
+        try:
+            with open(file_name, 'rb') as f:
+                info = Unpickler(f).load()
+        except Exception:
+            logger.exception("Couldn't load %s", file_name)
+            return None
+        index = class_(info['complete'])
+        index.missing.update(info['missing'])
+        index._data = info['references']
+        if collecting and info.get('dead') is not None:
+            index.candidates = set(info['candidates'])
+            index.dead = info['dead']
+        return index, info['pos'], info['tid']
@@ -340,3 +340,11 @@ class ConnectionStateError(POSError):
       still joined to a transaction (for example, a transaction is in
       progress, with uncommitted modifications in the connection).
     """
+
+class ConnectionPoolTimeoutError(POSError):
+    """No database connection became available in time.
+
+    DB.open() was called while the connection pool's hard limit of open
+    connections was reached, and none was returned to the pool within
+    the pool's wait timeout.
+    """
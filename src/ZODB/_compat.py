@@ -16,6 +16,7 @@ try:
     # Python 2.x
     from cPickle import Pickler
     from cPickle import Unpickler
+    from cPickle import Unpickler as NoloadUnpickler
     from cPickle import dump
     from cPickle import dumps
     from cPickle import loads
@@ -28,7 +29,7 @@ except ImportError:
     # Python 3.x: can't use stdlib's pickle because
     # http://bugs.python.org/issue6784
     import zodbpickle.pickle
-    HIGHEST_PROTOCOL = 3
+    HIGHEST_PROTOCOL = zodbpickle.pickle.HIGHEST_PROTOCOL
     from _compat_pickle import IMPORT_MAPPING, NAME_MAPPING
 
     class Pickler(zodbpickle.pickle.Pickler):
@@ -36,8 +37,6 @@ except ImportError:
             super(Pickler, self).__init__(f, protocol)
 
     class Unpickler(zodbpickle.pickle.Unpickler):
-        def __init__(self, f):
-            super(Unpickler, self).__init__(f)
 
         # Py3: Python 3 doesn't allow assignments to find_global,
         # instead, find_class can be overridden
@@ -49,6 +48,10 @@ except ImportError:
                 return super(Unpickler, self).find_class(modulename, name)
             return self.find_global(modulename, name)
 
+    # noload() doesn't look up globals, so it can use the base class,
+    # which is faster to create.
+    NoloadUnpickler = zodbpickle.pickle.Unpickler
+
     def dump(o, f, protocol=None):
         return zodbpickle.pickle.dump(o, f, protocol)
 
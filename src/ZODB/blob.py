@@ -15,6 +15,7 @@
 """
 
 import binascii
+import errno
 import logging
 import os
 import re
@@ -181,8 +182,9 @@ class Blob(persistent.Persistent):
                     self._create_uncommitted_file()
                     result = BlobFile(self._p_blob_uncommitted, mode, self)
                     if self._p_blob_committed:
-                        with open(self._p_blob_committed, 'rb') as fp:
-                            utils.cp(fp, result)
+                        with self._p_jar._storage.openCommittedBlobFile(
+                            self._p_oid, self._p_serial) as fp:
+                            utils.copy_file(fp, result)
                         if mode == 'r+':
                             result.seek(0)
                 else:
@@ -210,12 +212,12 @@ class Blob(persistent.Persistent):
             ):
             raise BlobError('Uncommitted changes')
 
-        result = self._p_blob_committed
-
-        # We do this to make sure we have the file and to let the
+        # We do this to make sure we have the file, which may have been
+        # removed from a blob cache since we were loaded, and to let the
         # storage know we're accessing the file.
-        n = self._p_jar._storage.loadBlob(self._p_oid, self._p_serial)
-        assert result == n, (result, n)
+        result = self._p_jar._storage.loadBlob(self._p_oid, self._p_serial)
+        assert result == self._p_blob_committed, (
+            result, self._p_blob_committed)
 
         return result
 
@@ -317,6 +319,59 @@ class BlobFile(file):
         self.blob.closed(self)
         super(BlobFile, self).close()
 
+    def size(self):
+        """Return the size of the blob data, in bytes
+        """
+        return os.fstat(self.fileno()).st_size
+
+    def sendfile(self, out, offset=0, count=None):
+        """Send blob data to a socket or file, without reading it
+
+        `out` is a file descriptor, or an object with a fileno method,
+        in blocking mode.  Up to `count` bytes, by default all, are sent
+        from `offset`, with os.sendfile when available, which copies
+        them in the kernel.  The position of the blob file isn't
+        changed.  Return the number of bytes sent.
+        """
+        if not isinstance(out, INT_TYPES):
+            out = out.fileno()
+        rest = max(self.size() - offset, 0)
+        if count is None or count > rest:
+            count = rest
+        sent = 0
+        if _sendfile is not None:
+            try:
+                while sent < count:
+                    n = _sendfile(out, self.fileno(), offset + sent,
+                                  count - sent)
+                    if not n:
+                        break
+                    sent += n
+                return sent
+            except OSError as v:
+                if sent or v.errno not in _sendfile_unsupported:
+                    raise
+
+        pos = self.tell()
+        self.seek(offset)
+        try:
+            while sent < count:
+                data = self.read(min(count - sent, 1 << 16))
+                if not data:
+                    break
+                while data:
+                    n = os.write(out, data)
+                    data = data[n:]
+                    sent += n
+        finally:
+            self.seek(pos)
+        return sent
+
+_sendfile = getattr(os, 'sendfile', None)
+# Errors of os.sendfile meaning it can't send to a given descriptor
+_sendfile_unsupported = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                         getattr(errno, 'ENOTSUP', errno.EINVAL))
+
 _pid = str(os.getpid())
 
 def log(msg, level=logging.INFO, subsys=_pid, exc_info=False):
@@ -608,12 +663,24 @@ LAYOUTS['lawn'] = LawnLayout()
 class BlobStorageMixin(object):
     """A mix-in to help storages support blobs."""
 
-    def _blob_init(self, blob_dir, layout='automatic'):
+    # The ZODB.BlobCache.BlobCache of committed blob files, if any.
+    blob_cache = None
+    # Whether the blob cache belongs to another storage, which closes it.
+    _blob_cache_shared = False
+
+    def _blob_init(self, blob_dir, layout='automatic',
+                   blob_cache_dir=None, blob_cache_size=None):
         # XXX Log warning if storage is ClientStorage
         self.fshelper = FilesystemHelper(blob_dir, layout)
         self.fshelper.create()
         self.fshelper.checkSecure()
         self.dirty_oids = []
+        if blob_cache_dir:
+            from ZODB.BlobCache import BlobCache
+            if not blob_cache_size:
+                raise ValueError("A blob cache needs a blob_cache_size")
+            self.blob_cache = BlobCache(blob_cache_dir, blob_cache_size,
+                                        self.fshelper.layout_name)
 
     def _blob_init_no_blobs(self):
         self.fshelper = NoBlobsFileSystemHelper()
@@ -633,6 +700,22 @@ class BlobStorageMixin(object):
         """
         self.dirty_oids = []
 
+    def _blob_close(self):
+        """Blob cleanup to be called from subclass close
+        """
+        if self.blob_cache is not None and not self._blob_cache_shared:
+            self.blob_cache.close()
+
+    def _blob_packed(self):
+        """Blob cleanup to be called from subclass pack, once blob
+        files are removed
+        """
+        cache = self.blob_cache
+        if cache is not None:
+            fshelper = self.fshelper
+            cache.prune(lambda oid, tid: os.path.exists(
+                fshelper.getBlobFilename(oid, tid)))
+
     def registerDB(self, db):
         self.__untransform_record_data = db.untransform_record_data
         try:
@@ -654,14 +737,38 @@ class BlobStorageMixin(object):
 
     def loadBlob(self, oid, serial):
         """Return the filename where the blob file can be found.
+
+        With a blob cache, that's the file in the cache, copied there
+        if needed.
         """
+        cache = self.blob_cache
+        if cache is not None:
+            cached = cache.get(oid, serial)
+            if cached is not None:
+                if os.path.exists(cached):
+                    return cached
+                # Removed by someone else.
+                cache.discard(oid, serial)
         filename = self.fshelper.getBlobFilename(oid, serial)
         if not os.path.exists(filename):
             raise POSKeyError("No blob file at %s" % filename, oid, serial)
+        if cache is not None:
+            return cache.add(oid, serial, filename)
         return filename
 
     def openCommittedBlobFile(self, oid, serial, blob=None):
         blob_filename = self.loadBlob(oid, serial)
+        try:
+            return self.__openCommittedBlobFile(blob_filename, blob)
+        except (IOError, OSError) as v:
+            if self.blob_cache is None or v.errno != errno.ENOENT:
+                raise
+        # Removed from the cache meanwhile, or by someone else.
+        self.blob_cache.discard(oid, serial)
+        blob_filename = self.loadBlob(oid, serial)
+        return self.__openCommittedBlobFile(blob_filename, blob)
+
+    def __openCommittedBlobFile(self, blob_filename, blob):
         if blob is None:
             return open(blob_filename, 'rb')
         else:
@@ -708,11 +815,13 @@ class BlobStorage(BlobStorageMixin):
     """
 
 
-    def __init__(self, base_directory, storage, layout='automatic'):
+    def __init__(self, base_directory, storage, layout='automatic',
+                 blob_cache_dir=None, blob_cache_size=None):
         assert not ZODB.interfaces.IBlobStorage.providedBy(storage)
         self.__storage = storage
 
-        self._blob_init(base_directory, layout)
+        self._blob_init(base_directory, layout,
+                        blob_cache_dir, blob_cache_size)
         try:
             supportsUndo = storage.supportsUndo
         except AttributeError:
@@ -755,6 +864,10 @@ class BlobStorage(BlobStorageMixin):
         self.__storage.tpc_abort(*arg, **kw)
         self._blob_tpc_abort()
 
+    def close(self):
+        self.__storage.close()
+        self._blob_close()
+
     def _packUndoing(self, packtime, referencesf):
         # Walk over all existing revisions of all blob files and check
         # if they are still needed by attempting to load the revision
@@ -816,6 +929,7 @@ class BlobStorage(BlobStorageMixin):
                 self._packUndoing(packtime, referencesf)
             else:
                 self._packNonUndoing(packtime, referencesf)
+            self._blob_packed()
         finally:
             self._lock_acquire()
             self._blobs_pack_is_in_progress = False
@@ -863,9 +977,7 @@ class BlobStorage(BlobStorageMixin):
                     data, serial_before, serial_after = load_result
                     orig_fn = self.fshelper.getBlobFilename(oid, serial_before)
                     new_fn = self.fshelper.getBlobFilename(oid, undo_serial)
-                with open(orig_fn, "rb") as orig:
-                    with open(new_fn, "wb") as new:
-                        utils.cp(orig, new)
+                copy_blob(orig_fn, new_fn)
                 self.dirty_oids.append((oid, undo_serial))
 
         finally:
@@ -881,6 +993,8 @@ class BlobStorage(BlobStorageMixin):
         base_dir = self.fshelper.base_dir
         s = self.__storage.new_instance()
         res = BlobStorage(base_dir, s)
+        res.blob_cache = self.blob_cache
+        res._blob_cache_shared = True
         return res
 
 copied = logging.getLogger('ZODB.blob.copied').debug
@@ -898,11 +1012,29 @@ def rename_or_copy_blob(f1, f2, chmod=True):
         copied("Copied blob file %r to %r.", f1, f2)
         with open(f1, 'rb') as file1:
             with open(f2, 'wb') as file2:
-                utils.cp(file1, file2)
+                utils.copy_file(file1, file2)
         remove_committed(f1)
     if chmod:
         os.chmod(f2, stat.S_IREAD)
 
+def copy_blob(f1, f2):
+    """Copy the committed blob file f1 to f2, which mustn't exist.
+
+    Committed blob files are never changed, so, except on Windows, f2 is
+    made a hard link to f1 when they're on the same file system.  The
+    data are copied with ZODB.utils.copy_file otherwise.
+    """
+    if sys.platform != 'win32':
+        try:
+            os.link(f1, f2)
+        except OSError:
+            pass
+        else:
+            return
+    with open(f1, 'rb') as file1:
+        with open(f2, 'wb') as file2:
+            utils.copy_file(file1, file2)
+
 if sys.platform == 'win32':
     # On Windows, you can't remove read-only files, so make the
     # file writable first.
@@ -964,9 +1096,9 @@ def copyTransactionsFromTo(source, destination):
                     prefix='CTFT',
                     suffix='.tmp', dir=destination.fshelper.temp_dir)
                 os.close(fd)
-                with open(blobfilename, 'rb') as sf:
-                    with open(name, 'wb') as df:
-                        utils.cp(sf, df)
+                # Leave the name to a link, if the files can share data.
+                os.remove(name)
+                copy_blob(blobfilename, name)
                 destination.restoreBlob(record.oid, record.tid, record.data,
                                  name, record.data_txn, trans)
             else:
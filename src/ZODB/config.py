@@ -112,8 +112,20 @@ class ZODBDatabase(BaseConfig):
                 options[oname] = v
 
         _option('pool_timeout')
+        _option('cache_budget_bytes')
+        _option('cache_budget_interval')
+        _option('cache_policy')
+        _option('pool_limit')
+        _option('pool_wait_timeout')
         _option('allow_implicit_cross_references', 'xrefs')
         _option('large_record_size')
+        _option('invalidation_log_size')
+        _option('invalidation_dispatcher')
+        _option('commit_timing')
+        _option('slow_commit_threshold')
+        _option('conflict_window')
+        _option('activation_sample_rate')
+        _option('pickle_protocol')
 
         try:
             return ZODB.DB(
@@ -172,7 +184,8 @@ class FileStorage(BaseConfig):
                 options['packer'] = getattr(m, name)
 
         for name in ('blob_dir', 'create', 'read_only', 'quota', 'pack_gc',
-                     'pack_keep_old'):
+                     'pack_keep_old', 'reference_index',
+                     'incremental_gc', 'blob_cache_dir', 'blob_cache_size'):
             v = getattr(config, name, self)
             if v is not self:
                 options[name] = v
@@ -184,7 +197,9 @@ class BlobStorage(BaseConfig):
     def open(self):
         from ZODB.blob import BlobStorage
         base = self.config.base.open()
-        return BlobStorage(self.config.blob_dir, base)
+        return BlobStorage(self.config.blob_dir, base,
+                           blob_cache_dir=self.config.blob_cache_dir,
+                           blob_cache_size=self.config.blob_cache_size)
 
 
 class ZEOClient(BaseConfig):
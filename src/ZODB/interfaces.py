@@ -278,6 +278,84 @@ class IConnection(Interface):
         If clear is True, reset the counters.
         """
 
+    def getTransferStatistics(clear=False):
+        """Return storage traffic and cache statistics.
+
+        The statistics cover the current request: they're reset when the
+        connection is opened, or when clear is True.  Return a
+        dictionary with keys:
+
+        loads, load_bytes
+           The number of storage load() and loadBefore() calls and the
+           number of bytes they returned.
+
+        load_time
+           A histogram of the load times, as a dictionary with count,
+           total, mean, max, p50, p95 and p99 keys, all in seconds, and
+           a list of (upper bound, count) buckets.
+
+        stores, store_bytes
+           The number of objects stored and the size of their records.
+
+        hits, misses
+           The number of get() calls answered with an object whose state
+           was in the cache, and the number of object states loaded.
+
+        invalidations
+           The number of objects invalidated in the cache.
+
+        commits
+           The number of transactions committed.
+
+        conflicts
+           The number of conflict errors raised by loads and commits.
+        """
+
+    def getActivationReport(clear=False):
+        """Return where the objects loaded by the current request were
+        activated.
+
+        Return None unless the request is traced, see the database's
+        activation_sample_rate.  Otherwise return a dictionary with the
+        number of activations, their total load_time in seconds, the
+        call_sites that activated objects, the n_plus_one call sites that
+        activated many objects referenced by the same parent one at a
+        time, and the slowest activations.  See ZODB.ActivationTracer.
+
+        The report is reset when the connection is opened, or when clear
+        is True.  N+1 patterns are logged when the connection is closed.
+        """
+
+    def cacheClassReport(sample=1000, clear=False):
+        """Report on the objects in the cache, by class.
+
+        Return a list of dictionaries, one per class, with the largest
+        total estimated size first.  The keys are:
+
+        class
+           The dotted name of the class.
+
+        objects, ghosts, non_ghosts
+           The number of objects of the class in the cache, and how many
+           of them are ghosts or not.
+
+        ghost_ratio
+           The fraction of the objects that are ghosts.
+
+        estimated_size
+           The total estimated size (_p_estimated_size) of the
+           non-ghost objects.
+
+        activations, activation_rate
+           How many objects of the class were loaded, and how many per
+           second.
+
+        Object counts and sizes are estimated from a sample of at most
+        `sample` objects; None means look at all of them.  Activations
+        are counted from when the connection was created or the report
+        was last asked for with clear set to True.
+        """
+
     def invalidateCache():
         """Invalidate the connection cache
 
@@ -0,0 +1,197 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Database metrics in the OpenMetrics text format
+
+render() formats the metrics of one or more databases (see
+DB.getMetrics()), labeled with their database names, for Prometheus
+and other collectors that read the OpenMetrics or Prometheus text
+formats.  make_app() returns a WSGI application serving them, to be
+mounted at a URL like /metrics::
+
+  app = ZODB.metrics.make_app(db)
+"""
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _histogram(statistics):
+    """Return the samples of a histogram from Histogram.getStatistics()
+    """
+    samples = []
+    seen = 0
+    for bound, n in statistics['buckets']:
+        seen += n
+        le = bound is None and '+Inf' or repr(bound)
+        samples.append(('_bucket', (('le', le), ), seen))
+    samples.append(('_count', (), statistics['count']))
+    samples.append(('_sum', (), statistics['total']))
+    return samples
+
+
+def families(metrics):
+    """Return [(name, type, help, samples)] for the result of getMetrics()
+
+    Samples are (suffix, labels, value), where labels is a sequence of
+    (name, value).
+    """
+    result = []
+    def add(name, type_, help, value):
+        if value is None:
+            return
+        if type_ == 'histogram':
+            samples = _histogram(value)
+        elif type_ == 'counter':
+            samples = [('_total', (), value)]
+        else:
+            samples = [('', (), value)]
+        result.append((name, type_, help, samples))
+
+    pool = metrics['pool']
+    add('zodb_pool_size', 'gauge',
+        'Expected maximum number of open connections.', pool['size'])
+    add('zodb_pool_limit', 'gauge',
+        'Hard limit on the number of open connections.', pool['limit'])
+    add('zodb_pool_available_connections', 'gauge',
+        'Closed connections available for reuse.', pool['available'])
+    add('zodb_pool_waiting', 'gauge',
+        'Callers of open() waiting for a connection.', pool['waiting'])
+    add('zodb_pool_waits', 'counter',
+        'Times open() had to wait for a connection.', pool['waits'])
+    add('zodb_pool_wait_timeouts', 'counter',
+        'Times open() gave up waiting for a connection.',
+        pool['wait_timeouts'])
+    add('zodb_connections_created', 'counter',
+        'Connections created by open().', pool['created'])
+    add('zodb_open_connections', 'gauge',
+        'Connections in use.', metrics['open_connections'])
+    add('zodb_open_historical_connections', 'gauge',
+        'Historical connections in use.',
+        metrics['open_historical_connections'])
+
+    caches = metrics['caches']
+    add('zodb_cache_objects', 'gauge',
+        'Objects in connection caches, including ghosts.', caches['objects'])
+    add('zodb_cache_non_ghost_objects', 'gauge',
+        'Objects with loaded state in connection caches.',
+        caches['non_ghosts'])
+    add('zodb_cache_bytes', 'gauge',
+        'Estimated size of the objects in connection caches.',
+        caches['estimated_bytes'])
+    add('zodb_cache_size_target', 'gauge',
+        'Target number of objects in each connection cache.',
+        metrics['cache_size'])
+    add('zodb_cache_size_bytes_target', 'gauge',
+        'Target size of each connection cache, 0 for no limit.',
+        metrics['cache_size_bytes'])
+
+    transfer = metrics['transfer']
+    add('zodb_loads', 'counter',
+        'Object records loaded from the storage.', transfer['loads'])
+    add('zodb_load_bytes', 'counter',
+        'Size of the records loaded from the storage.',
+        transfer['load_bytes'])
+    add('zodb_load_duration_seconds', 'histogram',
+        'Time taken by storage loads.', transfer['load_time'])
+    add('zodb_stores', 'counter',
+        'Object records stored.', transfer['stores'])
+    add('zodb_store_bytes', 'counter',
+        'Size of the records stored.', transfer['store_bytes'])
+    add('zodb_cache_hits', 'counter',
+        'Objects found loaded in connection caches.', transfer['hits'])
+    add('zodb_cache_misses', 'counter',
+        'Object states loaded into connection caches.', transfer['misses'])
+    add('zodb_invalidations', 'counter',
+        'Objects invalidated in connection caches.',
+        transfer['invalidations'])
+    add('zodb_commits', 'counter',
+        'Transactions committed.', transfer['commits'])
+    add('zodb_conflicts', 'counter',
+        'Conflict errors raised by loads and commits.', transfer['conflicts'])
+
+    commits = metrics['commits']
+    if commits is not None:
+        add('zodb_commit_duration_seconds', 'histogram',
+            'Time taken by two-phase commit.', commits['total'])
+        add('zodb_slow_commits', 'counter',
+            'Commits that took longer than the slow commit threshold.',
+            commits['slow'])
+
+    add('zodb_storage_size_bytes', 'gauge',
+        'Approximate size of the storage.', metrics['storage_size'])
+
+    pack = metrics['pack']
+    add('zodb_pack_running', 'gauge',
+        'Whether the database is being packed.', pack['running'])
+    add('zodb_last_pack_timestamp_seconds', 'gauge',
+        'When the last pack started.', pack['last_started'])
+    add('zodb_last_pack_duration_seconds', 'gauge',
+        'Time taken by the last pack.', pack['last_duration'])
+    add('zodb_last_pack_success', 'gauge',
+        'Whether the last pack succeeded.', pack['last_succeeded'])
+
+    return result
+
+
+def render(*databases):
+    """Return the metrics of the databases in the OpenMetrics text format
+    """
+    order = []
+    merged = {}
+    for db in databases:
+        metrics = db.getMetrics()
+        label = ('database', metrics['database_name'])
+        for name, type_, help, samples in families(metrics):
+            if name not in merged:
+                order.append(name)
+                merged[name] = type_, help, []
+            merged[name][2].extend(
+                (suffix, (label, ) + labels, value)
+                for (suffix, labels, value) in samples)
+
+    lines = []
+    for name in order:
+        type_, help, samples = merged[name]
+        lines.append('# TYPE %s %s' % (name, type_))
+        lines.append('# HELP %s %s' % (name, help))
+        for suffix, labels, value in samples:
+            lines.append('%s%s{%s} %s' % (
+                name, suffix,
+                ','.join('%s="%s"' % (k, _escape(v)) for (k, v) in labels),
+                _number(value)))
+    lines.append('# EOF\n')
+    return '\n'.join(lines)
+
+
+def make_app(*databases):
+    """Return a WSGI application serving the databases' metrics
+    """
+    def app(environ, start_response):
+        body = render(*databases).encode('utf-8')
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+    return app
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Compare connection cache policies by replaying an object access trace
+
+usage: cachepolicies.py [options] [tracefile]
+
+The trace file has one object access per line: an integer object
+number, optionally followed by the size of the object's record in
+bytes.  Lines starting with # and blank lines are ignored.  The objects
+are created in a MappingStorage and the trace is replayed against a
+connection using each cache policy in turn.
+
+Without a trace file, a synthetic trace is used, in which a working
+set of hot objects is accessed repeatedly, interrupted by scans through
+objects that are each used once.
+
+Options:
+
+    -c n    Cache size (default 1000)
+
+    -b n    Cache size in bytes (default 0, unlimited)
+
+    -g n    Garbage collect the cache every n accesses, like a
+            transaction boundary would (default 100)
+
+    -p name Policy to compare.  Can be given more than once.  The default
+            is all of the registered policies.
+
+    -s n    Seed for the synthetic trace (default 0)
+"""
+from __future__ import print_function
+
+import getopt
+import random
+import sys
+import time
+
+import transaction
+from persistent.mapping import PersistentMapping
+
+import ZODB
+import ZODB.CachePolicy
+from ZODB.MappingStorage import MappingStorage
+from ZODB.utils import p64
+
+
+def synthetic_trace(seed=0, hot=800, scans=10, scan_size=2000,
+                    between_scans=5000):
+    """Return a list of (object number, size)
+
+    Sizes are random, between 100 bytes and 10KB, with large objects
+    rarer than small ones.
+    """
+    r = random.Random(seed)
+    sizes = {}
+    def size(n):
+        if n not in sizes:
+            sizes[n] = int(100 * 100 ** r.random())
+        return sizes[n]
+
+    trace = []
+    cold = hot
+    for i in range(scans):
+        for j in range(between_scans):
+            n = int(hot * r.random() ** 2) # Skewed towards low numbers
+            trace.append((n, size(n)))
+        for j in range(scan_size):
+            trace.append((cold, size(cold)))
+            cold += 1
+    return trace
+
+
+def read_trace(f):
+    trace = []
+    for line in f:
+        line = line.split('#', 1)[0].split()
+        if not line:
+            continue
+        n = int(line[0])
+        if len(line) > 1:
+            size = int(line[1])
+        else:
+            size = 100
+        trace.append((n, size))
+    return trace
+
+
+def create(db, trace):
+    """Create the objects used in the trace.  Return their oids by number.
+    """
+    sizes = {}
+    for n, size in trace:
+        sizes[n] = max(size, sizes.get(n, 0))
+    conn = db.open()
+    oids = {}
+    for i, n in enumerate(sorted(sizes)):
+        obj = PersistentMapping(data=b'x' * sizes[n])
+        conn.add(obj)
+        oids[n] = obj._p_oid
+        if i % 1000 == 999:
+            transaction.commit()
+            conn.cacheMinimize()
+    transaction.commit()
+    conn.close()
+    return oids
+
+
+def replay(storage, trace, oids, policy, cache_size, cache_size_bytes,
+           gc_interval):
+    db = ZODB.DB(storage, cache_size=cache_size,
+                 cache_size_bytes=cache_size_bytes, cache_policy=policy)
+    conn = db.open()
+    conn.cacheMinimize()
+    # Start counting from scratch.
+    conn._cache_policy = db._cache_policy()
+
+    start = time.time()
+    for i, (n, size) in enumerate(trace):
+        obj = conn.get(oids[n])
+        obj._p_activate()
+        if i % gc_interval == gc_interval - 1:
+            conn.cacheGC()
+    elapsed = time.time() - start
+
+    stats = conn._cache_policy.getStatistics()
+    conn.close()
+    return stats, elapsed
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    opts, args = getopt.getopt(args, 'c:b:g:p:s:h')
+    cache_size = 1000
+    cache_size_bytes = 0
+    gc_interval = 100
+    policies = []
+    seed = 0
+    for o, v in opts:
+        if o == '-c':
+            cache_size = int(v)
+        elif o == '-b':
+            cache_size_bytes = int(v)
+        elif o == '-g':
+            gc_interval = int(v)
+        elif o == '-p':
+            policies.append(v)
+        elif o == '-s':
+            seed = int(v)
+        elif o == '-h':
+            print(__doc__)
+            return
+    if not policies:
+        policies = sorted(ZODB.CachePolicy.policies)
+
+    if args:
+        with open(args[0]) as f:
+            trace = read_trace(f)
+    else:
+        trace = synthetic_trace(seed)
+
+    storage = MappingStorage()
+    oids = create(ZODB.DB(storage), trace)
+
+    print("%d accesses to %d objects, cache size %d objects, %d bytes"
+          % (len(trace), len(oids), cache_size, cache_size_bytes))
+    print("%-8s %10s %10s %10s %8s %8s"
+          % ('policy', 'hits', 'misses', 'evictions', 'hit %', 'seconds'))
+    for policy in policies:
+        stats, elapsed = replay(storage, trace, oids, policy,
+                                cache_size, cache_size_bytes, gc_interval)
+        accesses = stats['hits'] + stats['misses']
+        print("%-8s %10d %10d %10d %8.1f %8.2f"
+              % (stats['policy'], stats['hits'], stats['misses'],
+                 stats['evictions'], 100.0 * stats['hits'] / (accesses or 1),
+                 elapsed))
+    storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Time commits of many small objects
+
+usage: commitbench.py [options]
+
+Transactions adding and then modifying small persistent mappings are
+committed to a MappingStorage, or to a FileStorage, and the time taken
+by the commits is printed, followed by the time taken to serialize the
+objects with a single ObjectWriter, as commits do.
+
+Options:
+
+    -n n    Number of objects per transaction (default 10000)
+
+    -r n    Number of transactions modifying the objects, and of times
+            the objects are serialized (default 5)
+
+    -f path Commit to a FileStorage at path, which is removed first
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import sys
+import time
+
+import transaction
+from persistent.mapping import PersistentMapping
+
+import ZODB
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.serialize import ObjectWriter
+
+
+def timed_commit():
+    start = time.time()
+    transaction.commit()
+    return time.time() - start
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    opts, args = getopt.getopt(args, 'n:r:f:h')
+    n = 10000
+    repeat = 5
+    path = None
+    for o, v in opts:
+        if o == '-n':
+            n = int(v)
+        elif o == '-r':
+            repeat = int(v)
+        elif o == '-f':
+            path = v
+        elif o == '-h':
+            print(__doc__)
+            return
+    if args:
+        print(__doc__)
+        sys.exit(2)
+
+    if path is None:
+        storage = MappingStorage()
+    else:
+        for suffix in ('', '.index', '.tmp', '.lock'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        storage = FileStorage(path)
+    db = ZODB.DB(storage)
+    conn = db.open()
+    root = conn.root()
+    root['objects'] = objects = [PersistentMapping(title=str(i), count=0)
+                                 for i in range(n)]
+    print("%d objects per transaction" % n)
+    print("%-10s %10s %10s" % ('commit', 'seconds', 'us/object'))
+    elapsed = timed_commit()
+    print("%-10s %10.3f %10.1f" % ('add', elapsed, elapsed * 1e6 / n))
+
+    for i in range(repeat):
+        for obj in objects:
+            obj['count'] += 1
+        elapsed = timed_commit()
+        print("%-10s %10.3f %10.1f" % ('modify', elapsed, elapsed * 1e6 / n))
+
+    for i in range(repeat):
+        writer = ObjectWriter(jar=conn)
+        start = time.time()
+        for obj in objects:
+            writer.serialize(obj)
+        elapsed = time.time() - start
+        print("%-10s %10.3f %10.1f"
+              % ('serialize', elapsed, elapsed * 1e6 / n))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
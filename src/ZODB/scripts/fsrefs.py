@@ -25,7 +25,9 @@ It's hard to explain exactly what it does because it relies on undocumented
 features in Python's cPickle module:  many of the crucial steps of loading
 an object are taken, but application objects aren't actually created.  This
 saves a lot of time, and allows fsrefs to be run even if the code
-implementing the object classes isn't available.
+implementing the object classes isn't available.  If the FileStorage
+keeps a reference index (a .refs file), the references are read from it
+instead.
 
 A read-only connection to the specified FileStorage is made, but it is not
 recommended to run fsrefs against a live FileStorage.  Because a live
@@ -62,6 +64,7 @@ revisions of objects; therefore fsrefs cannot find problems in versions or
 in non-current revisions.
 """
 from __future__ import print_function
+import os
 import traceback
 
 from ZODB.FileStorage import FileStorage
@@ -105,7 +108,10 @@ def main(path=None):
         path, = args
 
 
-    fs = FileStorage(path, read_only=1)
+    # Without a saved reference index, the read-only storage would have
+    # to build one in memory, so we read the records one at a time.
+    use_index = os.path.exists(path + '.refs')
+    fs = FileStorage(path, read_only=1, reference_index=use_index)
 
     # Set of oids in the index that failed to load due to POSKeyError.
     # This is what happens if undo is applied to the transaction creating
@@ -135,12 +141,14 @@ def main(path=None):
     for oid in fs._index.keys():
         if oid in inactive:
             continue
-        data, serial = fs.load(oid, "")
-        refs = get_refs(data)
+        if use_index:
+            data = None
+            refs = [(ref, None) for ref in fs.getReferences(oid)]
+        else:
+            data, serial = fs.load(oid, "")
+            refs = get_refs(data)
         missing = [] # contains 3-tuples of oid, klass-metadata, reason
         for ref, klass in refs:
-            if klass is None:
-                klass = '<unknown>'
             if ref not in fs._index:
                 missing.append((ref, klass, "missing"))
             if ref in noload:
@@ -148,7 +156,14 @@ def main(path=None):
             if ref in undone:
                 missing.append((ref, klass, "object creation was undone"))
         if missing:
-            report(oid, data, serial, missing)
+            if data is None:
+                data, serial = fs.load(oid, "")
+                klasses = dict(get_refs(data))
+                missing = [(ref, klasses.get(ref), reason)
+                           for ref, klass, reason in missing]
+            report(oid, data, serial,
+                   [(ref, klass or '<unknown>', reason)
+                    for ref, klass, reason in missing])
 
 if __name__ == "__main__":
     main()
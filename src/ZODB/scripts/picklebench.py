@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Compare the pickle protocols for the records of a FileStorage
+
+usage: picklebench.py [options] Data.fs
+
+The current data records of the storage are pickled again with each of
+the protocols supported, as with the pickle_protocol database option.
+The total size of the records and the times taken to pickle and
+unpickle them are printed for each protocol.  The references and class
+names found in the records are checked to be the same.  Protocols below
+the default one are only listed for comparison, they can't be used for
+records on Python 3.  The classes of the records must be importable.
+
+Options:
+
+    -n n    Number of records to read (default 100000, 0 for all)
+
+    -r n    Number of times to pickle and unpickle each record
+            (default 3)
+"""
+from __future__ import print_function
+
+import getopt
+import sys
+import time
+
+from ZODB._compat import BytesIO, HIGHEST_PROTOCOL, Pickler, Unpickler
+from ZODB._compat import _protocol
+from ZODB.broken import find_global
+from ZODB.FileStorage import FileStorage
+from ZODB.serialize import referencesf
+from ZODB.utils import get_pickle_metadata
+
+
+def load(p, persistent_load=None):
+    if persistent_load is None:
+        persistent_load = lambda reference: reference
+    u = Unpickler(BytesIO(p))
+    u.persistent_load = persistent_load
+    u.find_global = find_global
+    return u.load(), u.load()
+
+
+def dump(records, protocol):
+    f = BytesIO()
+    p = Pickler(f, protocol)
+    p.persistent_id = p.inst_persistent_id = lambda ob: (
+        ob.reference if isinstance(ob, Reference) else None)
+    for meta, state in records:
+        f.seek(0)
+        f.truncate()
+        p.clear_memo()
+        p.dump(meta)
+        p.dump(state)
+        yield f.getvalue()
+
+
+class Reference(object):
+
+    def __init__(self, reference):
+        self.reference = reference
+
+
+def read_records(path, limit):
+    storage = FileStorage(path, read_only=True)
+    records = []
+    try:
+        for oid in storage._index:
+            records.append(storage.load(oid, '')[0])
+            if len(records) == limit:
+                break
+    finally:
+        storage.close()
+    return records
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    opts, args = getopt.getopt(args, 'n:r:h')
+    limit = 100000
+    repeat = 3
+    for o, v in opts:
+        if o == '-n':
+            limit = int(v)
+        elif o == '-r':
+            repeat = int(v)
+        elif o == '-h':
+            print(__doc__)
+            return
+    if len(args) != 1:
+        print(__doc__)
+        sys.exit(2)
+
+    records = read_records(args[0], limit)
+    states = [load(p, Reference) for p in records]
+    print("%d records" % len(records))
+    print("%-9s %12s %10s %10s" % ('protocol', 'bytes', 'dump', 'load'))
+    for protocol in range(1, HIGHEST_PROTOCOL + 1):
+        start = time.time()
+        for i in range(repeat):
+            pickles = list(dump(states, protocol))
+        dumped = time.time() - start
+        start = time.time()
+        for i in range(repeat):
+            for p in pickles:
+                load(p)
+        loaded = time.time() - start
+        for old, new in zip(records, pickles):
+            if protocol < _protocol:
+                break
+            if (referencesf(old) != referencesf(new)
+                or get_pickle_metadata(old) != get_pickle_metadata(new)):
+                print("Different references or class for record", repr(old))
+                sys.exit(1)
+        print("%-9s %12d %10.3f %10.3f"
+              % (protocol, sum(len(p) for p in pickles), dumped, loaded))
+
+
+if __name__ == '__main__':
+    main()
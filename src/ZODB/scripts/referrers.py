@@ -19,9 +19,17 @@ $Id$
 from ZODB.serialize import referencesf
 
 def referrers(storage):
+    # The references of current records are taken from the reference
+    # index of FileStorages keeping one.
+    references = getattr(storage, '_references', None)
     result = {}
     for transaction in storage.iterator():
         for record in transaction:
-            for oid in referencesf(record.data):
+            refs = None
+            if references is not None:
+                refs = references.get(record.oid, record.pos)
+            if refs is None:
+                refs = referencesf(record.data)
+            for oid in refs:
                 result.setdefault(oid, []).append((record.oid, record.tid))
     return result
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Time finding the references in the records of a FileStorage
+
+usage: refsbench.py [options] Data.fs
+
+The current data records of the storage are read and the references
+in each of them are found with ZODB.serialize.referencesf and with
+plain noload(), how referencesf used to find them.  The results are
+checked to be the same and the times of both are printed, for all of
+the records and separately for the records without references.
+
+Options:
+
+    -n n    Number of records to read (default 100000, 0 for all)
+
+    -r n    Number of times to find the references of each record
+            (default 3)
+"""
+from __future__ import print_function
+
+import getopt
+import sys
+import time
+
+from ZODB._compat import Unpickler, BytesIO
+from ZODB.FileStorage import FileStorage
+from ZODB.serialize import referencesf
+
+
+def noload_referencesf(p):
+    refs = []
+    u = Unpickler(BytesIO(p))
+    u.persistent_load = refs.append
+    u.noload()
+    u.noload()
+    oids = []
+    for reference in refs:
+        if isinstance(reference, tuple):
+            oid = reference[0]
+        elif isinstance(reference, (bytes, str)):
+            oid = reference
+        else:
+            continue
+        if not isinstance(oid, bytes):
+            oid = oid.encode('ascii')
+        oids.append(oid)
+    return oids
+
+
+def read_records(path, limit):
+    storage = FileStorage(path, read_only=True)
+    records = []
+    try:
+        for oid in storage._index:
+            records.append(storage.load(oid, '')[0])
+            if len(records) == limit:
+                break
+    finally:
+        storage.close()
+    return records
+
+
+def timeit(f, records, repeat):
+    start = time.time()
+    for i in range(repeat):
+        for p in records:
+            f(p)
+    return time.time() - start
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    opts, args = getopt.getopt(args, 'n:r:h')
+    limit = 100000
+    repeat = 3
+    for o, v in opts:
+        if o == '-n':
+            limit = int(v)
+        elif o == '-r':
+            repeat = int(v)
+        elif o == '-h':
+            print(__doc__)
+            return
+    if len(args) != 1:
+        print(__doc__)
+        sys.exit(2)
+
+    records = read_records(args[0], limit)
+    leaves = []
+    for p in records:
+        refs = noload_referencesf(p)
+        if referencesf(p) != refs:
+            print("Different references for record", repr(p))
+            sys.exit(1)
+        if not refs:
+            leaves.append(p)
+
+    print("%d records, %d bytes, %d without references"
+          % (len(records), sum(len(p) for p in records), len(leaves)))
+    print("%-14s %12s %12s %8s" % ('records', 'noload', 'referencesf',
+                                   'speedup'))
+    for name, group in (('all', records), ('no references', leaves)):
+        before = timeit(noload_referencesf, group, repeat)
+        after = timeit(referencesf, group, repeat)
+        print("%-14s %12.3f %12.3f %7.1fx"
+              % (name, before, after, before / (after or 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
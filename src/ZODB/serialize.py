@@ -140,7 +140,8 @@ from persistent import Persistent
 from persistent.wref import WeakRefMarker, WeakRef
 from ZODB import broken
 from ZODB.POSException import InvalidObjectReference
-from ZODB._compat import Pickler, Unpickler, BytesIO, _protocol
+from ZODB._compat import Pickler, Unpickler, NoloadUnpickler
+from ZODB._compat import BytesIO, _protocol
 
 
 _oidtypes = bytes, type(None)
@@ -166,13 +167,19 @@ class ObjectWriter:
     The ObjectWriter creates object pickles in the ZODB format.  It
     also detects new persistent objects reachable from the current
     object.
+
+    A connection uses one writer for all of the objects of a commit, so
+    the pickler, its buffer and the pickles of the class metadata of
+    each class are reused.
     """
 
     _jar = None
 
-    def __init__(self, obj=None):
+    def __init__(self, obj=None, jar=None, protocol=None):
         self._file = BytesIO()
-        self._p = Pickler(self._file, _protocol)
+        if protocol is None:
+            protocol = _protocol
+        self._p = Pickler(self._file, protocol)
         if sys.version_info[0] < 3:
             self._p.inst_persistent_id = self.persistent_id
             # PyPy uses a python implementation of cPickle in both Python 2
@@ -183,12 +190,21 @@ class ObjectWriter:
         else:
             self._p.persistent_id = self.persistent_id
         self._stack = []
+        # {class -> (class metadata pickle, pickler memo after it)}
+        self._class_pickles = {}
+        # {class -> whether it has __getnewargs__}
+        self._has_newargs = {}
         if obj is not None:
             self._stack.append(obj)
             jar = obj._p_jar
+        if jar is not None:
             assert myhasattr(jar, "new_oid")
             self._jar = jar
 
+    def push(self, obj):
+        """Add an object to the objects to serialize"""
+        self._stack.append(obj)
+
     def persistent_id(self, obj):
         """Return the persistent id for obj.
 
@@ -377,7 +393,12 @@ class ObjectWriter:
                     )
 
         klass = type(obj)
-        if hasattr(klass, '__getnewargs__'):
+        try:
+            has_newargs = self._has_newargs[klass]
+        except KeyError:
+            has_newargs = self._has_newargs[klass] = hasattr(
+                klass, '__getnewargs__')
+        if has_newargs:
             # We don't want to save newargs in object refs.
             # It's possible that __getnewargs__ is degenerate and
             # returns (), but we don't want to have to deghostify
@@ -404,12 +425,32 @@ class ObjectWriter:
         # We don't use __class__ here, because obj could be a persistent proxy.
         # We don't want to be fooled by proxies.
         klass = type(obj)
+        newargs = getattr(obj, "__getnewargs__", None)
+        if newargs is not None:
+            return self._dump(self._classmeta(klass, newargs),
+                              obj.__getstate__())
+
+        # Without newargs, the class metadata is the same for all of the
+        # instances of the class, so it's only pickled once.  The memo is
+        # restored too, since the state pickle may refer to the class.
+        try:
+            meta, memo = self._class_pickles[klass]
+        except KeyError:
+            meta, memo = self._class_pickles[klass] = self._dump_classmeta(
+                self._classmeta(klass, None))
+        state = obj.__getstate__()
+        self._file.seek(0)
+        self._file.write(meta)
+        self._p.memo = memo.copy()
+        self._p.dump(state)
+        self._file.truncate()
+        return self._file.getvalue()
 
+    def _classmeta(self, klass, newargs):
         # We want to serialize persistent classes by name if they have
         # a non-None non-empty module so as not to have a direct
         # ref. This is important when copying.  We probably want to
         # revisit this in the future.
-        newargs = getattr(obj, "__getnewargs__", None)
         if (isinstance(getattr(klass, '_p_oid', 0), _oidtypes)
               and klass.__module__):
             # This is a persistent class with a non-empty module.  This
@@ -425,8 +466,13 @@ class ObjectWriter:
         else:
             # Pickle format #2.
             meta = klass, newargs()
+        return meta
 
-        return self._dump(meta, obj.__getstate__())
+    def _dump_classmeta(self, classmeta):
+        self._file.seek(0)
+        self._p.clear_memo()
+        self._p.dump(classmeta)
+        return self._file.getvalue()[:self._file.tell()], self._p.memo.copy()
 
     def _dump(self, classmeta, state):
         # To reuse the existing BytesIO object, we must reset
@@ -464,26 +510,51 @@ class NewObjectIterator:
 
 class ObjectReader:
 
-    def __init__(self, conn=None, cache=None, factory=None):
+    def __init__(self, conn=None, cache=None, factory=None, classes=None):
         self._conn = conn
         self._cache = cache
         self._factory = factory
+        # {(module name, name) -> (global found by the factory, module)},
+        # possibly shared by the connections of a database, see
+        # DB._classCache().
+        if classes is None:
+            classes = {}
+        self._classes = classes
+        # Bound once rather than for each record.
+        self._find_global = self._get_class
+        self._persistent_loader = self._persistent_load
+        # Tells the connection's cache policy about references resolved
+        # to loaded objects in the cache.
+        self._cache_hit = getattr(conn, '_cache_hit', None)
 
     def _get_class(self, module, name):
-        return self._factory(self._conn, module, name)
+        try:
+            klass, source = self._classes[module, name]
+        except KeyError:
+            pass
+        else:
+            # Unless its module was removed or changed since.
+            if (sys.modules.get(source.__name__) is source
+                and getattr(source, klass.__name__, None) is klass):
+                return klass
+        klass = self._factory(self._conn, module, name)
+        # Broken classes aren't cached, their modules may be fixed.
+        if not (isinstance(klass, type) and issubclass(klass, broken.Broken)):
+            source = sys.modules.get(getattr(klass, '__module__', None))
+            attr = getattr(klass, '__name__', None)
+            if (source is not None and isinstance(attr, str)
+                and getattr(source, attr, None) is klass):
+                self._classes[module, name] = klass, source
+        return klass
+
+    def clearClassCache(self):
+        """Forget the globals found by the factory"""
+        self._classes.clear()
 
     def _get_unpickler(self, pickle):
-        file = BytesIO(pickle)
-        unpickler = Unpickler(file)
-        unpickler.persistent_load = self._persistent_load
-        factory = self._factory
-        conn = self._conn
-
-        def find_global(modulename, name):
-            return factory(conn, modulename, name)
-
-        unpickler.find_global = find_global
-
+        unpickler = Unpickler(BytesIO(pickle))
+        unpickler.persistent_load = self._persistent_loader
+        unpickler.find_global = self._find_global
         return unpickler
 
     loaders = {}
@@ -513,6 +584,8 @@ class ObjectReader:
 
         obj = self._cache.get(oid, None)
         if obj is not None:
+            if self._cache_hit is not None and obj._p_changed is not None:
+                self._cache_hit(obj)
             return obj
 
         if isinstance(klass, tuple):
@@ -538,7 +611,7 @@ class ObjectReader:
     def load_multi_persistent(self, database_name, oid, klass):
         conn = self._conn.get_connection(database_name)
         # TODO, make connection _cache attr public
-        reader = ObjectReader(conn, conn._cache, self._factory)
+        reader = ObjectReader(conn, conn._cache, self._factory, self._classes)
         return reader.load_persistent(oid, klass)
 
     loaders['m'] = load_multi_persistent
@@ -573,13 +646,15 @@ class ObjectReader:
             oid = oid.encode('ascii')
         obj = self._cache.get(oid, None)
         if obj is not None:
+            if self._cache_hit is not None and obj._p_changed is not None:
+                self._cache_hit(obj)
             return obj
         return self._conn.get(oid)
 
     def load_multi_oid(self, database_name, oid):
         conn = self._conn.get_connection(database_name)
         # TODO, make connection _cache attr public
-        reader = ObjectReader(conn, conn._cache, self._factory)
+        reader = ObjectReader(conn, conn._cache, self._factory, self._classes)
         return reader.load_oid(oid)
 
     loaders['n'] = load_multi_oid
@@ -635,6 +710,35 @@ class ObjectReader:
         obj.__setstate__(state)
 
 
+def _may_refer(p):
+    """Tell whether a record may refer to other objects
+
+    A record without a BINPERSID opcode byte can't refer to other
+    objects.  Looking for the byte is much faster than noload(), and
+    leaf objects, which make up most of a typical database, have no
+    references.  The text PERSID opcode is only used in protocol 0
+    pickles, which don't start with a PROTO opcode.
+    """
+    return not (p and b'Q' not in p and (p[:1] == b'\x80' or b'P' not in p))
+
+
+def _references(p):
+    """Return the persistent references in a record, as unpickled
+
+    Both pickles of records that may refer to other objects are
+    noloaded to collect the references.
+    """
+    if not _may_refer(p):
+        return []
+
+    refs = []
+    u = NoloadUnpickler(BytesIO(p))
+    u.persistent_load = refs.append
+    u.noload()
+    u.noload()
+    return refs
+
+
 def referencesf(p, oids=None):
     """Return a list of object ids found in a pickle
 
@@ -645,11 +749,7 @@ def referencesf(p, oids=None):
     Weak and multi-database references are not included.
     """
 
-    refs = []
-    u = Unpickler(BytesIO(p))
-    u.persistent_load = refs.append
-    u.noload()
-    u.noload()
+    refs = _references(p)
 
     # Now we have a list of referencs.  Need to convert to list of
     # oids:
@@ -687,11 +787,7 @@ def get_refs(a_pickle):
     klass information is None.
     """
 
-    refs = []
-    u = Unpickler(BytesIO(a_pickle))
-    u.persistent_load = refs.append
-    u.noload()
-    u.noload()
+    refs = _references(a_pickle)
 
     # Now we have a list of references.  Need to convert to list of
     # oids and class info:
@@ -702,7 +798,7 @@ def get_refs(a_pickle):
         if isinstance(reference, tuple):
             oid, klass = reference
         elif isinstance(reference, (bytes, str)):
-            data, klass = reference, None
+            oid, klass = reference, None
         else:
             assert isinstance(reference, list)
             continue
@@ -0,0 +1,156 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests of activation tracing.
+
+See ZODB/ActivationTracer.py
+"""
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+from zope.testing.loggingsupport import InstalledHandler
+
+import ZODB
+import ZODB.config
+from ZODB.MappingStorage import MappingStorage
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = InstalledHandler('ZODB.ActivationTracer')
+        self.db = ZODB.DB(MappingStorage(), activation_sample_rate=1)
+        conn = self.db.open()
+        conn.root()['folder'] = folder = PersistentMapping()
+        for i in range(10):
+            folder[i] = PersistentMapping(title=str(i))
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.handler.uninstall()
+        self.db.close()
+
+    def open(self):
+        conn = self.db.open()
+        conn.cacheMinimize()
+        return conn
+
+    def titles(self, folder):
+        return [folder[i]['title'] for i in sorted(folder)]
+
+    def test_off_by_default(self):
+        db = ZODB.DB(None)
+        conn = db.open()
+        conn.root()
+        self.assertEqual(conn.getActivationReport(), None)
+        conn.close()
+        db.close()
+
+    def test_sampling(self):
+        self.db.setActivationSampleRate(0)
+        self.assertEqual(self.db.getActivationSampleRate(), 0)
+        conn = self.open()
+        self.titles(conn.root()['folder'])
+        self.assertEqual(conn.getActivationReport(), None)
+        conn.close()
+
+    def test_n_plus_one(self):
+        conn = self.open()
+        folder = conn.root()['folder']
+        self.titles(folder)
+        report = conn.getActivationReport()
+        # The root, the folder and its items
+        self.assertEqual(report['activations'], 12)
+        self.assertTrue(report['load_time'] >= 0)
+
+        found, = report['n_plus_one']
+        self.assertEqual(found['parent'], folder._p_oid)
+        self.assertEqual(found['parent_class'],
+                         'persistent.mapping.PersistentMapping')
+        self.assertEqual(found['activations'], 10)
+        self.assertEqual(found['classes'],
+                         {'persistent.mapping.PersistentMapping': 10})
+        # The call site has the innermost frames outside of ZODB and
+        # persistent, here the ones of PersistentMapping's base class.
+        self.assertFalse([frame for frame in found['call_site']
+                          if 'ZODB/Connection.py' in frame])
+        self.assertTrue([frame for frame in found['call_site']
+                         if 'testActivationTracer.py' in frame
+                         and frame.endswith(', in titles')])
+
+        site = report['call_sites'][0]
+        self.assertEqual(site['activations'], 10)
+        self.assertEqual(site['call_site'], found['call_site'])
+        self.assertEqual(len(report['slowest']), 10)
+        times = [d['load_time'] for d in report['slowest']]
+        self.assertEqual(times, sorted(times, reverse=True))
+
+        # The pattern is logged when the connection is closed.
+        conn.close()
+        record, = self.handler.records
+        self.assertTrue(record.getMessage().startswith(
+            '10 objects referenced by persistent.mapping.PersistentMapping'))
+
+    def test_tracing_errors_dont_break_loads(self):
+        conn = self.open()
+        def activated(*args):
+            raise ValueError('tracing bug')
+        conn._activation_tracer.activated = activated
+        handler = InstalledHandler('ZODB.Connection')
+        try:
+            self.assertEqual(len(self.titles(conn.root()['folder'])), 10)
+        finally:
+            handler.uninstall()
+        messages = [record.getMessage() for record in handler.records]
+        self.assertEqual(len(messages), 12)
+        self.assertTrue(messages[0].startswith(
+            "Couldn't trace the activation of "))
+        conn.close()
+
+    def test_few_siblings_are_not_reported(self):
+        conn = self.open()
+        folder = conn.root()['folder']
+        folder[0]['title'], folder[1]['title']
+        report = conn.getActivationReport(clear=True)
+        self.assertEqual(report['activations'], 4)
+        self.assertEqual(report['n_plus_one'], [])
+        self.assertEqual(conn.getActivationReport()['activations'], 0)
+        conn.close()
+        self.assertEqual(self.handler.records, [])
+
+    def test_reset_by_open(self):
+        conn = self.open()
+        self.titles(conn.root()['folder'])
+        conn.close()
+        conn = self.open()
+        self.assertEqual(conn.getActivationReport()['activations'], 0)
+        conn.close()
+
+    def test_config(self):
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          activation-sample-rate .25
+          <mappingstorage/>
+        </zodb>
+        """)
+        self.assertEqual(db.getActivationSampleRate(), .25)
+        db.close()
+
+
+def test_suite():
+    return unittest.makeSuite(Tests)
+
+if __name__=='__main__':
+    unittest.main(defaultTest='test_suite')
@@ -21,7 +21,12 @@ $Id$
 import unittest
 import time
 
-from ZODB.ActivityMonitor import ActivityMonitor
+import transaction
+
+import ZODB
+from ZODB.ActivityMonitor import ActivityMonitor, Histogram
+from ZODB.ActivityMonitor import RingBufferActivityMonitor
+from ZODB.tests.MinPO import MinPO
 
 
 class FakeConnection:
@@ -99,9 +104,185 @@ class Tests(unittest.TestCase):
         self.assertTrue(div['start'] >= lastend)
         self.assertTrue(div['start'] < div['end'])
 
+    def testHistogram(self):
+        h = Histogram()
+        self.assertEqual(h.percentile(50), 0.0)
+        for i in range(90):
+            h.add(.00005)
+        for i in range(10):
+            h.add(.003)
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.buckets[0], 90)
+        self.assertEqual(h.percentile(50), .0001)
+        self.assertEqual(h.percentile(95), .003) # The max, within .0032
+        self.assertEqual(h.max, .003)
+        h.add(100)
+        self.assertEqual(h.buckets[-1], 1)
+        self.assertEqual(h.percentile(100), 100)
+
+        h2 = Histogram()
+        h2.add(.0002)
+        h.update(h2)
+        self.assertEqual(h.count, 102)
+        self.assertEqual(h.buckets[1], 1)
+        stats = h.getStatistics()
+        self.assertEqual(stats['count'], 102)
+        self.assertEqual(stats['buckets'][0], (.0001, 90))
+        self.assertEqual(stats['buckets'][-1], (None, 1))
+
+    def testTransferStatistics(self):
+        db = ZODB.DB(None)
+        am = ActivityMonitor()
+        db.setActivityMonitor(am)
+        conn = db.open()
+        conn.root()['a'] = MinPO('x' * 100)
+        transaction.commit()
+        stats = conn.getTransferStatistics()
+        self.assertEqual(stats['stores'], 2)
+        self.assertTrue(stats['store_bytes'] > 100)
+        loads1 = stats['loads']
+        conn.close()
+
+        conn = db.open()
+        self.assertEqual(conn.getTransferStatistics()['stores'], 0)
+        a = conn.root()['a'] # root() is a get(), and a hit
+        conn.cacheMinimize()
+        a.value
+        conn.get(a._p_oid)
+        stats = conn.getTransferStatistics()
+        self.assertEqual((stats['loads'], stats['misses'], stats['hits']),
+                         (1, 1, 2))
+        self.assertEqual(stats['load_time']['count'], 1)
+        self.assertTrue(stats['load_bytes'] > 100)
+        info, = [i for i in db.connectionDebugInfo() if i['opened']]
+        self.assertEqual(info['transfer']['loads'], 1)
+
+        # Invalidations are counted when they're applied.
+        tm2 = transaction.TransactionManager()
+        conn2 = db.open(tm2)
+        conn2.root()['a'].value = 'y'
+        tm2.commit()
+        transaction.begin()
+        self.assertEqual(conn.getTransferStatistics()['invalidations'], 1)
+        loads2 = conn2.getTransferStatistics()['loads']
+        conn2.close()
+        conn.close()
+
+        # The activity monitor sums up the statistics of closed
+        # connections.
+        stats = am.getTransferStatistics()
+        self.assertEqual(stats['stores'], 3)
+        self.assertEqual(stats['loads'], loads1 + 1 + loads2)
+        self.assertEqual(stats['load_time']['count'], stats['loads'])
+        self.assertEqual(stats['invalidations'], 1)
+        db.close()
+
+
+
+class RingBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000000.5
+        self.time = time.time
+        time.time = lambda: self.now
+
+    def tearDown(self):
+        time.time = self.time
+
+    def close(self, am, loads, stores):
+        c = FakeConnection()
+        c._transferred(loads, stores)
+        am.closedConnection(c)
+
+    def testActivityAnalysis(self):
+        am = RingBufferActivityMonitor(history_length=3600)
+        self.close(am, 1, 2)
+        self.now += 1
+        self.close(am, 3, 7)
+        res = am.getActivityAnalysis(divisions=10)
+        self.assertEqual(len(res), 10)
+        for div in res[:9]:
+            self.assertEqual((div['connections'], div['loads'],
+                              div['stores']), (0, 0, 0))
+        div = res[9]
+        self.assertEqual((div['connections'], div['loads'], div['stores'],
+                          div['commits']), (2, 4, 9, 0))
+        self.assertEqual(div['end'], self.now)
+
+        res = am.getActivityAnalysis(self.now - 2, self.now, divisions=2)
+        self.assertEqual([(div['loads'], div['stores']) for div in res],
+                         [(1, 2), (3, 7)])
+
+    def testOldActivityIsOverwritten(self):
+        am = RingBufferActivityMonitor(history_length=10)
+        self.close(am, 1, 2)
+        self.now += 5
+        self.close(am, 3, 7)
+        self.assertEqual(am.getActivitySummary()['loads'], 4)
+        self.now += 6
+        self.assertEqual(am.getActivitySummary()['loads'], 3)
+        # Reuse the slot of the first second.
+        self.now += 200 * am._size - 11
+        self.close(am, 5, 0)
+        self.assertEqual(am.getActivitySummary()['loads'], 5)
+
+    def testSetHistoryLength(self):
+        am = RingBufferActivityMonitor(history_length=3600)
+        self.close(am, 1, 2)
+        self.now += 10
+        self.close(am, 3, 7)
+        am.setHistoryLength(5)
+        self.assertEqual(am.getHistoryLength(), 5)
+        self.assertEqual(am.getActivitySummary()['loads'], 3)
+        am.setHistoryLength(3600)
+        self.assertEqual(am.getActivitySummary()['loads'], 3)
+        self.now += 1
+        self.close(am, 1, 0)
+        self.assertEqual(am.getActivitySummary()['loads'], 4)
+
+    def testPercentiles(self):
+        am = RingBufferActivityMonitor()
+        for i in range(100):
+            self.close(am, i + 1, 0)
+            if i % 10 == 9:
+                self.now += 1
+        summary = am.getActivitySummary()
+        self.assertEqual(summary['connections'], 100)
+        self.assertEqual(summary['loads'], 5050)
+        self.assertEqual(summary['loads_per_connection'],
+                         dict(p50=63, p95=127, p99=127))
+        self.assertEqual(summary['stores_per_connection'],
+                         dict(p50=0, p95=0, p99=0))
+
+    def testBucketsAndHistoryLength(self):
+        am = RingBufferActivityMonitor(history_length=2.5)
+        self.assertEqual(am._size, 4)
+        self.assertEqual(am.log, [])
+        self.assertEqual([am._bucket(n) for n in (0, 1, 2, 3, 4, 7, 8)],
+                         [0, 1, 2, 2, 3, 3, 4])
+        self.assertEqual(am._bucket(1 << 40), am.histogram_size - 1)
+
+    def testCommits(self):
+        db = ZODB.DB(None)
+        am = RingBufferActivityMonitor()
+        db.setActivityMonitor(am)
+        conn = db.open()
+        conn.root()['a'] = MinPO(1)
+        transaction.commit()
+        conn.root()['a'].value = 2
+        transaction.commit()
+        conn.close()
+        summary = am.getActivitySummary()
+        self.assertEqual((summary['connections'], summary['commits']),
+                         (1, 2))
+        self.assertEqual(am.getTransferStatistics()['commits'], 2)
+        db.close()
+
 
 def test_suite():
-    return unittest.makeSuite(Tests)
+    s = unittest.makeSuite(Tests)
+    s.addTest(unittest.makeSuite(RingBufferTests))
+    return s
 
 if __name__=='__main__':
     unittest.main(defaultTest='test_suite')
@@ -0,0 +1,238 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests of the blob cache.
+
+See ZODB/BlobCache.py
+"""
+import os
+import time
+import unittest
+
+import transaction
+
+import ZODB
+import ZODB.blob
+import ZODB.config
+import ZODB.POSException
+import ZODB.tests.util
+from ZODB.BlobCache import BlobCache
+from ZODB.FileStorage import FileStorage
+
+
+class Tests(ZODB.tests.util.TestCase):
+
+    def open(self, size=250, start=False):
+        fs = FileStorage('data.fs', blob_dir='blobs',
+                         blob_cache_dir='cache', blob_cache_size=size)
+        if not start:
+            # Clean up explicitly, rather than in the thread.
+            cache = fs.blob_cache
+            cache.close()
+            fs.blob_cache = BlobCache('cache', size, start=False)
+        self.db = ZODB.DB(fs)
+        self.fs = fs
+        self.cache = fs.blob_cache
+        return self.db.open().root()
+
+    def close(self):
+        self.db.close()
+
+    def populate(self, n=3):
+        root = self.open()
+        for i in range(n):
+            root[i] = blob = ZODB.blob.Blob()
+            with blob.open('w') as f:
+                f.write(str(i).encode() * 100)
+        transaction.commit()
+        return root
+
+    def cached(self, blob):
+        # Without loading the blob, which could copy it to the cache.
+        # It was committed by populate(), in the last transaction.
+        return os.path.exists(self.cache.fshelper.getBlobFilename(
+            blob._p_oid, self.fs.lastTransaction()))
+
+    def read(self, blob):
+        with blob.open() as f:
+            return f.read()
+
+    def test_loaded_from_cache(self):
+        root = self.populate()
+        blob = root[0]
+        # Copied to the cache when the blob is loaded, then opened there.
+        self.assertEqual(self.read(blob), b'0' * 100)
+        self.assertEqual(self.cache.getStatistics(), dict(
+            size_bytes=250, bytes=100, files=1, hits=1, misses=1,
+            evictions=0))
+        filename = blob.committed()
+        self.assertTrue(filename.startswith(os.path.abspath('cache')))
+        self.assertEqual(self.cache.hits, 2)
+        self.assertEqual(self.read(blob), b'0' * 100)
+        self.assertEqual(self.cache.hits, 3)
+        self.assertEqual(
+            filename[len(os.path.abspath('cache')):],
+            self.fs.fshelper.getBlobFilename(
+                blob._p_oid, blob._p_serial)[len(os.path.abspath('blobs')):])
+        self.close()
+
+    def test_least_recently_used_removed(self):
+        root = self.populate()
+        self.read(root[0])
+        self.read(root[1])
+        self.read(root[0])
+        self.read(root[2])
+        self.assertEqual(self.cache.getStatistics()['bytes'], 300)
+        self.assertEqual(self.cache.cleanup(), 1)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.getStatistics()['bytes'], 200)
+        self.assertEqual(
+            [self.cached(root[i]) for i in range(3)], [True, False, True])
+
+        # Copied again when needed
+        self.assertEqual(self.read(root[1]), b'1' * 100)
+        self.assertEqual(self.cache.misses, 4)
+        self.assertEqual(self.cache.cleanup(), 1)
+        self.assertEqual(
+            [self.cached(root[i]) for i in range(3)], [False, True, True])
+        self.assertEqual(self.cache.cleanup(), 0)
+        self.close()
+
+    def test_removed_by_someone_else(self):
+        root = self.populate()
+        blob = root[0]
+        os.remove(blob.committed())
+        self.assertEqual(self.read(blob), b'0' * 100)
+        self.assertEqual(self.cache.getStatistics()['bytes'], 100)
+        self.close()
+
+    def test_updated_after_eviction(self):
+        root = self.populate()
+        blob = root[0]
+        filename = blob.committed()
+        self.assertEqual(self.cache.cleanup(), 0)
+        self.cache.size_bytes = 0
+        self.assertEqual(self.cache.cleanup(), 1)
+        self.assertFalse(os.path.exists(filename))
+        # The committed data is copied from the storage again.
+        with blob.open('a') as f:
+            f.write(b'!')
+        transaction.commit()
+        self.assertEqual(self.read(blob), b'0' * 100 + b'!')
+        self.cache.cleanup()
+        self.assertTrue(os.path.exists(blob.committed()))
+        self.close()
+
+    def test_pruned_by_pack(self):
+        root = self.populate()
+        blob = root[0]
+        oid, tid = blob._p_oid, blob._p_serial
+        self.read(blob)
+        with blob.open('w') as f:
+            f.write(b'new')
+        transaction.commit()
+        self.assertEqual(self.read(blob), b'new')
+        self.assertEqual(len(self.cache), 2)
+        self.db.pack()
+        # The revision removed by the pack isn't served from the cache.
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.getStatistics()['bytes'], 3)
+        self.assertFalse(os.path.exists(
+            self.cache.fshelper.getBlobFilename(oid, tid)))
+        self.assertRaises(ZODB.POSException.POSKeyError,
+                          self.fs.loadBlob, oid, tid)
+        self.assertEqual(self.read(blob), b'new')
+        self.close()
+
+    def test_cleanup_thread(self):
+        root = self.populate()
+        self.close()
+        root = self.open(start=True)
+        for i in range(3):
+            self.read(root[i])
+        for i in range(100):
+            if self.cache.evictions:
+                break
+            time.sleep(.01)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(len(self.cache), 2)
+        self.assertFalse(self.cached(root[0]))
+        self.close()
+
+    def test_index_saved(self):
+        root = self.populate()
+        self.read(root[1])
+        self.read(root[0])
+        self.close()
+
+        root = self.open()
+        self.assertEqual(self.cache.getStatistics()['bytes'], 200)
+        self.read(root[2])
+        self.assertEqual(self.cache.cleanup(), 1)
+        self.assertEqual(
+            [self.cached(root[i]) for i in range(3)], [True, False, True])
+        self.assertEqual(self.read(root[0]), b'0' * 100)
+        self.assertEqual(self.cache.hits, 3)
+        self.assertEqual(self.cache.misses, 1)
+        self.close()
+
+        # Without index, what was cached is removed.
+        os.remove(os.path.join('cache', BlobCache.index_name))
+        root = self.open()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(
+            [os.listdir(path) for oid, path in self.cache.fshelper.listOIDs()
+             if os.listdir(path)], [])
+        self.assertEqual(self.read(root[0]), b'0' * 100)
+        self.close()
+
+    def test_size_required(self):
+        self.assertRaises(ValueError, FileStorage, 'data.fs',
+                          blob_dir='blobs', blob_cache_dir='cache')
+
+    def test_config(self):
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          <filestorage>
+            path data.fs
+            blob-dir blobs
+            blob-cache-dir cache
+            blob-cache-size 1MB
+          </filestorage>
+        </zodb>
+        """)
+        self.assertEqual(db.storage.blob_cache.size_bytes, 1 << 20)
+        db.close()
+
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          <blobstorage>
+            blob-dir blobs2
+            blob-cache-dir cache2
+            blob-cache-size 1KB
+            <mappingstorage/>
+          </blobstorage>
+        </zodb>
+        """)
+        self.assertEqual(db.storage.blob_cache.size_bytes, 1 << 10)
+        db.close()
+        self.assertTrue(os.path.exists(
+            os.path.join('cache2', BlobCache.index_name)))
+
+
+def test_suite():
+    return unittest.makeSuite(Tests)
+
+if __name__=='__main__':
+    unittest.main(defaultTest='test_suite')
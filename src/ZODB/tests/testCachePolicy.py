@@ -0,0 +1,217 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests of the connection cache policies.
+
+See ZODB/CachePolicy.py
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+import six
+import transaction
+from persistent.mapping import PersistentMapping
+
+import ZODB
+import ZODB.config
+from ZODB.CachePolicy import LRUPolicy, TwoQueuePolicy, SizeAwareLFUPolicy
+from ZODB.MappingStorage import MappingStorage
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = MappingStorage()
+        db = ZODB.DB(self.storage)
+        conn = db.open()
+        self.objects = []
+        for i in range(60):
+            obj = PersistentMapping(data=b'x' * 100)
+            conn.add(obj)
+            self.objects.append(obj._p_oid)
+        # One big object.
+        obj = PersistentMapping(data=b'x' * 5000)
+        conn.add(obj)
+        self.big = obj._p_oid
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.storage.close()
+
+    def open(self, **kw):
+        db = ZODB.DB(self.storage, **kw)
+        conn = db.open()
+        conn.cacheMinimize()
+        return db, conn
+
+    def use(self, conn, oids):
+        for oid in oids:
+            conn.get(oid)._p_activate()
+        conn.cacheGC()
+
+    def scan(self, conn, oids):
+        for i in range(0, len(oids), 5):
+            self.use(conn, oids[i:i+5])
+
+    def resident(self, conn, oids):
+        return len([oid for oid in oids
+                    if conn.get(oid)._p_changed is not None])
+
+    def test_default(self):
+        db, conn = self.open()
+        self.assertEqual(db.getCachePolicy(), 'lru')
+        self.assertTrue(isinstance(conn._cache_policy, LRUPolicy))
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, ZODB.DB, self.storage,
+                          cache_policy='nope')
+
+    def test_policy_factory(self):
+        db, conn = self.open(cache_policy=SizeAwareLFUPolicy)
+        self.assertEqual(db.getCachePolicy(), 'lfu')
+        self.assertTrue(isinstance(conn._cache_policy, SizeAwareLFUPolicy))
+
+    def test_config(self):
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          cache-policy 2q
+          <mappingstorage/>
+        </zodb>
+        """)
+        self.assertEqual(db.getCachePolicy(), '2q')
+        conn = db.open()
+        self.assertTrue(isinstance(conn._cache_policy, TwoQueuePolicy))
+        db.close()
+
+    def test_lru_is_not_scan_resistant(self):
+        db, conn = self.open(cache_size=20)
+        hot, cold = self.objects[:10], self.objects[10:]
+        self.use(conn, hot)
+        self.use(conn, hot)
+        self.scan(conn, cold)
+        self.assertEqual(self.resident(conn, hot), 0)
+
+    def test_2q_is_scan_resistant(self):
+        db, conn = self.open(cache_size=20, cache_policy='2q')
+        hot, cold = self.objects[:10], self.objects[10:]
+        self.use(conn, hot)
+        self.use(conn, hot)
+        self.scan(conn, cold)
+        self.assertEqual(self.resident(conn, hot), 10)
+        self.assertTrue(conn._cache.cache_non_ghost_count <= 20)
+
+    def test_2q_promotes_objects_reloaded_after_eviction(self):
+        db, conn = self.open(cache_size=20, cache_policy='2q')
+        self.scan(conn, self.objects[:30])
+        self.assertEqual(self.resident(conn, self.objects[:10]), 0)
+        policy = conn._cache_policy
+        self.use(conn, self.objects[:5])
+        self.assertEqual(set(self.objects[:5]) - set(policy._hot), set())
+
+    def test_references_resolved_from_the_cache_are_hits(self):
+        db, conn = self.open(cache_policy='2q')
+        parent = PersistentMapping(
+            children=[conn.get(oid) for oid in self.objects[:5]])
+        conn.add(parent)
+        transaction.commit()
+        db, conn = self.open(cache_policy='2q')
+        parent = conn.get(parent._p_oid)
+        self.use(conn, [parent._p_oid] + self.objects[:5])
+        parent._p_deactivate()
+        parent._p_activate()
+        policy = conn._cache_policy
+        self.assertEqual(policy.hits, 5)
+        self.assertEqual(set(self.objects[:5]) - set(policy._hot), set())
+
+    def test_objects_the_policy_doesnt_know_are_evicted(self):
+        for policy in '2q', 'lfu':
+            db, conn = self.open(cache_size=5, cache_policy=policy)
+            for i in range(10):
+                conn.add(PersistentMapping())
+            transaction.commit()
+            conn.cacheGC()
+            self.assertEqual(conn._cache.cache_non_ghost_count, 5)
+
+    def test_lfu_evicts_big_objects_first(self):
+        db, conn = self.open(cache_size_bytes=6000, cache_policy='lfu')
+        self.use(conn, self.objects[:20] + [self.big])
+        self.assertEqual(self.resident(conn, [self.big]), 0)
+        self.assertEqual(self.resident(conn, self.objects[:20]), 20)
+
+        db, conn = self.open(cache_size_bytes=6000)
+        self.use(conn, self.objects[:20] + [self.big])
+        self.assertEqual(self.resident(conn, [self.big]), 1)
+
+    def test_lfu_keeps_frequently_used_objects(self):
+        db, conn = self.open(cache_size=20, cache_policy='lfu')
+        hot, cold = self.objects[:10], self.objects[10:]
+        # Priorities age as objects are evicted, so it takes a few uses
+        # to outlast a scan through 2.5 times the cache size.
+        for i in range(10):
+            self.use(conn, hot)
+        self.scan(conn, cold)
+        self.assertEqual(self.resident(conn, hot), 10)
+
+    def test_modified_objects_are_not_evicted(self):
+        for policy in '2q', 'lfu':
+            db, conn = self.open(cache_size=5, cache_policy=policy)
+            for oid in self.objects[:10]:
+                conn.get(oid)['data'] = b'y'
+            conn.cacheGC()
+            self.assertEqual(conn._cache.cache_non_ghost_count, 10)
+            transaction.abort()
+
+    def test_statistics(self):
+        db, conn = self.open(cache_size=20, cache_policy='2q')
+        self.use(conn, self.objects[:30])
+        self.use(conn, self.objects[25:30])
+        stats = conn._cache_policy.getStatistics()
+        self.assertEqual(stats, dict(policy='2q', hits=5, misses=30,
+                                     evictions=10))
+        self.assertEqual(db.getCachePolicyStatistics(), {
+            '2q': dict(connections=1, hits=5, misses=30, evictions=10)})
+        details, = db.cacheDetailSize()
+        self.assertEqual(details['policy'], stats)
+
+    def test_benchmark(self):
+        from ZODB.scripts.cachepolicies import main
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write("# A trace\n")
+            for i in range(50):
+                f.write("%s 200\n" % (i % 10))
+            f.write("\n")
+            for i in range(100):
+                f.write("%s\n" % (i + 10))
+        stdout = sys.stdout
+        sys.stdout = out = six.StringIO()
+        try:
+            main(['-c', '20', '-g', '5', '-p', 'lru', '-p', '2q', path])
+        finally:
+            sys.stdout = stdout
+            os.remove(path)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "150 accesses to 110 objects, "
+                         "cache size 20 objects, 0 bytes")
+        self.assertEqual([line.split()[0] for line in lines[1:]],
+                         ['policy', 'lru', '2q'])
+
+
+def test_suite():
+    return unittest.makeSuite(Tests)
+
+if __name__=='__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,164 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests of commit phase timing.
+
+See ZODB/CommitStatistics.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+from zope.testing.loggingsupport import InstalledHandler
+
+import ZODB
+import ZODB.config
+from ZODB.FileStorage import FileStorage
+from ZODB.tests.ConflictResolution import PCounter
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.handler = InstalledHandler('ZODB.CommitStatistics')
+
+    def tearDown(self):
+        self.handler.uninstall()
+        shutil.rmtree(self.dir)
+
+    def open(self, name='data.fs', **kw):
+        storage = FileStorage(os.path.join(self.dir, name))
+        self.addCleanup(storage.close)
+        return ZODB.DB(storage, **kw)
+
+    def test_off_by_default(self):
+        db = self.open()
+        self.assertEqual(db.getCommitStatistics(), None)
+        conn = db.open()
+        conn.root()['x'] = 1
+        transaction.commit()
+        self.assertEqual(conn._commit_timing, None)
+
+    def test_phases(self):
+        db = self.open(commit_timing=True)
+        conn = db.open()
+        conn.root()['a'] = PersistentMapping()
+        conn.root()['b'] = PersistentMapping()
+        transaction.commit()
+
+        stats = db.getCommitStatistics()
+        self.assertEqual(stats['commits'], 1)
+        self.assertEqual(stats['aborts'], 0)
+        self.assertEqual(stats['slow'], 0)
+        self.assertEqual(stats['total']['count'], 1)
+        phases = stats['phases']
+        for name in ('tpc_begin', 'commit_lock_wait', 'commit', 'tpc_vote',
+                     'tpc_finish', 'invalidation', 'storage_finish', 'fsync'):
+            self.assertEqual(phases[name]['count'], 1, name)
+        # Times are summed over the 3 objects stored.
+        self.assertEqual(phases['serialize']['count'], 1)
+        self.assertEqual(phases['store']['count'], 1)
+        self.assertEqual(phases['conflict_resolution']['count'], 0)
+        self.assertTrue(phases['tpc_finish']['total'] >=
+                        phases['storage_finish']['total'] >=
+                        phases['fsync']['total'])
+        self.assertEqual(conn._commit_timing, None)
+
+    def test_aborts(self):
+        db = self.open(commit_timing=True)
+        conn = db.open()
+        conn.root()['x'] = 1
+        t = transaction.get()
+        conn.tpc_begin(t)
+        conn.commit(t)
+        conn.tpc_abort(t)
+        transaction.abort()
+        stats = db.getCommitStatistics()
+        self.assertEqual((stats['commits'], stats['aborts']), (0, 1))
+        self.assertEqual(conn._commit_timing, None)
+
+    def test_conflict_resolution(self):
+        db = self.open(commit_timing=True)
+        tm1 = transaction.TransactionManager()
+        conn1 = db.open(tm1)
+        conn1.root()['counter'] = counter = PCounter()
+        counter.inc()
+        tm1.commit()
+        tm2 = transaction.TransactionManager()
+        conn2 = db.open(tm2)
+        conn2.root()['counter'].inc()
+        conn1.root()['counter'].inc()
+        tm1.commit()
+        conn2.root()['counter'].inc()
+        tm2.commit()
+        phases = db.getCommitStatistics()['phases']
+        self.assertEqual(phases['conflict_resolution']['count'], 1)
+
+    def test_slow_commits_are_logged(self):
+        db = self.open(slow_commit_threshold=0)
+        conn = db.open()
+        conn.root()['a'] = PersistentMapping()
+        conn.root()['b'] = PersistentMapping()
+        t = transaction.get()
+        t.note(u'slow')
+        t.commit()
+        self.assertEqual(db.getCommitStatistics()['slow'], 1)
+        record, = self.handler.records
+        message = record.getMessage()
+        self.assertTrue("phases: tpc_begin=" in message)
+        self.assertTrue("fsync=" in message)
+        self.assertTrue("objects: persistent.mapping.PersistentMapping=3"
+                        in message)
+
+        db = self.open('fast.fs', slow_commit_threshold=60)
+        conn = db.open()
+        conn.root()['a'] = 1
+        transaction.commit()
+        self.assertEqual(db.getCommitStatistics()['slow'], 0)
+        self.assertEqual(len(self.handler.records), 1)
+
+    def test_config(self):
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          slow-commit-threshold 0.5
+          <mappingstorage/>
+        </zodb>
+        """)
+        stats = db.getCommitStatistics()
+        self.assertEqual(stats['slow_threshold'], 0.5)
+        db.close()
+
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          commit-timing true
+          <mappingstorage/>
+        </zodb>
+        """)
+        conn = db.open()
+        conn.root()['x'] = 1
+        transaction.commit()
+        stats = db.getCommitStatistics()
+        self.assertEqual(stats['slow_threshold'], None)
+        self.assertEqual(stats['commits'], 1)
+        db.close()
+
+
+def test_suite():
+    return unittest.makeSuite(Tests)
+
+if __name__=='__main__':
+    unittest.main(defaultTest='test_suite')
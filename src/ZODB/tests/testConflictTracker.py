@@ -0,0 +1,182 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests of conflict tracking.
+
+See ZODB/ConflictTracker.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+
+import ZODB
+import ZODB.config
+import ZODB.ConflictTracker
+from ZODB.ConflictTracker import ConflictTracker
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError, ReadConflictError
+from ZODB.tests.ConflictResolution import PCounter
+
+
+class TrackerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.timer = ZODB.ConflictTracker.timer
+        ZODB.ConflictTracker.timer = lambda: self.now
+
+    def tearDown(self):
+        ZODB.ConflictTracker.timer = self.timer
+
+    def test_report(self):
+        tracker = ConflictTracker(60)
+        for i in range(3):
+            tracker.conflict(b'1', 'app.Counter')
+        tracker.resolved(b'1', 'app.Counter')
+        tracker.read_conflict(b'2', 'app.Folder')
+        tracker.read_conflict(b'2', 'app.Folder')
+        tracker.conflict(b'3', 'app.Counter')
+        tracker.conflict(None, None)
+
+        report = tracker.getReport(2)
+        self.assertEqual(
+            (report['window'], report['conflicts'], report['resolved'],
+             report['read_conflicts']),
+            (60, 5, 1, 2))
+        self.assertEqual(report['objects'], [
+            dict(oid=b'1', class_name='app.Counter',
+                 conflicts=3, resolved=1, read_conflicts=0),
+            dict(oid=b'2', class_name='app.Folder',
+                 conflicts=0, resolved=0, read_conflicts=2),
+            ])
+        self.assertEqual(report['classes'], [
+            dict(class_name='app.Counter',
+                 conflicts=4, resolved=1, read_conflicts=0),
+            dict(class_name='app.Folder',
+                 conflicts=0, resolved=0, read_conflicts=2),
+            ])
+
+    def test_window(self):
+        tracker = ConflictTracker(60)
+        tracker.conflict(b'1', 'app.Counter')
+        self.now += 30
+        tracker.conflict(b'2', 'app.Counter')
+        self.now += 31
+        report = tracker.getReport()
+        self.assertEqual(report['conflicts'], 1)
+        self.assertEqual([o['oid'] for o in report['objects']], [b'2'])
+        self.assertEqual(report['classes'][0]['conflicts'], 1)
+
+        tracker.setWindow(10)
+        self.assertEqual(tracker.getReport()['conflicts'], 0)
+        self.assertEqual(tracker.objects, {})
+        self.assertEqual(tracker.classes, {})
+
+    def test_max_events(self):
+        tracker = ConflictTracker()
+        tracker.max_events = 5
+        for i in range(10):
+            tracker.conflict(b'1', 'app.Counter')
+        self.assertEqual(tracker.getReport()['objects'][0]['conflicts'], 5)
+        tracker.clear()
+        self.assertEqual(tracker.getReport()['conflicts'], 0)
+
+
+class DBTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, storage=None):
+        if storage is None:
+            storage = FileStorage(os.path.join(self.dir, 'data.fs'))
+        db = ZODB.DB(storage)
+        self.addCleanup(db.close)
+        tm1 = transaction.TransactionManager()
+        tm2 = transaction.TransactionManager()
+        conn1 = db.open(tm1)
+        conn1.root()['counter'] = counter = PCounter()
+        counter.inc()
+        conn1.root()['data'] = PersistentMapping()
+        tm1.commit()
+        conn2 = db.open(tm2)
+        return db, (tm1, conn1.root()), (tm2, conn2.root())
+
+    def test_write_conflicts(self):
+        db, (tm1, root1), (tm2, root2) = self.open()
+        root1['data']['x'] = 1
+        root2['data']['x'] = 2
+        tm1.commit()
+        self.assertRaises(ConflictError, tm2.commit)
+        tm2.abort()
+        report = db.getConflictReport()
+        self.assertEqual(report['conflicts'], 1)
+        obj, = report['objects']
+        self.assertEqual(obj['oid'], root1['data']._p_oid)
+        self.assertEqual(obj['class_name'],
+                         'persistent.mapping.PersistentMapping')
+
+    def test_resolved_conflicts(self):
+        db, (tm1, root1), (tm2, root2) = self.open()
+        root1['counter'].inc()
+        root2['counter'].inc()
+        tm1.commit()
+        tm2.commit()
+        report = db.getConflictReport()
+        self.assertEqual((report['conflicts'], report['resolved']), (0, 1))
+        self.assertEqual(report['classes'], [dict(
+            class_name='ZODB.tests.ConflictResolution.PCounter',
+            conflicts=0, resolved=1, read_conflicts=0)])
+
+    def test_read_conflicts(self):
+        db, (tm1, root1), (tm2, root2) = self.open(MappingStorage())
+        root2['data']._p_activate()
+        root2._p_jar.readCurrent(root2['data'])
+        root2['counter'].inc()
+        root1['data']['x'] = 1
+        tm1.commit()
+        self.assertRaises(ReadConflictError, tm2.commit)
+        tm2.abort()
+        report = db.getConflictReport()
+        self.assertEqual(report['read_conflicts'], 1)
+        self.assertEqual(report['objects'][0]['class_name'],
+                         'persistent.mapping.PersistentMapping')
+
+    def test_config(self):
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          conflict-window 5m
+          <mappingstorage/>
+        </zodb>
+        """)
+        self.assertEqual(db.getConflictWindow(), 300)
+        db.setConflictWindow(60)
+        self.assertEqual(db.getConflictReport()['window'], 60)
+        db.close()
+
+
+def test_suite():
+    suite = unittest.makeSuite(TrackerTests)
+    suite.addTest(unittest.makeSuite(DBTests))
+    return suite
+
+if __name__=='__main__':
+    unittest.main(defaultTest='test_suite')
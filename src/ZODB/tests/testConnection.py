@@ -22,6 +22,9 @@ import unittest
 import transaction
 import ZODB.tests.util
 from ZODB.config import databaseFromString
+from ZODB.CachePolicy import LRUPolicy
+from ZODB.ConflictTracker import ConflictTracker
+from ZODB.DB import InvalidationLog
 from ZODB.utils import p64
 from persistent import Persistent
 from zope.interface.verify import verifyObject
@@ -1315,14 +1318,23 @@ class StubDatabase:
     def __init__(self):
         self.storage = StubStorage()
         self.new_oid = self.storage.new_oid
+        self._invalidation_log = InvalidationLog()
 
     classFactory = None
+    _cache_policy = LRUPolicy
+    _commit_statistics = None
+    _activation_sample_rate = 0
+    pickle_protocol = None
+    _conflict_tracker = ConflictTracker()
     database_name = 'stubdatabase'
     databases = {'stubdatabase': database_name}
 
     def invalidate(self, transaction, dict_with_oid_keys, connection):
         pass
 
+    def _classCache(self):
+        return {}
+
     large_record_size = 1<<30
 
 def test_suite():
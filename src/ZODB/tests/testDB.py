@@ -21,6 +21,7 @@ import time
 import transaction
 import unittest
 import ZODB
+import ZODB.config
 import ZODB.tests.util
 from zope.testing import renormalizing
 
@@ -75,6 +76,64 @@ class DBTests(ZODB.tests.util.TestCase):
         import ZODB.serialize
         self.assertTrue(self.db.references is ZODB.serialize.referencesf)
 
+    def test_withdrawn_connection_restored_to_waiter(self):
+        import threading
+        db = ZODB.DB(None, pool_size=1, pool_limit=1)
+        tm = transaction.TransactionManager()
+        c = db.open(tm)
+        c.close()
+        position = db.pool.withdraw(c)
+        self.assertEqual(db.pool.available, [])
+        got = []
+        thread = threading.Thread(target=lambda: got.append(db.open(tm)))
+        thread.start()
+        while not db.pool.waiters:
+            time.sleep(.01)
+        db._a()
+        try:
+            db.pool.restore(c, position)
+        finally:
+            db._r()
+        thread.join(10)
+        self.assertEqual(got, [c])
+        self.assertEqual(db.pool.available, [])
+        c.close()
+        c = db.open(tm)
+        self.assertEqual(db.pool.withdraw(c), None)
+        c.close()
+        db.close()
+
+    def test_pickle_protocol(self):
+        from ZODB._compat import HIGHEST_PROTOCOL, _protocol
+        from ZODB.utils import get_pickle_protocol, z64
+        self.assertEqual(self.db.pickle_protocol, _protocol)
+        db = ZODB.DB(None, pickle_protocol=HIGHEST_PROTOCOL)
+        conn = db.open()
+        conn.root()['a'] = a = MinPO(1)
+        transaction.commit()
+        for oid in (z64, a._p_oid):
+            p, serial = db.storage.load(oid)
+            self.assertEqual(get_pickle_protocol(p), HIGHEST_PROTOCOL)
+        self.assertEqual(db.references(db.storage.load(z64)[0]), [a._p_oid])
+        conn.close()
+        conn = db.open()
+        self.assertEqual(conn.root()['a'].value, 1)
+        conn.close()
+        db.close()
+
+        for protocol in (_protocol - 1, HIGHEST_PROTOCOL + 1):
+            self.assertRaises(ValueError, ZODB.DB, None,
+                              pickle_protocol=protocol)
+
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          pickle-protocol %s
+          <mappingstorage/>
+        </zodb>
+        """ % HIGHEST_PROTOCOL)
+        self.assertEqual(db.pickle_protocol, HIGHEST_PROTOCOL)
+        db.close()
+
 
 def test_invalidateCache():
     """The invalidateCache method invalidates a connection caches for all of
@@ -354,6 +413,313 @@ def minimally_test_connection_timeout():
 
     """
 
+def invalidations_are_read_from_a_shared_log():
+    """Committing appends a single entry to the database's invalidation
+    log rather than updating every connection.  Connections read the log
+    when they need to.
+
+    >>> db = ZODB.DB(None, invalidation_log_size=3)
+    >>> db.getInvalidationLogSize()
+    3
+    >>> tm1 = transaction.TransactionManager()
+    >>> c1 = db.open(tm1)
+    >>> tm2 = transaction.TransactionManager()
+    >>> c2 = db.open(tm2)
+    >>> c1.root.x = MinPO(1)
+    >>> tm1.commit()
+    >>> _ = tm2.begin()
+    >>> c2.root.x.value
+    1
+
+    >>> position = c2._inv_position
+    >>> c1.root.x.value = 2
+    >>> tm1.commit()
+    >>> log = db._invalidation_log
+    >>> log.position - position
+    1
+    >>> c2._inv_position == position
+    True
+
+    The connection catches up when its view of the database is needed.
+
+    >>> c2.root.x._p_oid in c2._invalidated
+    True
+    >>> c2._inv_position == log.position
+    True
+    >>> c2.root.x.value
+    1
+    >>> _ = tm2.begin()
+    >>> c2.root.x.value
+    2
+
+    The committing connection doesn't invalidate its own objects:
+
+    >>> len(c1._invalidated)
+    0
+
+    Only the most recent entries are kept.  A connection that falls
+    further behind, here because it sat in the pool, has its whole cache
+    invalidated when it's reopened:
+
+    >>> c2.close()
+    >>> for i in range(10):
+    ...     c1.root.x.value = i
+    ...     tm1.commit()
+    >>> len(log.entries) < 6
+    True
+    >>> c2 is db.open(tm2)
+    True
+    >>> c2.root()._p_changed, c2.root.x._p_changed
+    (None, None)
+    >>> c2.root.x.value
+    9
+
+    Entries an open connection hasn't read yet are kept, so it goes on
+    reading consistent data rather than treating its whole cache as
+    invalid:
+
+    >>> for i in range(10):
+    ...     c1.root.x.value = 10 + i
+    ...     tm1.commit()
+    >>> log.first <= c2._inv_position
+    True
+    >>> c2.root.x.value
+    9
+    >>> c2._invalidatedCache
+    False
+    >>> _ = tm2.begin()
+    >>> c2.root.x.value
+    19
+
+    But only up to `max_reader_lag` times the log size, so that open
+    connections that aren't used don't make the log grow without bound.
+    A connection further behind has its whole cache invalidated too:
+
+    >>> log.max_reader_lag
+    10
+    >>> position = c2._inv_position
+    >>> for i in range(40):
+    ...     c1.root.x.value = 20 + i
+    ...     tm1.commit()
+    >>> log.first > position, len(log.entries) <= 33
+    (True, True)
+    >>> _ = tm2.begin()
+    >>> c2.root()._p_changed, c2.root.x._p_changed
+    (None, None)
+    >>> c2.root.x.value
+    59
+
+    The log doesn't keep the committing connection alive:
+
+    >>> import gc
+    >>> c1.root.x.value = 20
+    >>> tm1.commit()
+    >>> c1 in gc.get_referents(log.entries[-1])
+    False
+
+    >>> db.close()
+    """
+
+def invalidation_dispatcher():
+    """The invalidation dispatcher applies committed invalidations to
+    connections sitting unused in the pool, in a background thread.
+
+    >>> db = ZODB.config.databaseFromString('''
+    ...     <zodb>
+    ...         invalidation-dispatcher true
+    ...         <mappingstorage/>
+    ...     </zodb>
+    ... ''')
+    >>> tm1 = transaction.TransactionManager()
+    >>> c1 = db.open(tm1)
+    >>> c1.root.x = MinPO(1)
+    >>> tm1.commit()
+    >>> tm2 = transaction.TransactionManager()
+    >>> c2 = db.open(tm2)
+    >>> x2 = c2.root.x
+    >>> x2.value
+    1
+    >>> c2.close()
+
+    >>> c1.root.x.value = 2
+    >>> tm1.commit()
+    >>> for i in range(100):
+    ...     if x2._p_changed is None:
+    ...         break
+    ...     time.sleep(.01)
+    >>> print(x2._p_changed)
+    None
+    >>> c2._inv_position == db._invalidation_log.position
+    True
+
+    >>> c2 is db.open(tm2)
+    True
+    >>> c2.root.x.value
+    2
+
+    Closing the database stops the dispatcher thread.
+
+    >>> dispatcher = db._invalidation_dispatcher
+    >>> db.close()
+    >>> dispatcher._thread.is_alive()
+    False
+    """
+
+def cache_budget():
+    """A database-wide budget can be set for the total estimated size of
+    the objects in all of its connections' caches.
+
+    Trimming is normally done in the background.  Here we turn that off
+    and call it directly.
+
+    >>> db = ZODB.DB(None, cache_budget_bytes=1<<30, cache_budget_interval=0)
+    >>> db.getCacheBudgetBytes() == 1<<30
+    True
+    >>> budget = db._cache_budget
+    >>> print(budget._thread)
+    None
+    >>> tm1 = transaction.TransactionManager()
+    >>> c1 = db.open(tm1)
+    >>> for i in range(100):
+    ...     c1.root()[i] = MinPO('x' * 1000)
+    >>> tm1.commit()
+    >>> tm2 = transaction.TransactionManager()
+    >>> c2 = db.open(tm2)
+    >>> _ = [c2.root()[i].value for i in range(100)]
+    >>> c2.close()
+
+    cacheDetailSize reports how the budget is being spent:
+
+    >>> details = dict((d['opened'], d) for d in db.cacheDetailSize())
+    >>> details[True]['estimated_size'] > 100000
+    True
+    >>> details[False]['estimated_size'] > 100000
+    True
+
+    While we're within the budget, nothing happens:
+
+    >>> total = budget.trim()
+    >>> stats = db.getCacheBudgetStatistics()
+    >>> stats['total'] == total, stats['connections'], stats['trims']
+    (True, 2, 0)
+
+    When we lower the budget, the unused connection in the pool is
+    shrunk first.  It's taken out of the pool while its cache is
+    collected, rather than holding the database lock:
+
+    >>> import threading
+    >>> gc = c2._cache_policy.gc
+    >>> def gc_checked(cache):
+    ...     thread = threading.Thread(target=lambda: (db._a(), db._r()))
+    ...     thread.start()
+    ...     thread.join(10)
+    ...     print(thread.is_alive(), c2 in [c for (_, c) in db.pool.available])
+    ...     gc(cache)
+    >>> c2._cache_policy.gc = gc_checked
+    >>> db.setCacheBudgetBytes(total - 50000)
+    >>> _ = budget.trim()
+    False False
+    >>> del c2._cache_policy.gc
+    >>> c2 in [c for (_, c) in db.pool.available]
+    True
+    >>> details = dict((d['opened'], d) for d in db.cacheDetailSize())
+    >>> (details[False]['estimated_size'] <=
+    ...  details[True]['estimated_size'] - 50000)
+    True
+    >>> details[True]['cache_size_bytes']
+    0
+
+    If that's not enough, the open connection's target is lowered, so that
+    its cache is shrunk at its next transaction boundary:
+
+    >>> db.setCacheBudgetBytes(50000)
+    >>> _ = budget.trim()
+    >>> details = dict((d['opened'], d) for d in db.cacheDetailSize())
+    >>> 0 < details[True]['cache_size_bytes'] <= 50000
+    True
+    >>> _ = tm1.begin()
+    >>> c1._cache.total_estimated_size <= 50000
+    True
+    >>> stats = db.getCacheBudgetStatistics()
+    >>> stats['total'] <= 50000, stats['trims']
+    (True, 2)
+
+    Just fitting in the budget isn't enough for the connections to get
+    their normal targets back, or they'd grow right back over it:
+
+    >>> db.setCacheBudgetBytes(stats['total'] + 1000)
+    >>> _ = budget.trim()
+    >>> 0 < c1._cache.cache_size_bytes <= 50000
+    True
+
+    When the caches fit comfortably in the budget, they do:
+
+    >>> db.setCacheBudgetBytes(1<<30)
+    >>> _ = budget.trim()
+    >>> [d['cache_size_bytes'] for d in db.cacheDetailSize()]
+    [0, 0]
+
+    >>> db.setCacheBudgetBytes(0)
+    >>> print(db.getCacheBudgetStatistics())
+    None
+    >>> db.close()
+    """
+
+def cache_class_report():
+    """cacheClassReport reports on the objects in the caches by class,
+    largest first, estimated from a sample of the objects.
+
+    >>> from persistent.mapping import PersistentMapping
+    >>> db = ZODB.DB(None)
+    >>> conn = db.open()
+    >>> for i in range(100):
+    ...     conn.root()[i] = MinPO('x' * 1000)
+    >>> transaction.commit()
+    >>> conn.cacheMinimize()
+    >>> for i in range(25):
+    ...     _ = conn.root()[i].value
+
+    >>> report = conn.cacheClassReport(sample=None)
+    >>> [d['class'] for d in report]
+    ['ZODB.tests.MinPO.MinPO', 'persistent.mapping.PersistentMapping']
+    >>> minpo = report[0]
+    >>> minpo['objects'], minpo['ghosts'], minpo['non_ghosts']
+    (100, 75, 25)
+    >>> minpo['ghost_ratio']
+    0.75
+    >>> minpo['estimated_size'] > 25000
+    True
+    >>> minpo['activations']
+    25
+    >>> minpo['activation_rate'] > 0
+    True
+
+    With a sample, counts are scaled up from the objects looked at:
+
+    >>> sampled = conn.cacheClassReport(sample=20)
+    >>> sum(d['objects'] for d in sampled)
+    101
+
+    Activation counts can be reset:
+
+    >>> _ = conn.cacheClassReport(clear=True)
+    >>> conn.cacheClassReport()[0]['activations']
+    0
+
+    The database report sums the reports of its connections.  Loading
+    the root in the second connection adds ghosts for all of its items:
+
+    >>> conn2 = db.open()
+    >>> _ = conn2.root()[0].value
+    >>> report = db.cacheClassReport(sample=None)
+    >>> [(d['class'], d['objects'], d['activations']) for d in report]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('ZODB.tests.MinPO.MinPO', 200, 1),
+     ('persistent.mapping.PersistentMapping', 2, 1)]
+
+    >>> db.close()
+    """
+
 def test_suite():
     s = unittest.makeSuite(DBTests)
     s.addTest(doctest.DocTestSuite(
@@ -0,0 +1,180 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests of the database metrics.
+
+See ZODB/metrics.py
+"""
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+
+import ZODB
+import ZODB.metrics
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError
+
+
+def samples(text):
+    """Return {sample name with labels: value} for rendered metrics"""
+    result = {}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            result[name] = value
+    return result
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = ZODB.DB(MappingStorage(), database_name='main',
+                          commit_timing=True)
+        conn = self.db.open()
+        for i in range(3):
+            conn.root()[i] = PersistentMapping()
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_getMetrics(self):
+        db = self.db
+        conn = db.open()
+        conn.cacheMinimize()
+        conn.root()[0]['x'] = 1
+        transaction.commit()
+        db.open().close()
+
+        metrics = db.getMetrics()
+        self.assertEqual(metrics['database_name'], 'main')
+        self.assertEqual((metrics['connections'],
+                          metrics['open_connections']), (2, 1))
+        self.assertEqual(metrics['pool']['available'], 1)
+        self.assertEqual(metrics['caches']['non_ghosts'],
+                         db.cacheSize())
+        transfer = metrics['transfer']
+        # Closed and open connections are counted.
+        self.assertEqual(transfer['commits'], 2)
+        self.assertEqual(transfer['stores'], 5)
+        self.assertEqual(transfer, db.getTransferStatistics())
+        self.assertEqual(metrics['commits']['commits'], 2)
+        self.assertEqual(metrics['storage_size'], db.getSize())
+        self.assertEqual(metrics['pack']['running'], False)
+        conn.close()
+
+    def test_transfer_statistics_survive_reopening(self):
+        db = self.db
+        conn = db.open()
+        conn.root()[0]['x'] = 1
+        transaction.commit()
+        conn.close()
+        conn = db.open()
+        self.assertEqual(conn.getTransferStatistics()['commits'], 0)
+        self.assertEqual(db.getTransferStatistics()['commits'], 2)
+        conn.close()
+
+    def test_conflicts(self):
+        db = self.db
+        tm1 = transaction.TransactionManager()
+        conn1 = db.open(tm1)
+        tm2 = transaction.TransactionManager()
+        conn2 = db.open(tm2)
+        conn1.root()[0]['x'] = 1
+        conn2.root()[0]['x'] = 2
+        tm1.commit()
+        self.assertRaises(ConflictError, tm2.commit)
+        tm2.abort()
+        self.assertEqual(db.getTransferStatistics()['conflicts'], 1)
+
+    def test_pack_status(self):
+        db = self.db
+        db.pack()
+        status = db.getPackStatus()
+        self.assertEqual(status['running'], False)
+        self.assertEqual(status['last_succeeded'], True)
+        self.assertTrue(status['last_duration'] >= 0)
+
+        def pack(*args):
+            self.assertEqual(db.getPackStatus()['running'], True)
+            raise ValueError
+        db.storage.pack = pack
+        self.assertRaises(ValueError, db.pack)
+        self.assertEqual(db.getPackStatus()['last_succeeded'], False)
+
+    def test_render(self):
+        other = ZODB.DB(MappingStorage(), database_name='o"ther')
+        db = self.db
+        db.pack()
+        text = ZODB.metrics.render(db, other)
+        self.assertTrue(text.endswith('\n# EOF\n'))
+        lines = text.splitlines()
+        self.assertEqual(lines[:2], [
+            '# TYPE zodb_pool_size gauge',
+            '# HELP zodb_pool_size Expected maximum number of open '
+            'connections.'])
+        # Each family is described once.
+        types = [line for line in lines if line.startswith('# TYPE ')]
+        self.assertEqual(len(types), len(set(types)))
+        self.assertTrue('# TYPE zodb_loads counter' in types)
+
+        values = samples(text)
+        self.assertEqual(values['zodb_pool_size{database="main"}'], '7')
+        self.assertEqual(values[r'zodb_pool_size{database="o\"ther"}'], '7')
+        self.assertEqual(values['zodb_commits_total{database="main"}'], '1')
+        self.assertEqual(values['zodb_pack_running{database="main"}'], '0')
+        self.assertEqual(
+            values['zodb_last_pack_success{database="main"}'], '1')
+        self.assertFalse(
+            'zodb_last_pack_success{database="o\\"ther"}' in values)
+        # Commit timing is only on for main.
+        self.assertEqual(
+            values['zodb_commit_duration_seconds_count{database="main"}'],
+            '1')
+        self.assertEqual(
+            values['zodb_commit_duration_seconds_bucket'
+                   '{database="main",le="+Inf"}'], '1')
+        self.assertFalse(
+            'zodb_commit_duration_seconds_count{database="o\\"ther"}'
+            in values)
+        # Buckets are cumulative.
+        buckets = [int(line.split()[-1]) for line in lines
+                   if line.startswith('zodb_load_duration_seconds_bucket'
+                                      '{database="main"')]
+        self.assertEqual(len(buckets), 18)
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(
+            buckets[-1],
+            int(values['zodb_loads_total{database="main"}']))
+        other.close()
+
+    def test_wsgi_app(self):
+        app = ZODB.metrics.make_app(self.db)
+        responses = []
+        def start_response(status, headers):
+            responses.append((status, dict(headers)))
+        body = b''.join(app({'REQUEST_METHOD': 'GET'}, start_response))
+        (status, headers), = responses
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], ZODB.metrics.CONTENT_TYPE)
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        self.assertTrue(body.endswith(b'# EOF\n'))
+
+
+def test_suite():
+    return unittest.makeSuite(Tests)
+
+if __name__=='__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,389 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests of the FileStorage reference index.
+
+See ZODB/FileStorage/references.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+
+import ZODB
+import ZODB.config
+import ZODB.POSException
+from ZODB.FileStorage import FileStorage
+from ZODB.FileStorage.fspack import FileStoragePacker
+from ZODB.utils import z64
+
+# The module, shadowed by the class in the package
+fsmodule = sys.modules['ZODB.FileStorage.FileStorage']
+
+
+def no_referencesf(p, oids=None):
+    raise AssertionError("Unpickled a record")
+
+
+class Base(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'Data.fs')
+        self.referencesf = fsmodule.referencesf
+
+    def tearDown(self):
+        fsmodule.referencesf = self.referencesf
+        shutil.rmtree(self.dir)
+
+    def open(self, **kw):
+        kw.setdefault('reference_index', True)
+        self.fs = FileStorage(self.path, **kw)
+        self.db = ZODB.DB(self.fs)
+        self.addCleanup(self.fs.close)
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(self.tm)
+        return self.conn.root()
+
+    def populate(self):
+        root = self.open()
+        root['a'] = a = PersistentMapping()
+        root['b'] = b = PersistentMapping()
+        a['b'] = b
+        self.tm.commit()
+        return root, a, b
+
+    def unpickling_fails(self):
+        fsmodule.referencesf = no_referencesf
+
+
+class Tests(Base):
+
+    def test_maintained_by_commits(self):
+        root, a, b = self.populate()
+        self.unpickling_fails()
+        self.assertEqual(sorted(self.fs.getReferences(z64)),
+                         sorted([a._p_oid, b._p_oid]))
+        self.assertEqual(self.fs.getReferences(a._p_oid), [b._p_oid])
+        self.assertEqual(self.fs.getReferences(b._p_oid), [])
+        self.assertEqual(self.fs.getReferrers(b._p_oid),
+                         sorted([z64, a._p_oid]))
+
+        fsmodule.referencesf = self.referencesf
+        del a['b']
+        self.tm.commit()
+        self.unpickling_fails()
+        self.assertEqual(self.fs.getReferences(a._p_oid), [])
+        self.assertEqual(self.fs.getReferrers(b._p_oid), [z64])
+        self.assertEqual(self.fs.getReferrers(a._p_oid), [z64])
+
+    def test_without_index(self):
+        root = self.open(reference_index=False)
+        root['a'] = a = PersistentMapping()
+        root['b'] = b = PersistentMapping()
+        a['b'] = b
+        self.tm.commit()
+        self.assertEqual(self.fs.getReferences(a._p_oid), [b._p_oid])
+        self.assertEqual(self.fs.getReferrers(b._p_oid),
+                         sorted([z64, a._p_oid]))
+        self.db.close()
+        self.assertFalse(os.path.exists(self.path + '.refs'))
+
+        # The references of existing objects are read by the first query.
+        self.open()
+        self.assertFalse(self.fs._references.complete)
+        self.assertEqual(self.fs.getReferrers(b._p_oid),
+                         sorted([z64, a._p_oid]))
+        self.assertTrue(self.fs._references.complete)
+        self.assertEqual(len(self.fs._references), 3)
+
+    def test_saved(self):
+        root, a, b = self.populate()
+        self.db.close()
+
+        self.unpickling_fails()
+        self.open()
+        self.assertEqual(self.fs._references.missing, set())
+        self.assertEqual(self.fs.getReferrers(b._p_oid),
+                         sorted([z64, a._p_oid]))
+        self.db.close()
+
+        # Records written while the index isn't kept are missing.
+        fsmodule.referencesf = self.referencesf
+        root = self.open(reference_index=False)
+        root['c'] = c = PersistentMapping()
+        self.tm.commit()
+        self.db.close()
+        self.open()
+        self.assertEqual(self.fs._references.missing,
+                         set([z64, c._p_oid]))
+        self.assertEqual(self.fs.getReferrers(c._p_oid), [z64])
+        self.assertEqual(self.fs._references.missing, set())
+
+    def test_saved_for_another_file(self):
+        self.populate()
+        self.db.close()
+        os.remove(self.path)
+        os.remove(self.path + '.index')
+        root = self.open()
+        root['x'] = 1
+        self.tm.commit()
+        self.assertEqual(self.fs._references.missing, set())
+        self.assertTrue(self.fs._references.complete)
+        self.assertEqual(len(self.fs._references), 1)
+
+    def test_undo(self):
+        root, a, b = self.populate()
+        del a['b']
+        self.tm.commit()
+        self.db.undo(self.db.undoLog(0, 1)[0]['id'], self.tm.get())
+        self.tm.commit()
+        self.assertEqual(self.fs._references.missing, set([a._p_oid]))
+        self.assertEqual(self.fs.getReferrers(b._p_oid),
+                         sorted([z64, a._p_oid]))
+
+    def test_pack(self):
+        root, a, b = self.populate()
+        root['c'] = PersistentMapping()
+        root['c']['d'] = d = PersistentMapping()
+        self.tm.commit()
+        del root['c']
+        self.tm.commit()
+        time.sleep(.01)
+
+        # Garbage collection only needs the index.
+        self.fs.pack(time.time(), no_referencesf)
+        self.assertFalse(d._p_oid in self.fs._index)
+        self.assertEqual(len(self.fs._references), 3)
+        for oid, pos in self.fs._index.items():
+            self.assertTrue(self.fs._references.get(oid, pos) is not None)
+        self.unpickling_fails()
+        self.assertEqual(self.fs.getReferrers(b._p_oid),
+                         sorted([z64, a._p_oid]))
+        self.assertEqual(self.fs.getReferrers(d._p_oid), [])
+
+    def test_config(self):
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          <filestorage>
+            path %s
+            reference-index true
+          </filestorage>
+        </zodb>
+        """ % self.path)
+        self.assertTrue(db.storage._references is not None)
+        db.close()
+
+
+class GCTests(Base):
+
+    def open(self, **kw):
+        kw.setdefault('incremental_gc', True)
+        return Base.open(self, **kw)
+
+    def populate(self):
+        root = self.open()
+        root['a'] = a = PersistentMapping()
+        a['b'] = b = PersistentMapping()
+        self.tm.commit()
+        return root, a, b
+
+    def dead(self):
+        return sorted(self.fs._references.dead)
+
+    def test_collected_at_commit(self):
+        root, a, b = self.populate()
+        root['b'] = b
+        self.tm.commit()
+        del root['a']
+        self.tm.commit()
+        self.assertEqual(self.dead(), [a._p_oid])
+        a_tid = self.fs.lastTransaction()
+        del root['b']
+        self.tm.commit()
+        self.assertEqual(self.dead(), sorted([a._p_oid, b._p_oid]))
+        self.assertEqual(self.fs._references.dead[a._p_oid], a_tid)
+        self.assertEqual(self.fs._references.dead[b._p_oid],
+                         self.fs.lastTransaction())
+
+    def test_cycle(self):
+        root, a, b = self.populate()
+        b['a'] = a
+        self.tm.commit()
+        self.assertEqual(self.dead(), [])
+        del root['a']
+        self.tm.commit()
+        self.assertEqual(self.dead(), sorted([a._p_oid, b._p_oid]))
+
+    def test_large_cycles_are_left(self):
+        root, a, b = self.populate()
+        b['a'] = a
+        self.tm.commit()
+        self.fs._references.max_search = 1
+        del root['a']
+        self.tm.commit()
+        self.assertEqual(self.dead(), [])
+        self.assertEqual(self.fs.collectGarbage(), 0)
+
+    def test_revived(self):
+        root, a, b = self.populate()
+        del root['a']
+        self.tm.commit()
+        self.assertEqual(self.dead(), sorted([a._p_oid, b._p_oid]))
+        # A connection can still refer to them
+        root['a'] = a
+        self.tm.commit()
+        self.assertEqual(self.dead(), [])
+
+    def test_undo(self):
+        root, a, b = self.populate()
+        del root['a']
+        self.tm.commit()
+        self.db.undo(self.db.undoLog(0, 1)[0]['id'], self.tm.get())
+        self.tm.commit()
+        # The undone root record is missing, nothing is done before
+        # its references are known.
+        self.assertEqual(self.dead(), sorted([a._p_oid, b._p_oid]))
+        self.assertEqual(self.fs.collectGarbage(), 0)
+        self.assertEqual(self.dead(), [])
+
+    def test_started_on_existing_storage(self):
+        root = self.open(incremental_gc=False, reference_index=False)
+        root['a'] = a = PersistentMapping()
+        self.tm.commit()
+        del root['a']
+        self.tm.commit()
+        self.db.close()
+        self.open()
+        self.assertEqual(self.fs._references.candidates, set([a._p_oid]))
+        self.assertEqual(self.fs.collectGarbage(), 1)
+        self.assertEqual(self.dead(), [a._p_oid])
+        self.db.close()
+
+        self.open()
+        self.assertEqual(self.dead(), [a._p_oid])
+        self.assertEqual(self.fs._references.candidates, set())
+
+    def test_revived_after_commits_without_gc(self):
+        root, a, b = self.populate()
+        del root['a']
+        self.tm.commit()
+        self.assertEqual(self.dead(), sorted([a._p_oid, b._p_oid]))
+        self.db.close()
+
+        root = self.open(incremental_gc=False, reference_index=False)
+        root['y'] = self.conn.get(a._p_oid)
+        self.tm.commit()
+        self.db.close()
+
+        root = self.open()
+        self.assertEqual(self.dead(), [])
+        self.db.pack()
+        self.assertEqual(root['y']['b'], {})
+        self.db.close()
+
+    def test_reopened_without_gc(self):
+        root, a, b = self.populate()
+        del root['a']
+        self.tm.commit()
+        self.db.close()
+
+        root = self.open(incremental_gc=False)
+        self.assertEqual(self.fs._references.dead, None)
+        root['c'] = PersistentMapping()
+        self.tm.commit()
+        self.assertFalse(self.fs._file.closed)
+        self.assertRaises(fsmodule.FileStorageError,
+                          self.fs.collectGarbage)
+        # Packs mark the reachable objects
+        self.db.pack()
+        self.assertFalse(a._p_oid in self.fs._index)
+        self.db.close()
+
+    def test_collection_failure_doesnt_close(self):
+        root, a, b = self.populate()
+        def collect(tid, limit=None):
+            raise ValueError
+        self.fs._references.collect = collect
+        del root['a']
+        self.tm.commit()
+        self.assertFalse(self.fs._file.closed)
+        self.assertEqual(root._p_serial, self.fs.lastTransaction())
+
+    def test_pack_without_marking(self):
+        root, a, b = self.populate()
+        root['c'] = c = PersistentMapping()
+        self.tm.commit()
+        del root['a']
+        self.tm.commit()
+        time.sleep(.01)
+        packtime = time.time()
+        time.sleep(.01)
+        del root['c']
+        self.tm.commit()
+
+        def findReachableAtPacktime(roots):
+            raise AssertionError("Marked reachable objects")
+        self.fs.packer = self.packer(findReachableAtPacktime)
+        self.fs.pack(packtime, no_referencesf)
+        self.assertFalse(a._p_oid in self.fs._index)
+        self.assertFalse(b._p_oid in self.fs._index)
+        self.assertRaises(ZODB.POSException.POSKeyError,
+                          self.fs.load, a._p_oid)
+        # Dead after the pack time
+        self.assertEqual(self.dead(), [c._p_oid])
+        self.fs.load(c._p_oid)
+
+    def packer(self, findReachableAtPacktime):
+        def packer(storage, referencesf, stop, gc):
+            p = FileStoragePacker(storage, referencesf, stop, gc)
+            p.gc.findReachableAtPacktime = findReachableAtPacktime
+            try:
+                opos = p.pack()
+                if opos is None:
+                    return None
+                return opos, p.index
+            finally:
+                p.close()
+        return packer
+
+    def test_collect_requires_incremental_gc(self):
+        self.open(incremental_gc=False)
+        self.assertRaises(fsmodule.FileStorageError,
+                          self.fs.collectGarbage)
+
+    def test_config(self):
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          <filestorage>
+            path %s
+            incremental-gc true
+          </filestorage>
+        </zodb>
+        """ % self.path)
+        self.assertEqual(db.storage._references.dead, {})
+        db.close()
+
+
+def test_suite():
+    suite = unittest.makeSuite(Tests)
+    suite.addTest(unittest.makeSuite(GCTests))
+    return suite
+
+if __name__=='__main__':
+    unittest.main(defaultTest='test_suite')
@@ -15,9 +15,11 @@ import doctest
 import sys
 import unittest
 
+import ZODB
+import ZODB.broken
 import ZODB.tests.util
 from ZODB import serialize
-from ZODB._compat import Pickler, BytesIO, _protocol
+from ZODB._compat import Pickler, Unpickler, BytesIO, _protocol
 
 
 class ClassWithNewargs(int):
@@ -119,6 +121,262 @@ class SerializerTestCase(unittest.TestCase):
         self.assertTrue(not serialize.myhasattr(NewStyle(), "rat"))
 
 
+class Reference(object):
+
+    def __init__(self, reference):
+        self.reference = reference
+
+
+def make_record(state, protocol=_protocol):
+    sio = BytesIO()
+    p = Pickler(sio, protocol)
+    def persistent_id(ob):
+        if isinstance(ob, Reference):
+            return ob.reference
+    if sys.version_info[0] < 3:
+        p.inst_persistent_id = persistent_id
+    else:
+        p.persistent_id = persistent_id
+    p.dump(ClassWithoutNewargs)
+    p.dump(state)
+    return sio.getvalue()
+
+
+def noload_references(p):
+    # How references were found before records were scanned first
+    refs = []
+    u = Unpickler(BytesIO(p))
+    u.persistent_load = refs.append
+    u.noload()
+    u.noload()
+    return refs
+
+
+class ReferencesTestCase(unittest.TestCase):
+
+    references = [
+        b'\0' * 7 + b'\1',
+        (b'\0' * 7 + b'\2', ClassWithoutNewargs),
+        (b'\0' * 7 + b'\3', None),
+        ['w', (b'\0' * 7 + b'\4', )],
+        ['w', (b'\0' * 7 + b'\5', 'other')],
+        ['n', ('other', b'\0' * 7 + b'\6')],
+        ['m', ('other', b'\0' * 7 + b'\7', ClassWithoutNewargs)],
+        [b'\0' * 7 + b'\x08'],
+        b'\0' * 7 + b'Q',
+        ]
+
+    def records(self):
+        for protocol in range(1, _protocol + 1):
+            refs = [Reference(ref) for ref in self.references]
+            # The same reference twice is memoized
+            yield make_record(dict(refs=refs, again=refs[1].reference,
+                                   first=refs[0]), protocol)
+            yield make_record([1, u'x', b'QQ', 2.5, (None, )], protocol)
+            yield make_record(u'No references, Please.', protocol)
+            yield make_record(Reference(self.references[0]), protocol)
+
+    def test_same_references_as_noload(self):
+        for p in self.records():
+            self.assertEqual(serialize._references(p), noload_references(p))
+
+    def test_leaf_records_are_not_noloaded(self):
+        def NoloadUnpickler(f):
+            raise AssertionError("noloaded")
+        self.addCleanup(setattr, serialize, 'NoloadUnpickler',
+                        serialize.NoloadUnpickler)
+        serialize.NoloadUnpickler = NoloadUnpickler
+        p = make_record(dict(title=u'Persistent Paper'))
+        self.assertEqual(serialize.referencesf(p), [])
+        self.assertEqual(serialize.get_refs(p), [])
+        self.assertRaises(AssertionError, serialize.referencesf, b'')
+
+    def test_referencesf(self):
+        p = make_record([Reference(ref) for ref in self.references])
+        self.assertEqual(serialize.referencesf(p),
+                         [b'\0' * 7 + b'\1', b'\0' * 7 + b'\2',
+                          b'\0' * 7 + b'\3', b'\0' * 7 + b'Q'])
+        oids = [b'\0' * 8]
+        self.assertTrue(serialize.referencesf(p, oids) is oids)
+        self.assertEqual(len(oids), 5)
+
+    def test_get_refs(self):
+        p = make_record([Reference(ref) for ref in self.references])
+        self.assertEqual(serialize.get_refs(p),
+                         [(b'\0' * 7 + b'\1', None),
+                          (b'\0' * 7 + b'\2', None),
+                          (b'\0' * 7 + b'\3', None),
+                          (b'\0' * 7 + b'Q', None)])
+
+
+class PWithNewargs(ZODB.tests.util.P):
+
+    def __getnewargs__(self):
+        return ()
+
+
+class WriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import transaction
+        from persistent.mapping import PersistentMapping
+        self.db = ZODB.DB(None)
+        self.conn = self.db.open()
+        root = self.conn.root()
+        root['a'] = PersistentMapping(p=ZODB.tests.util.P('p'))
+        root['b'] = PersistentMapping(klass=PersistentMapping)
+        root['c'] = ZODB.tests.util.P(PWithNewargs('n'))
+        root['d'] = root['c'].name
+        transaction.commit()
+        self.objects = [self.conn.get(oid)
+                        for oid in sorted(self.conn._cache.cache_data)]
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_reused_writer_makes_the_same_pickles(self):
+        writer = serialize.ObjectWriter(jar=self.conn)
+        for i in range(2):
+            for obj in self.objects:
+                self.assertEqual(writer.serialize(obj),
+                                 serialize.ObjectWriter(obj).serialize(obj))
+
+    def test_class_referred_to_by_state(self):
+        # The state refers to the class in the memo, after the cached
+        # class metadata.
+        root = self.conn.root()
+        writer = serialize.ObjectWriter(jar=self.conn)
+        writer.serialize(root['a'])
+        p = writer.serialize(root['b'])
+        u = Unpickler(BytesIO(p))
+        u.persistent_load = lambda ref: None
+        klass = u.load()
+        self.assertTrue(u.load()['data']['klass'] is klass)
+        self.assertEqual(p.count(b'PersistentMapping'), 1)
+
+    def test_new_objects_are_pushed(self):
+        from persistent.mapping import PersistentMapping
+        writer = serialize.ObjectWriter(jar=self.conn)
+        obj = PersistentMapping(new=PersistentMapping())
+        self.conn.add(obj)
+        writer.push(obj)
+        self.assertEqual(list(writer), [obj])
+        writer.serialize(obj)
+        self.assertEqual(list(writer), [obj['new']])
+
+
+class ClassCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.found = []
+        def factory(conn, module, name):
+            self.found.append((module, name))
+            return ZODB.broken.find_global(module, name)
+        self.factory = factory
+
+    def test_reader_caches_globals(self):
+        r = serialize.ObjectReader(factory=self.factory)
+        p = make_pickle(ClassWithoutNewargs)
+        for i in range(3):
+            self.assertEqual(r.getClassName(p),
+                             __name__ + ".ClassWithoutNewargs")
+        self.assertEqual(self.found, [(__name__, 'ClassWithoutNewargs')])
+        # Other globals are found too
+        self.assertTrue(r._get_class('sys', 'path') is sys.path)
+
+    def test_broken_classes_are_not_cached(self):
+        r = serialize.ObjectReader(factory=self.factory)
+        p = b'cZODB.not.there\natall\n.'
+        self.assertEqual(r.getClassName(p), 'ZODB.not.there.atall')
+        r.getClassName(p)
+        self.assertEqual(len(self.found), 2)
+        self.assertEqual(r._classes, {})
+        ZODB.broken.broken_cache.clear()
+
+    def test_shared_by_connections(self):
+        import transaction
+        from persistent.mapping import PersistentMapping
+        db = ZODB.DB(None)
+        tm = transaction.TransactionManager()
+        conns = [db.open(tm), db.open(tm)]
+        conns[0].root()['a'] = PersistentMapping()
+        tm.commit()
+        for conn in conns:
+            conn.cacheMinimize()
+            conn.root()['a'].keys()
+            self.assertTrue(conn._reader._classes is db._classes)
+        self.assertTrue(
+            ('persistent.mapping', 'PersistentMapping') in db._classes)
+        db.close()
+
+    def test_kept_by_connections_with_other_factories(self):
+        # Factories other than DB.classFactory are passed the connection,
+        # what they find could depend on it.
+        import transaction
+        from persistent.mapping import PersistentMapping
+        factory = self.factory
+        found = []
+        class DB(ZODB.DB):
+            def classFactory(self, conn, module, name):
+                found.append(conn)
+                return factory(conn, module, name)
+        db = DB(None)
+        tm = transaction.TransactionManager()
+        conns = [db.open(tm), db.open(tm)]
+        conns[0].root()['a'] = PersistentMapping()
+        tm.commit()
+        for conn in conns:
+            conn.cacheMinimize()
+            conn.root()['a'].keys()
+            conn.cacheMinimize()
+            conn.root()['a'].keys()
+        self.assertEqual(found.count(conns[0]), 1)
+        self.assertEqual(found.count(conns[1]), 1)
+        self.assertEqual(db._classes, {})
+
+        # Likewise when classFactory is rebound.
+        db2 = ZODB.DB(None)
+        db2.classFactory = lambda conn, module, name: factory(
+            conn, module, name)
+        self.found = []
+        for i in range(2):
+            conn = db2.open(transaction.TransactionManager())
+            conn.root()
+            conn.cacheMinimize()
+            conn.root().keys()
+        self.assertEqual(self.found.count(
+            ('persistent.mapping', 'PersistentMapping')), 2)
+        self.assertEqual(db2._classes, {})
+        db2.close()
+        db.close()
+
+    def test_cleared_by_persistent_class_invalidations(self):
+        import transaction
+        import ZODB.persistentclass
+        C = ZODB.persistentclass.PersistentMetaClass(
+            'C', (object, ), dict(__module__='__zodb__', kind='sample'))
+        db = ZODB.DB(None)
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        conn.root()['C'] = C
+        tm.commit()
+        tm2 = transaction.TransactionManager()
+        conn2 = db.open(tm2)
+        conn2.root()['C'].kind
+
+        db._classes['module', 'name'] = C, sys
+        conn.root()['a'] = 1
+        tm.commit()
+        tm2.begin()
+        self.assertTrue(('module', 'name') in db._classes)
+
+        C.kind = 'changed'
+        tm.commit()
+        tm2.begin()
+        self.assertFalse(('module', 'name') in db._classes)
+        db.close()
+
+
 class SerializerFunctestCase(unittest.TestCase):
 
     def setUp(self):
@@ -192,6 +450,9 @@ def _functest_load(fqn):
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(SerializerTestCase),
+        unittest.makeSuite(ReferencesTestCase),
+        unittest.makeSuite(WriterTestCase),
+        unittest.makeSuite(ClassCacheTestCase),
         unittest.makeSuite(SerializerFunctestCase),
         doctest.DocTestSuite("ZODB.serialize",
                              checker=ZODB.tests.util.checker),
@@ -128,6 +128,57 @@ class TestUtils(unittest.TestCase):
             self.assertEqual(get_pickle_metadata(pickle),
                             (__name__, ExampleClass.__name__))
 
+    def test_get_pickle_metadata_w_protocol_4_class_pickle(self):
+        import pickle
+        from ZODB.utils import get_pickle_metadata
+        if pickle.HIGHEST_PROTOCOL >= 4:
+            for data in (pickle.dumps(ExampleClass, protocol=4),
+                         pickle.dumps((ExampleClass, None), protocol=4)):
+                self.assertEqual(get_pickle_metadata(data),
+                                 (__name__, ExampleClass.__name__))
+
+    def test_get_pickle_protocol(self):
+        from ZODB.utils import get_pickle_protocol
+        from ZODB._compat import dumps
+        from ZODB._compat import HIGHEST_PROTOCOL
+        self.assertEqual(get_pickle_protocol(dumps(ExampleClass, 1)), 1)
+        for protocol in range(2, HIGHEST_PROTOCOL + 1):
+            self.assertEqual(
+                get_pickle_protocol(dumps(ExampleClass, protocol)), protocol)
+
+    def test_copy_file(self):
+        import tempfile
+        import ZODB.utils
+        data = b''.join(p64(i) for i in range(10000))
+        saved = ZODB.utils._FICLONE, ZODB.utils._copy_file_range
+        try:
+            # Whatever the platform supports, then without clones, then
+            # with cp() only.
+            for ficlone, copy_file_range in (saved, (None, saved[1]),
+                                             (None, None)):
+                ZODB.utils._FICLONE = ficlone
+                ZODB.utils._copy_file_range = copy_file_range
+                for size in (len(data), 0):
+                    with tempfile.TemporaryFile() as f1:
+                        with tempfile.TemporaryFile() as f2:
+                            f1.write(data[:size])
+                            f1.seek(0)
+                            ZODB.utils.copy_file(f1, f2)
+                            self.assertEqual(f1.tell(), size)
+                            self.assertEqual(f2.tell(), size)
+                            f2.write(b'end')
+                            f2.seek(0)
+                            self.assertEqual(f2.read(), data[:size] + b'end')
+        finally:
+            ZODB.utils._FICLONE, ZODB.utils._copy_file_range = saved
+
+    def test_class_name(self):
+        from ZODB.utils import class_name
+        self.assertEqual(class_name(ExampleClass),
+                         'ZODB.tests.testUtils.ExampleClass')
+        self.assertEqual(class_name(type('C', (object,), {})),
+                         __name__ + '.C')
+
 
 class ExampleClass(object):
     pass
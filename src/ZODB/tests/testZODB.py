@@ -52,11 +52,11 @@ class ZODBTests(ZODB.tests.util.TestCase):
         transaction.commit()
         conn.close()
 
-    def checkExportImport(self, abort_it=False):
+    def checkExportImport(self, abort_it=False, compress=False):
         self.populate()
         conn = self._db.open()
         try:
-            self.duplicate(conn, abort_it)
+            self.duplicate(conn, abort_it, compress)
         finally:
             conn.close()
         conn = self._db.open()
@@ -65,7 +65,7 @@ class ZODBTests(ZODB.tests.util.TestCase):
         finally:
             conn.close()
 
-    def duplicate(self, conn, abort_it):
+    def duplicate(self, conn, abort_it, compress=False):
         transaction.begin()
         transaction.get().note('duplication')
         root = conn.root()
@@ -74,8 +74,14 @@ class ZODBTests(ZODB.tests.util.TestCase):
         try:
             import tempfile
             with tempfile.TemporaryFile(prefix="DUP") as f:
-                ob._p_jar.exportFile(ob._p_oid, f)
+                progress = []
+                ob._p_jar.exportFile(ob._p_oid, f, compress,
+                                     lambda *args: progress.append(args))
                 assert f.tell() > 0, 'Did not export correctly'
+                self.assertEqual(len(progress), 101)
+                self.assertEqual(progress[-1][0], 101)
+                if not compress:
+                    self.assertEqual(progress[-1][1], f.tell() - 20)
                 f.seek(0)
                 new_ob = ob._p_jar.importFile(f)
                 self.assertEqual(new_ob, ob)
@@ -122,6 +128,36 @@ class ZODBTests(ZODB.tests.util.TestCase):
     def checkExportImportAborted(self):
         self.checkExportImport(abort_it=True)
 
+    def checkExportImportCompressed(self):
+        self.checkExportImport(compress=True)
+
+    def checkImportCopiesRecordsWithoutReferences(self):
+        self.populate()
+        conn = self._db.open()
+        root = conn.root()
+        ob = root['test']
+        with ob._p_jar.exportFile(ob._p_oid) as f:
+            f.seek(0)
+            root['dup'] = new_ob = conn.importFile(f)
+            transaction.commit()
+        load = self._storage.load
+        # The mappings in the mapping don't refer to other objects.
+        self.assertEqual(load(new_ob[0]._p_oid)[0], load(ob[0]._p_oid)[0])
+        self.assertNotEqual(load(new_ob._p_oid)[0], load(ob._p_oid)[0])
+        self.assertEqual(new_ob[0][0], 100)
+        conn.close()
+
+    def checkImportOidMap(self):
+        from ZODB.ExportImport import _OidMap
+        from ZODB.utils import p64
+        oids = _OidMap()
+        large = p64((1 << 64) - 1)
+        for ooid, oid in ((p64(1), p64(7)), (large, p64(8)),
+                          (p64(2), large)):
+            self.assertEqual(oids.get(ooid), None)
+            oids[ooid] = oid
+            self.assertEqual(oids.get(ooid), oid)
+
     def checkResetCache(self):
         # The cache size after a reset should be 0.  Note that
         # _resetCache is not a public API, but the resetCaches()
@@ -140,6 +140,92 @@ class BlobCloneTests(ZODB.tests.util.TestCase):
         database.close()
 
 
+class BlobFileTests(ZODB.tests.util.TestCase):
+
+    data = b''.join(struct.pack('>I', i) for i in range(100000))
+
+    def setUp(self):
+        super(BlobFileTests, self).setUp()
+        self.database = DB(FileStorage('data.fs', blob_dir='blobs'))
+        self.root = self.database.open().root()
+        self.root['blob'] = Blob(self.data)
+        transaction.commit()
+
+    def tearDown(self):
+        self.database.close()
+        super(BlobFileTests, self).tearDown()
+
+    def sendfile(self, blob_file, *args):
+        with open('out', 'wb') as out:
+            sent = blob_file.sendfile(out, *args)
+        with open('out', 'rb') as out:
+            data = out.read()
+        self.assertEqual(sent, len(data))
+        return data
+
+    def test_size_and_sendfile(self):
+        with self.root['blob'].open() as f:
+            self.assertEqual(f.size(), len(self.data))
+            f.seek(42)
+            self.assertEqual(self.sendfile(f), self.data)
+            self.assertEqual(self.sendfile(f, 10, 100), self.data[10:110])
+            self.assertEqual(self.sendfile(f, len(self.data) - 5, 100),
+                             self.data[-5:])
+            self.assertEqual(self.sendfile(f, len(self.data) + 5), b'')
+            self.assertEqual(f.tell(), 42)
+
+            # To a pipe, from another thread, as to a socket.
+            import threading
+            r, w = os.pipe()
+            received = []
+            def read():
+                with os.fdopen(r, 'rb') as pipe:
+                    received.append(pipe.read())
+            thread = threading.Thread(target=read)
+            thread.start()
+            try:
+                self.assertEqual(f.sendfile(w, 1000), len(self.data) - 1000)
+            finally:
+                os.close(w)
+                thread.join()
+            self.assertEqual(received, [self.data[1000:]])
+
+    def test_sendfile_without_os_sendfile(self):
+        sendfile = ZODB.blob._sendfile
+        ZODB.blob._sendfile = None
+        try:
+            with self.root['blob'].open() as f:
+                f.seek(42)
+                self.assertEqual(self.sendfile(f), self.data)
+                self.assertEqual(self.sendfile(f, 10, 100),
+                                 self.data[10:110])
+                self.assertEqual(f.tell(), 42)
+        finally:
+            ZODB.blob._sendfile = sendfile
+
+    def test_copy_blob(self):
+        committed = self.root['blob'].committed()
+        ZODB.blob.copy_blob(committed, 'copy')
+        with open('copy', 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        if sys.platform != 'win32':
+            # Committed blob files on the same file system share data.
+            self.assertEqual(os.stat('copy').st_ino,
+                             os.stat(committed).st_ino)
+
+    def test_working_copy(self):
+        committed = self.root['blob'].committed()
+        with self.root['blob'].open('a') as f:
+            f.write(b'end')
+        with self.root['blob'].open('r+') as f:
+            self.assertEqual(f.read(), self.data + b'end')
+        with open(committed, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        transaction.commit()
+        with self.root['blob'].open() as f:
+            self.assertEqual(f.read(), self.data + b'end')
+
+
 class BushyLayoutTests(ZODB.tests.util.TestCase):
 
     def testBushyLayoutOIDToPathUnicode(self):
@@ -804,6 +890,7 @@ def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ZODBBlobConfigTest))
     suite.addTest(unittest.makeSuite(BlobCloneTests))
+    suite.addTest(unittest.makeSuite(BlobFileTests))
     suite.addTest(unittest.makeSuite(BushyLayoutTests))
     suite.addTest(doctest.DocFileSuite(
         "blob_basic.txt",
@@ -110,6 +110,67 @@ Of course, none of this applies if content doesn't support conflict resolution.
     >>> db.close()
     """
 
+def resolution_reuses_committed_records():
+    """
+    Storages keep the committed records they resolve conflicts against,
+    so that a hot object isn't loaded again and again:
+
+    >>> from ZODB.tests.ConflictResolution import PCounter
+    >>> from ZODB._compat import BytesIO, Unpickler
+    >>> def value(p):
+    ...     unpickler = Unpickler(BytesIO(p))
+    ...     _ = unpickler.load()
+    ...     return unpickler.load()['_value']
+    >>> db = ZODB.DB('t.fs') # FileStorage!
+    >>> storage = db.storage
+    >>> conn = db.open()
+    >>> conn.root.x = PCounter()
+    >>> conn.root.x.inc()
+    >>> transaction.commit()
+    >>> serial1 = conn.root.x._p_serial
+    >>> conn.root.x.inc()
+    >>> transaction.commit()
+    >>> serial2 = conn.root.x._p_serial
+    >>> oid = conn.root.x._p_oid
+
+    A change from 1 to 2 made concurrently with the committed one is
+    resolved to 3.  PCounter updates the old state it's passed, so the
+    records must be kept pickled for the second resolution to work:
+
+    >>> new = storage.loadSerial(oid, serial2)
+    >>> for i in range(2):
+    ...     p = storage.tryToResolveConflict(oid, serial2, serial1, new)
+    ...     print(value(p))
+    3
+    3
+
+    >>> stats = storage.getConflictResolutionStatistics()
+    >>> stats['resolved'], stats['failed'], stats['time']['count']
+    (2, 0, 2)
+    >>> stats['cache_hits'], stats['cache_misses'], stats['cache_records']
+    (2, 2, 2)
+
+    Failures are counted too:
+
+    >>> storage.tryToResolveConflict(oid, serial2, serial1, new[:-1])
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ConflictError: database conflict error (oid 0x01, ...
+    >>> storage.getConflictResolutionStatistics()['failed']
+    1
+
+    The number of records kept is limited:
+
+    >>> cache = storage._crs_cache
+    >>> cache.size = 1
+    >>> cache.add(oid, serial1, storage.loadSerial(oid, serial1))
+    >>> list(cache.records) == [(oid, serial1)]
+    True
+
+    >>> db.close()
+    """
+
 class Resolveable(persistent.Persistent):
 
     def _p_resolveConflict(self, old, committed, new):
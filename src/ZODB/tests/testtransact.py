@@ -0,0 +1,209 @@
+##############################################################################
+#
+# Copyright (c) 2015 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests of retrying transactions.
+
+See ZODB/transact.py
+"""
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+
+import ZODB
+import ZODB.transact
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError, ReadConflictError
+from ZODB.transact import Backoff, Retry, retry, transact
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = ZODB.DB(MappingStorage())
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(self.tm)
+        self.conn.root()['data'] = PersistentMapping(n=0)
+        self.tm.commit()
+        # Another client, committing competing changes
+        self.other_tm = transaction.TransactionManager()
+        self.other = self.db.open(self.other_tm).root()['data']
+        self.delays = []
+        ZODB.transact.sleep = self.delays.append
+        ZODB.transact.clearRetryStatistics()
+
+    def tearDown(self):
+        ZODB.transact.sleep = ZODB.transact.time.sleep
+        ZODB.transact.clearRetryStatistics()
+        self.db.close()
+
+    def compete(self):
+        self.other['n'] += 100
+        self.other_tm.commit()
+
+    def test_write_conflicts_are_retried_with_backoff(self):
+        conn = self.conn
+        calls = []
+
+        @retry(connection=conn, name='inc')
+        def inc():
+            calls.append(1)
+            conn.root()['data']['n'] += 1
+            if len(calls) < 3:
+                self.compete()
+            return 'done'
+
+        self.assertEqual(inc(), 'done')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(conn.root()['data']['n'], 201)
+        self.assertEqual(len(self.delays), 2)
+        self.assertTrue(.005 <= self.delays[0] <= .01)
+        self.assertTrue(.01 <= self.delays[1] <= .02)
+
+        stats = ZODB.transact.getRetryStatistics()['inc']
+        self.assertEqual(
+            (stats['calls'], stats['commits'], stats['retries'],
+             stats['conflicts'], stats['read_conflicts'], stats['failures']),
+            (3, 1, 2, 2, 0, 0))
+        self.assertEqual(stats['classes'],
+                         {'persistent.mapping.PersistentMapping': 2})
+        self.assertTrue(stats['wasted_time'] >= 0)
+
+    def test_read_conflicts_have_their_own_backoff(self):
+        conn = self.conn
+        calls = []
+        for attempt in Retry('read', connection=conn):
+            with attempt:
+                calls.append(1)
+                data = conn.root()['data']
+                data._p_activate()
+                conn.readCurrent(data)
+                conn.root()['x'] = data['n']
+                if len(calls) < 2:
+                    self.compete()
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(conn.root()['x'], 100)
+        # Read conflicts are retried right away by default.
+        self.assertEqual(self.delays, [])
+        stats = ZODB.transact.getRetryStatistics()['read']
+        self.assertEqual((stats['read_conflicts'], stats['conflicts']),
+                         (1, 0))
+
+    def test_giving_up(self):
+        conn = self.conn
+
+        @retry(connection=conn, attempts=3,
+               write_backoff=Backoff(delay=1, max_delay=10, jitter=0))
+        def inc():
+            conn.root()['data']['n'] += 1
+            self.compete()
+
+        self.assertRaises(ConflictError, inc)
+        self.assertEqual(self.delays, [1, 2])
+        stats = ZODB.transact.getRetryStatistics()[
+            'ZODB.tests.testtransact.inc']
+        self.assertEqual((stats['calls'], stats['retries'],
+                          stats['failures'], stats['commits']),
+                         (3, 2, 1, 0))
+        # The transaction was aborted.
+        self.assertEqual(conn.root()['data']['n'], 300)
+
+    def test_other_errors_are_not_retried(self):
+        conn = self.conn
+        calls = []
+
+        @retry(connection=conn)
+        def fail():
+            calls.append(1)
+            conn.root()['data']['n'] = 42
+            raise ValueError
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(conn.root()['data']['n'], 0)
+
+    def test_conflicts_raised_by_the_function(self):
+        calls = []
+
+        @retry(transaction_manager=self.tm)
+        def f():
+            calls.append(1)
+            if len(calls) < 2:
+                raise ReadConflictError()
+            return len(calls)
+
+        self.assertEqual(f(), 2)
+
+    def test_transact(self):
+        conn = self.conn
+        def inc():
+            conn.root()['data']['n'] += 1
+        inc = transact(inc, note=u'inc', retries=2)
+        # transact uses the thread's transaction manager.
+        conn.close()
+        conn = self.db.open()
+        inc()
+        self.assertEqual(conn.root()['data']['n'], 1)
+        self.assertEqual(
+            self.db.history(conn.root()['data']._p_oid)[0]['description'],
+            u'inc')
+        conn.close()
+
+    def test_transact_commits_the_current_transaction(self):
+        conn = self.conn
+        conn.close()
+        conn = self.db.open()
+        conn.root()['a'] = 1
+        def f():
+            conn.root()['b'] = 2
+        transact(f)()
+        transaction.abort()
+        self.assertEqual((conn.root()['a'], conn.root()['b']), (1, 2))
+        conn.close()
+
+    def test_transact_retries(self):
+        calls = []
+        def f(error):
+            calls.append(1)
+            if len(calls) < 2:
+                raise error()
+            return len(calls)
+        self.assertEqual(transact(f)(ReadConflictError), 2)
+        self.assertEqual(len(self.delays), 0)
+        del calls[:]
+        # Other conflicts raised by f aren't retried.
+        self.assertRaises(ConflictError, transact(f), ConflictError)
+        self.assertEqual(len(calls), 1)
+        self.assertRaises(RuntimeError, transact(f, retries=0),
+                          ReadConflictError)
+
+    def test_attempts_must_be_positive(self):
+        self.assertRaises(ValueError, Retry, 'none', attempts=0)
+        f = retry(lambda: 1, attempts=0)
+        self.assertRaises(ValueError, f)
+
+    def test_backoff(self):
+        backoff = Backoff(delay=.1, multiplier=3, max_delay=.5, jitter=0)
+        self.assertEqual([round(backoff.getDelay(n), 6) for n in (1, 2, 3)],
+                         [.1, .3, .5])
+        backoff.jitter = .5
+        for i in range(100):
+            self.assertTrue(.05 <= backoff.getDelay(1) <= .1)
+
+
+def test_suite():
+    return unittest.makeSuite(Tests)
+
+if __name__=='__main__':
+    unittest.main(defaultTest='test_suite')
@@ -11,16 +11,256 @@
 # FOR A PARTICULAR PURPOSE
 #
 ##############################################################################
-"""Tools to simplify transactions within applications."""
+"""Tools to simplify transactions within applications.
+
+Transactions that fail with a ConflictError can be retried, either by
+decorating a function with retry()::
+
+  @retry(connection=conn)
+  def add_order(order):
+      conn.root.orders.append(order)
+
+or by looping over attempts::
+
+  for attempt in Retry('add_order', connection=conn):
+      with attempt:
+          conn.root.orders.append(order)
+
+Each attempt runs in a new transaction, which is committed at the end
+of the attempt.  When an attempt fails with a conflict, the transaction
+is aborted, the connection synced and, after a delay growing with each
+retry, the next attempt is made.  Read conflicts and write conflicts
+have their own Backoff.  The retries and time wasted on failed
+attempts are counted by name, see getRetryStatistics().
+"""
+import functools
+import random
+import threading
+import time
 
-from ZODB.POSException import ReadConflictError, ConflictError
 import transaction
 
-def _commit(note):
-    t = transaction.get()
-    if note:
-        t.note(note)
-    t.commit()
+from ZODB.ActivityMonitor import timer
+from ZODB.POSException import ReadConflictError, ConflictError
+
+sleep = time.sleep # Replaced by tests
+
+
+class Backoff(object):
+    """Delays between attempts
+
+    Retry n waits for ``delay * multiplier ** (n - 1)`` seconds, but no
+    more than `max_delay`, less a random fraction of up to `jitter`, so
+    that transactions that conflicted with each other don't retry at the
+    same time.
+    """
+
+    def __init__(self, delay=.01, multiplier=2.0, max_delay=1.0, jitter=.5):
+        self.delay = delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def getDelay(self, retry):
+        delay = min(self.delay * self.multiplier ** (retry - 1),
+                    self.max_delay)
+        return delay * (1 - self.jitter * random.random())
+
+
+# A read conflict means we read data that was changed since, which a
+# sync fixes.  Write conflicts are with transactions that may still be
+# running, so we give them time to get out of the way.
+default_read_backoff = Backoff(delay=0)
+default_write_backoff = Backoff()
+
+
+class RetryStatistics(object):
+    """Counts for the transactions retried under a name
+
+    Counters are changed with `lock` held.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0          # Transactions started
+        self.commits = 0
+        self.failures = 0       # Calls that ran out of attempts
+        self.retries = 0
+        self.read_conflicts = 0
+        self.conflicts = 0      # Write conflicts
+        self.wasted_time = 0.0  # Seconds in failed attempts and delays
+        self.classes = {}       # {class name -> number of conflicts}
+
+    def getStatistics(self):
+        with self.lock:
+            return dict(
+                calls=self.calls,
+                commits=self.commits,
+                failures=self.failures,
+                retries=self.retries,
+                read_conflicts=self.read_conflicts,
+                conflicts=self.conflicts,
+                wasted_time=self.wasted_time,
+                classes=dict(self.classes),
+                )
+
+_statistics = {} # {name -> RetryStatistics}
+_statistics_lock = threading.Lock()
+
+
+def getRetryStatistics():
+    """Return {name -> statistics} for the transactions retried by name
+    """
+    with _statistics_lock:
+        return dict((name, stats.getStatistics())
+                    for (name, stats) in _statistics.items())
+
+
+def clearRetryStatistics():
+    with _statistics_lock:
+        _statistics.clear()
+
+
+class Retry(object):
+    """Attempts at a transaction, retried after conflicts
+
+    Iterating gives up to `attempts` context managers, each running an
+    attempt in a new transaction of the `transaction_manager` (by
+    default the connection's, or the thread's).  The transaction is
+    committed with `note` when the block exits.  The ConflictError of
+    the last attempt is raised.
+    """
+
+    def __init__(self, name, attempts=5, note=None, transaction_manager=None,
+                 connection=None, read_backoff=None, write_backoff=None):
+        if attempts < 1:
+            raise ValueError("attempts must be at least 1, not %r"
+                             % (attempts,))
+        self.name = name
+        self.attempts = attempts
+        self.note = note
+        if transaction_manager is None:
+            if connection is not None:
+                transaction_manager = connection.transaction_manager
+            else:
+                transaction_manager = transaction.manager
+        self.transaction_manager = transaction_manager
+        self.connection = connection
+        self.read_backoff = read_backoff or default_read_backoff
+        self.write_backoff = write_backoff or default_write_backoff
+        with _statistics_lock:
+            stats = _statistics.get(name)
+            if stats is None:
+                stats = _statistics[name] = RetryStatistics()
+        self.statistics = stats
+
+    def __iter__(self):
+        self.done = False
+        for number in range(1, self.attempts + 1):
+            yield Attempt(self, number)
+            if self.done:
+                break
+
+    def _begin(self):
+        self._started()
+        return self.transaction_manager.begin()
+
+    def _started(self):
+        stats = self.statistics
+        with stats.lock:
+            stats.calls += 1
+
+    def _commit(self, attempt):
+        t = self.transaction_manager.get()
+        if self.note:
+            t.note(self.note)
+        try:
+            t.commit()
+        except ConflictError as v:
+            if not self._failed(attempt, v):
+                raise
+        else:
+            stats = self.statistics
+            with stats.lock:
+                stats.commits += 1
+            self.done = True
+
+    def _failed(self, attempt, error):
+        """Handle a conflict.  Return whether to try again."""
+        self.transaction_manager.abort()
+        stats = self.statistics
+        read = isinstance(error, ReadConflictError)
+        class_name = getattr(error, 'class_name', None)
+        last = attempt.number >= self.attempts
+        with stats.lock:
+            if read:
+                stats.read_conflicts += 1
+            else:
+                stats.conflicts += 1
+            if class_name:
+                stats.classes[class_name] = (
+                    stats.classes.get(class_name, 0) + 1)
+            if last:
+                stats.failures += 1
+                stats.wasted_time += timer() - attempt.start
+            else:
+                stats.retries += 1
+        if last:
+            return False
+
+        if read:
+            delay = self.read_backoff.getDelay(attempt.number)
+        else:
+            delay = self.write_backoff.getDelay(attempt.number)
+        if delay > 0:
+            sleep(delay)
+        if self.connection is not None:
+            self.connection.sync()
+        with stats.lock:
+            stats.wasted_time += timer() - attempt.start
+        return True
+
+
+class Attempt(object):
+
+    def __init__(self, retry, number):
+        self.retry = retry
+        self.number = number
+        self.start = timer()
+
+    def __enter__(self):
+        self.start = timer()
+        return self.retry._begin()
+
+    def __exit__(self, t, v, tb):
+        if v is None:
+            self.retry._commit(self)
+            return
+        if isinstance(v, ConflictError):
+            return self.retry._failed(self, v)
+        self.retry.transaction_manager.abort()
+
+
+def retry(f=None, name=None, **options):
+    """Decorate a function to run it in a transaction retried on conflicts
+
+    Can be used with or without arguments.  The name under which retries
+    are counted defaults to the function's dotted name.  Other options
+    are passed to Retry.
+    """
+    if f is None:
+        return lambda f: retry(f, name, **options)
+    if name is None:
+        name = "%s.%s" % (f.__module__, f.__name__)
+
+    @functools.wraps(f)
+    def g(*args, **kwargs):
+        for attempt in Retry(name, **options):
+            with attempt:
+                result = f(*args, **kwargs)
+        return result
+    return g
+
 
 def transact(f, note=None, retries=5):
     """Returns transactional version of function argument f.
@@ -30,30 +270,27 @@ def transact(f, note=None, retries=5):
     retry up to retries time before giving up.  If note, it will
     be added to the transaction metadata when it commits.
 
-    The retries occur on ConflictErrors.  If some other
-    TransactionError occurs, the transaction will not be retried.
+    f runs in the current transaction, which is committed after it
+    returns.  The retries occur on ReadConflictErrors raised by f and
+    ConflictErrors raised on commit, after a delay (see Retry).  If some
+    other error occurs, the transaction will not be retried.
     """
+    name = "%s.%s" % (f.__module__, f.__name__)
 
-    # TODO:  deal with ZEO disconnected errors?
-
+    @functools.wraps(f)
     def g(*args, **kwargs):
-        n = retries
-        while n:
-            n -= 1
+        if retries < 1:
+            raise RuntimeError("couldn't commit transaction")
+        attempts = Retry(name, retries, note)
+        for attempt in attempts:
+            attempts._started()
             try:
                 r = f(*args, **kwargs)
-            except ReadConflictError as msg:
-                transaction.abort()
-                if not n:
-                    raise
-                continue
-            try:
-                _commit(note)
-            except ConflictError as msg:
-                transaction.abort()
-                if not n:
+            except ReadConflictError as v:
+                if not attempts._failed(attempt, v):
                     raise
                 continue
-            return r
-        raise RuntimeError("couldn't commit transaction")
+            attempts._commit(attempt)
+            if attempts.done:
+                return r
     return g
@@ -22,6 +22,12 @@ from tempfile import mkstemp
 
 from persistent.TimeStamp import TimeStamp
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
 from ZODB._compat import Unpickler
 from ZODB._compat import BytesIO
 from ZODB._compat import ascii_bytes
@@ -32,11 +38,13 @@ __all__ = ['z64',
            'u64',
            'U64',
            'cp',
+           'copy_file',
            'newTid',
            'oid_repr',
            'serial_repr',
            'tid_repr',
            'positive_id',
+           'class_name',
            'readable_tid_repr',
            'DEPRECATED_ARGUMENT',
            'deprecated37',
@@ -144,6 +152,58 @@ def cp(f1, f2, length=None):
         write(data)
         length -= len(data)
 
+if fcntl is not None and sys.platform.startswith('linux'):
+    # _IOW(0x94, 9, int) in linux/fs.h, only in fcntl as of Python 3.12
+    _FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+else:
+    _FICLONE = None
+
+_copy_file_range = getattr(os, 'copy_file_range', None)
+
+def copy_file(f1, f2):
+    """Copy all data from one file to another.
+
+    The input file (f1) must be at its start and the output file (f2)
+    empty.  When the platform and the file systems allow it, the data
+    are shared by the files using a copy-on-write clone (reflink), or
+    copied by the kernel, rather than read and written by cp().  Both
+    files are left at their end.
+    """
+    f2.flush()
+    fd1 = f1.fileno()
+    fd2 = f2.fileno()
+    if _FICLONE is not None:
+        try:
+            fcntl.ioctl(fd2, _FICLONE, fd1)
+        except (IOError, OSError):
+            pass # Not supported, or across file systems
+        else:
+            f1.seek(0, 2)
+            f2.seek(0, 2)
+            return
+
+    if _copy_file_range is not None:
+        size = os.fstat(fd1).st_size
+        copied = 0
+        try:
+            while copied < size:
+                n = _copy_file_range(fd1, fd2, size - copied)
+                if not n:
+                    break
+                copied += n
+        except OSError:
+            pass
+        if copied == size:
+            # The kernel moved the positions of the descriptors.
+            f1.seek(0, 2)
+            f2.seek(0, 2)
+            return
+        f1.seek(0)
+        f2.seek(0)
+        f2.truncate()
+
+    cp(f1, f2)
+
 def newTid(old):
     t = time.time()
     ts = TimeStamp(*time.gmtime(t)[:5]+(t%60,))
@@ -204,6 +264,12 @@ def positive_id(obj):
         assert result > 0
     return result
 
+def class_name(klass):
+    """Return the dotted name of a class, as shown in reports."""
+    module = getattr(klass, '__module__', '')
+    module = module and '%s.' % module or ''
+    return "%s%s" % (module, klass.__name__)
+
 # Given a ZODB pickle, return pair of strings (module_name, class_name).
 # Do this without importing the module or class object.
 # See ZODB/serialize.py's module docstring for the only docs that exist about
@@ -221,6 +287,21 @@ def get_pickle_metadata(data):
                    b'\x80'  # Python2 indexes bytes -> bytes
                   ): # protocol marker, protocol > 1
         data = data[2:]
+    if data.startswith(b'\x95'):  # FRAME opcode, protocol > 3
+        data = data[9:]
+    if data.startswith(b'\x8c'):  # SHORT_BINUNICODE opcode, protocol > 3
+        # Formats 1 and 2, with the module and class names pushed on the
+        # stack before a STACK_GLOBAL opcode.
+        names = []
+        pos = 0
+        while len(names) < 2 and data[pos:pos+1] == b'\x8c':
+            size = ord(data[pos+1:pos+2])
+            names.append(data[pos+2:pos+2+size].decode())
+            pos += 2 + size
+            if data[pos:pos+1] == b'\x94':  # MEMOIZE opcode
+                pos += 1
+        if len(names) == 2 and data[pos:pos+1] == b'\x93':
+            return tuple(names)
     if data.startswith(b'(c'):   # pickle MARK GLOBAL opcode sequence
         global_prefix = 2
     elif data.startswith(b'c'):  # pickle GLOBAL opcode
@@ -258,6 +339,12 @@ def get_pickle_metadata(data):
         classname = ''
     return modname, classname
 
+def get_pickle_protocol(data):
+    """Return the protocol a ZODB record was pickled with"""
+    if data[:1] == b'\x80': # PROTO opcode, protocol > 1
+        return ord(data[1:2])
+    return 1
+
 def mktemp(dir=None, prefix='tmp'):
     """Create a temp file, known by name, in a semi-secure manner."""
     handle, filename = mkstemp(dir=dir, prefix=prefix)